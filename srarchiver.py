@@ -3,6 +3,7 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file, You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 
+import fnmatch
 import json
 import logging
 import os
@@ -12,10 +13,57 @@ import zipfile
 import stoneridge
 
 
+# Files that are already compressed, so trying to compress them again would
+# just waste time
+STORED_EXTENSIONS = ('.bz2', '.dmg', '.gif', '.gz', '.jar', '.jpeg', '.jpg',
+                     '.png', '.xpi', '.xz', '.zip')
+
+
+def _get_patterns(option, default):
+    value = stoneridge.get_config('archiver', option, default=default)
+    return [p.strip() for p in value.split(',') if p.strip()]
+
+
 class StoneRidgeArchiver(object):
     """A class to zip up all the results and logging from a stone ridge
     run, and put the results with the stone ridge archvies.
     """
+    def __init__(self):
+        self.include = _get_patterns('include', '*')
+        self.exclude = _get_patterns('exclude', 'metadata.zip, profile')
+        self.maxsize = stoneridge.get_config_int('archiver', 'maxsize',
+                                                 default=64) * 1024 * 1024
+        logging.debug('include: %s' % (self.include,))
+        logging.debug('exclude: %s' % (self.exclude,))
+        logging.debug('max file size: %s' % (self.maxsize,))
+
+    def _matches(self, relpath, patterns):
+        """Determine if a path (relative to the out directory) matches any of
+        the glob <patterns>. A pattern that matches a directory matches
+        everything under it, too.
+        """
+        parts = relpath.split('/')
+        for i in range(1, len(parts) + 1):
+            candidate = '/'.join(parts[:i])
+            for p in patterns:
+                if fnmatch.fnmatch(candidate, p):
+                    return True
+        return False
+
+    def _wanted(self, relpath, is_dir=False):
+        if self._matches(relpath, self.exclude):
+            return False
+        if is_dir:
+            # We may want files under this directory even if we don't want the
+            # directory itself
+            return True
+        return self._matches(relpath, self.include)
+
+    def _compression(self, filename):
+        if os.path.splitext(filename)[1].lower() in STORED_EXTENSIONS:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
     def run(self):
         logging.debug('archiver running')
         outdir = stoneridge.get_config('run', 'out')
@@ -43,31 +91,67 @@ class StoneRidgeArchiver(object):
             os.mkdir(archivedir)
 
         logging.debug('opening zip file for writing')
-        zfile = zipfile.ZipFile(filename, mode='w')
+        zfile = zipfile.ZipFile(filename, mode='w',
+                                compression=zipfile.ZIP_DEFLATED,
+                                allowZip64=True)
 
         # Put all the files under a directory in the zip named for the zip
         # file itself, for easy separation when unzipping multiple archives
         # in the same place
         logging.debug('adding files to zip')
+        skipped = []
         for dirpath, dirs, files in os.walk(outdir):
+            reldir = os.path.relpath(dirpath, outdir).replace(os.sep, '/')
+            if reldir == '.':
+                reldir = ''
             dirname = dirpath.replace(outdir, arcname, 1)
             logging.debug('directory %s -> %s' % (dirpath, dirname))
-            # Add the directories to the zip
-            for d in dirs:
+
+            # Add the directories to the zip (and don't bother walking the
+            # ones we've excluded)
+            for d in list(dirs):
+                relpath = '/'.join(filter(None, [reldir, d]))
+                if not self._wanted(relpath, is_dir=True):
+                    logging.debug('excluding directory %s' % (relpath,))
+                    dirs.remove(d)
+                    continue
                 logging.debug('subdirectory %s' % (d,))
                 zfile.write(os.path.join(dirpath, d),
                             arcname=os.path.join(dirname, d))
+
             # Add the files to the zip
             for f in files:
+                relpath = '/'.join(filter(None, [reldir, f]))
+                if not self._wanted(relpath):
+                    logging.debug('excluding file %s' % (relpath,))
+                    continue
+                path = os.path.join(dirpath, f)
+                size = os.path.getsize(path)
+                if self.maxsize and size > self.maxsize:
+                    logging.warning('skipping %s: %s bytes' % (relpath, size))
+                    skipped.append('%s %s' % (relpath, size))
+                    continue
                 logging.debug('file %s' % (f,))
-                zfile.write(os.path.join(dirpath, f),
-                            arcname=os.path.join(dirname, f))
+                zfile.write(path, arcname=os.path.join(dirname, f),
+                            compress_type=self._compression(f))
+
+        if skipped:
+            # Leave a note for whoever looks at this archive
+            zfile.writestr(os.path.join(arcname, 'skipped_files.txt'),
+                           'Files too large to archive (name, bytes):\n%s\n' %
+                           ('\n'.join(skipped),))
 
         logging.debug('closing zip file')
         zfile.close()
 
-        # Make a copy where the uploader will find it
-        shutil.copyfile(filename, metadata)
+        # Make a copy where the uploader will find it. A hard link is plenty,
+        # since nobody modifies the archive once we've written it.
+        if os.path.exists(metadata):
+            os.unlink(metadata)
+        try:
+            os.link(filename, metadata)
+        except (AttributeError, OSError):
+            shutil.copyfile(filename, metadata)
 
 
 @stoneridge.main
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+
+import bottle
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+import stoneridge
+
+
+digestpat = re.compile('^[0-9a-f]{64}$')
+
+
+class BlobOffsetMismatch(Exception):
+    """Special exception type to handle the case when a client sends us a
+    chunk of a blob that doesn't start where our copy of the blob ends, so the
+    client can find out where to resume from.
+    """
+    pass
+
+
+class StoneRidgeBlobStore(object):
+    """A content-addressed store of files (blobs), named by the sha256 of
+    their contents. This runs on the master, and lets the clients hand off
+    large files (like the metadata archive of a run) without putting them
+    inside a queue message. Blobs are uploaded in chunks, so a client can
+    resume an upload that failed partway through. Blobs older than
+    blobstore.maxage hours are thrown away.
+    """
+    def __init__(self):
+        self.root = stoneridge.get_config('blobstore', 'root')
+        self.maxage = stoneridge.get_config_int('blobstore', 'maxage', 168)
+        self.partials = os.path.join(self.root, 'partial')
+        self.lock = threading.Lock()
+        if not os.path.exists(self.partials):
+            os.makedirs(self.partials)
+        logging.debug('blob root: %s' % (self.root,))
+        logging.debug('max age: %s hours' % (self.maxage,))
+
+    def _check(self, digest):
+        if digest is None or not digestpat.match(digest):
+            raise ValueError('Invalid blob digest %s' % (digest,))
+
+    def path(self, digest):
+        """Where the (complete) blob named <digest> lives on disk
+        """
+        self._check(digest)
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _partial(self, digest):
+        self._check(digest)
+        return os.path.join(self.partials, digest)
+
+    def status(self, digest):
+        """Find out how much of the blob named <digest> we have
+        """
+        path = self.path(digest)
+        if os.path.exists(path):
+            return {'complete': True, 'size': os.path.getsize(path)}
+
+        partial = self._partial(digest)
+        size = 0
+        if os.path.exists(partial):
+            size = os.path.getsize(partial)
+        return {'complete': False, 'size': size}
+
+    def append(self, digest, offset, stream):
+        """Add the data in <stream> to the blob named <digest>, which must
+        start at byte <offset> of the blob.
+        """
+        with self.lock:
+            status = self.status(digest)
+            if status['complete']:
+                return status
+            if offset != status['size']:
+                raise BlobOffsetMismatch('Have %s bytes of %s, not %s' %
+                                         (status['size'], digest, offset))
+
+            with file(self._partial(digest), 'ab') as f:
+                shutil.copyfileobj(stream, f, 1024 * 1024)
+
+            return self.status(digest)
+
+    def finish(self, digest):
+        """Mark the blob named <digest> as fully uploaded, moving it into the
+        store if its contents actually match its name.
+        """
+        with self.lock:
+            status = self.status(digest)
+            if status['complete']:
+                return status
+
+            partial = self._partial(digest)
+            h = hashlib.sha256()
+            with file(partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                    h.update(chunk)
+            if h.hexdigest() != digest:
+                os.unlink(partial)
+                raise ValueError('Contents of blob %s have digest %s' %
+                                 (digest, h.hexdigest()))
+
+            path = self.path(digest)
+            if not os.path.exists(os.path.dirname(path)):
+                os.mkdir(os.path.dirname(path))
+            os.rename(partial, path)
+            logging.debug('stored blob %s' % (digest,))
+
+            self._expire()
+            return self.status(digest)
+
+    def _expire(self):
+        """Throw away blobs (and abandoned partial uploads) that are older
+        than our maximum age.
+        """
+        cutoff = time.time() - (self.maxage * 3600)
+        for dirpath, dirs, files in os.walk(self.root):
+            for f in files:
+                path = os.path.join(dirpath, f)
+                if os.stat(path).st_mtime < cutoff:
+                    logging.debug('expiring blob %s' % (path,))
+                    os.unlink(path)
+
+
+# This is our one and only StoneRidgeBlobStore object, initialized just before
+# the web server starts.
+blobstore = None
+
+
+def error(msg):
+    """Create an error response with a message and return it.
+    """
+    logging.debug('Returning error: %s' % (msg,))
+    res = {'status': 'error', 'message': msg}
+    return json.dumps(res)
+
+
+def ok(data=None):
+    """Create a success response, with optional data to go along with it.
+    """
+    logging.debug('Returning ok')
+    res = {'status': 'ok', 'data': data}
+    return json.dumps(res)
+
+
+@bottle.get('/status/:digest')
+def status(digest=None):
+    """Web endpoint for finding out how much of a blob we have.
+    """
+    try:
+        return ok(blobstore.status(digest))
+    except Exception as e:
+        logging.exception('Error getting status of %s' % (digest,))
+        return error(str(e))
+
+
+@bottle.post('/upload/:digest/:offset')
+def upload(digest=None, offset=None):
+    """Web endpoint for uploading a chunk of a blob. The chunk is the raw body
+    of the request.
+    """
+    try:
+        return ok(blobstore.append(digest, int(offset), bottle.request.body))
+    except BlobOffsetMismatch as e:
+        logging.warning('Upload of %s at wrong offset' % (digest,))
+        return error(str(e))
+    except Exception as e:
+        logging.exception('Error uploading to %s' % (digest,))
+        return error(str(e))
+
+
+@bottle.post('/finish/:digest')
+def finish(digest=None):
+    """Web endpoint for marking a blob as completely uploaded.
+    """
+    try:
+        return ok(blobstore.finish(digest))
+    except Exception as e:
+        logging.exception('Error finishing %s' % (digest,))
+        return error(str(e))
+
+
+@bottle.get('/blob/:digest')
+def blob(digest=None):
+    """Web endpoint for downloading a (complete) blob.
+    """
+    try:
+        path = blobstore.path(digest)
+    except ValueError as e:
+        return bottle.HTTPError(400, str(e))
+    return bottle.static_file(os.path.basename(path),
+                              root=os.path.dirname(path),
+                              mimetype='application/octet-stream')
+
+
+def daemon():
+    global blobstore
+
+    blobstore = StoneRidgeBlobStore()
+    port = stoneridge.get_config_int('blobstore', 'port', 2256)
+    stoneridge.StreamLogger.bottle_inject()
+    bottle.run(host='0.0.0.0', port=port)
+
+
+@stoneridge.main
+def main():
+    parser = stoneridge.DaemonArgumentParser()
+    parser.parse_args()
+
+    parser.start_daemon(daemon)
@@ -5,7 +5,6 @@
 
 import logging
 import os
-import shutil
 import sys
 import time
 
@@ -15,32 +14,28 @@ import stoneridge
 class StoneRidgeCleaner(object):
     def __init__(self):
         self.workdir = stoneridge.get_config('stoneridge', 'work')
-        self.keep = stoneridge.get_config_int('cleaner', 'keep')
+        budget = stoneridge.get_config_int('cleaner', 'size', 20480)
+        min_free = stoneridge.get_config_int('cleaner', 'free', 2048)
+        self.evictor = stoneridge.Evictor(self.workdir, budget * 1024 * 1024,
+                                          min_free * 1024 * 1024)
 
     def run(self):
         logging.debug('cleaner running')
 
-        with stoneridge.cwd(self.workdir):
-            while True:
-                listing = os.listdir('.')
-                logging.debug('candidate files: %s' % (listing,))
+        # Get rid of anything left in the trash from last time
+        self.evictor.empty_trash()
 
-                directories = [l for l in listing
-                               if os.path.isdir(l) and not l.startswith('.')]
-                logging.debug('directories: %s' % (directories,))
+        while True:
+            try:
+                evicted = self.evictor.evict()
+                logging.debug('directories deleted: %s' % (evicted,))
+            except:
+                # Things can disappear out from under us, or be impossible to
+                # delete for a while, but we'll get another chance next time
+                logging.exception('Error cleaning %s' % (self.workdir,))
 
-                times = [(d, os.stat(d).st_mtime) for d in directories]
-                times.sort(key=lambda x: x[1])
-
-                delete_us = times[:-self.keep]
-                logging.debug('directories to delete: %s' % (delete_us,))
-
-                for d in delete_us:
-                    logging.debug('removing %s' % (d,))
-                    shutil.rmtree(d)
-
-                # Check again in a minute
-                time.sleep(60)
+            # Check again in a minute
+            time.sleep(60)
 
 
 def daemon(args):
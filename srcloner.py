@@ -7,10 +7,11 @@ import ftplib
 import logging
 import os
 import requests
-import shutil
 import sys
 import tempfile
 
+from multiprocessing.pool import ThreadPool
+
 import stoneridge
 
 
@@ -33,6 +34,23 @@ My sincerest (for a computer) apologies,
 '''
 
 
+class DownloadProgress(object):
+    """Logs the progress of a download every time another 10% of it is done.
+    """
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.reported = -1
+
+    def __call__(self, done, total):
+        if not total:
+            return
+        percent = (done * 100 / total) / 10 * 10
+        if percent > self.reported:
+            self.reported = percent
+            logging.debug('%s: %s%% (%s of %s bytes)' %
+                          (self.outfile, percent, done, total))
+
+
 class StoneRidgeCloner(object):
     """This runs on the central stone ridge server, and downloads releases from
     ftp.m.o to a local directory that is served up to the clients by a plain
@@ -46,8 +64,15 @@ class StoneRidgeCloner(object):
         self.outroot = stoneridge.get_config('cloner', 'output')
         self.srid = srid
         self.outdir = os.path.join(self.outroot, srid)
-        self.keep = stoneridge.get_config_int('cloner', 'keep', default=50)
+        self.budget = stoneridge.get_config_int('cloner', 'size',
+                                                default=20480)
+        self.min_free = stoneridge.get_config_int('cloner', 'free',
+                                                  default=4096)
         self.max_attempts = stoneridge.get_config_int('cloner', 'attempts')
+        self.concurrency = stoneridge.get_config_int('cloner', 'concurrency',
+                                                     default=6)
+        self.retries = stoneridge.get_config_int('cloner', 'retries',
+                                                 default=3)
         self.operating_systems = operating_systems
         self.netconfigs = netconfigs
         self.ldap = ldap
@@ -56,6 +81,14 @@ class StoneRidgeCloner(object):
 
         if not os.path.exists(self.outroot):
             os.mkdir(self.outroot)
+        # Every file we've cloned lives here, named by its sha512, and the
+        # files in each srid's directory are hard links into here. That way,
+        # builds that are identical to one we already have (which happens a
+        # lot) take up no extra space, and don't need to be downloaded.
+        self.store = os.path.join(self.outroot, '.store')
+        self.evictor = stoneridge.Evictor(self.outroot,
+                                          self.budget * 1024 * 1024,
+                                          self.min_free * 1024 * 1024)
 
         root = stoneridge.get_config('cloner', 'root')
         if nightly:
@@ -69,8 +102,11 @@ class StoneRidgeCloner(object):
         logging.debug('srid: %s' % (self.srid,))
         logging.debug('output root: %s' % (self.outroot,))
         logging.debug('output directory: %s' % (self.outdir,))
-        logging.debug('keep history: %s' % (self.keep,))
+        logging.debug('size budget: %s MB' % (self.budget,))
+        logging.debug('min free space: %s MB' % (self.min_free,))
         logging.debug('max attempts: %s' % (self.max_attempts,))
+        logging.debug('concurrency: %s' % (self.concurrency,))
+        logging.debug('retries: %s' % (self.retries,))
         logging.debug('operating systems: %s' % (self.operating_systems,))
         logging.debug('netconfigs: %s' % (self.netconfigs,))
         logging.debug('ldap: %s' % (self.ldap,))
@@ -144,111 +180,194 @@ class StoneRidgeCloner(object):
             logging.debug('creating platform directory %s' % (platdir,))
             os.mkdir(platdir)
 
-    def _dl_to_file(self, url, outfile):
-        """Download the file at <url> and save it to the file
-        at <outfile>
-        """
-        logging.debug('downloading %s => %s' % (url, outfile))
-        resp = requests.get(url, timeout=30000)
-        with file(outfile, 'wb') as f:
-            logging.debug('writing file contents')
-            f.write(resp.content)
-
-    def _dl_test_zip(self, try_subdir, archid, outdir):
-        """Download the test zip for a particular architecture id (<archid>)
-        and save it at <outdir>/tests.zip
-        """
-        logging.debug('downloading test zip for %s to %s' % (archid, outdir))
-        srcfile = '%s.%s.tests.zip' % (self.prefix, archid)
-        logging.debug('zip source filename: %s' % (srcfile,))
-        url = self._build_dl_url(try_subdir, srcfile)
-        outfile = os.path.join(self.outdir, outdir, 'tests.zip')
-        logging.debug('zip dest filename: %s' % (outfile,))
-        self._dl_to_file(url, outfile)
+    def _get_checksums(self, try_subdir, archid):
+        """Get the published checksums for the build files of a particular
+        architecture id (<archid>)
 
-    def _clone_mac(self):
-        """Clone the dmg and tests zip for the mac build
+        Returns: {filename: (sha512, size)}
         """
-        logging.debug('cloning mac build')
-        self._ensure_outdir('mac')
-
-        logging.debug('downloading firefox dmg')
-        dmg = '%s.mac.dmg' % (self.prefix,)
-        logging.debug('dmg source filename: %s' % (dmg,))
-        url = self._build_dl_url(MAC_SUBDIRS[0], dmg)
-        outfile = os.path.join(self.outdir, 'mac', 'firefox.dmg')
-        logging.debug('dmg dest filename: %s' % (outfile,))
-        self._dl_to_file(url, outfile)
-
-        self._dl_test_zip(MAC_SUBDIRS[0], 'mac', 'mac')
-
-    def _clone_linux(self):
-        """Clone the .tar.bz2 and tests zip for both 32-bit and 64-bit linux
-        builds
+        srcfile = '%s.%s.checksums' % (self.prefix, archid)
+        url = self._build_dl_url(try_subdir, srcfile)
+        logging.debug('getting checksums from %s' % (url,))
+        try:
+            resp = requests.get(url, timeout=300)
+        except requests.exceptions.RequestException:
+            logging.exception('Unable to get checksums from %s' % (url,))
+            return {}
+        if resp.status_code != 200:
+            logging.warning('No checksums for %s (%s), not verifying' %
+                            (archid, resp.status_code))
+            return {}
+        return stoneridge.parse_checksums(resp.text)
+
+    def _write_checksums(self, outdir, checksums):
+        """Save the checksums of the files we cloned into <outdir>, in the same
+        format as the upstream .checksums file, so the clients can verify their
+        downloads, too.
+
+        checksums - {local filename: (sha512, size)}
         """
-        logging.debug('cloning linux builds')
-        archids = ('x86_64',)
-        outdirs = ('linux64',)
-        for archid, outdir, subdir in zip(archids, outdirs, LINUX_SUBDIRS):
-            logging.debug('architecture: %s' % (archid,))
-            logging.debug('outdir: %s' % (outdir,))
-            self._ensure_outdir(outdir)
-
-            logging.debug('downloading firefox tarball')
-            srcfile = '%s.linux-%s.tar.bz2' % (self.prefix, archid)
-            logging.debug('tarball source filename: %s' % (srcfile,))
-            url = self._build_dl_url(subdir, srcfile)
-            outfile = os.path.join(self.outdir, outdir, 'firefox.tar.bz2')
-            logging.debug('tarball dest filename: %s' % (outfile,))
-            self._dl_to_file(url, outfile)
-
-            self._dl_test_zip(subdir, 'linux-%s' % (archid,), outdir)
-
-    def _clone_win(self):
-        """Clone the firefox zip and tests zip for both 32-bit and 64-bit
-        windows builds
+        outfile = os.path.join(self.outdir, outdir, 'checksums')
+        logging.debug('writing checksums to %s' % (outfile,))
+        with file(outfile, 'w') as f:
+            for fname, (digest, size) in sorted(checksums.items()):
+                f.write('%s sha512 %s %s\n' % (digest, size, fname))
+
+    def _store_path(self, digest):
+        """Where the file with the sha512 <digest> lives in our store
         """
-        logging.debug('cloning windows build')
-        self._ensure_outdir('win32')
+        return os.path.join(self.store, digest[:2], digest)
 
-        logging.debug('downloading firefox zip')
-        srcfile = '%s.win32.zip' % (self.prefix,)
-        logging.debug('zip source filename: %s' % (srcfile,))
-        url = self._build_dl_url(WINDOWS_SUBDIRS[0], srcfile)
-        outfile = os.path.join(self.outdir, 'win32', 'firefox.zip')
-        logging.debug('zip dest filename: %s' % (outfile,))
-        self._dl_to_file(url, outfile)
+    def _link_from_store(self, blob, outfile):
+        """Make <outfile> a hard link to <blob> (a file in our store)
+        """
+        if os.path.exists(outfile):
+            os.unlink(outfile)
+        os.link(blob, outfile)
+
+    def _add_to_store(self, outfile, digest):
+        """Put the file we just downloaded to <outfile> (with sha512 <digest>)
+        into our store, so later clones can use it. If it turns out we already
+        have an identical file, <outfile> becomes a link to that one instead.
+        """
+        blob = self._store_path(digest)
+        blobdir = os.path.dirname(blob)
+        if not os.path.exists(blobdir):
+            try:
+                os.makedirs(blobdir)
+            except OSError:
+                # Somebody else got there first
+                pass
 
-        self._dl_test_zip(WINDOWS_SUBDIRS[0], 'win32', 'win32')
+        try:
+            os.link(outfile, blob)
+            logging.debug('stored %s as %s' % (outfile, blob))
+        except OSError:
+            if not os.path.exists(blob):
+                logging.exception('Unable to store %s' % (outfile,))
+                return
+            logging.debug('%s is identical to %s' % (outfile, blob))
+            self._link_from_store(blob, outfile)
+
+    def _prune_store(self):
+        """Get rid of files in our store that none of the builds we've kept
+        use any more (that is, files that have no links other than the one in
+        the store)
+        """
+        for dirpath, dirs, files in os.walk(self.store):
+            for f in files:
+                path = os.path.join(dirpath, f)
+                if os.stat(path).st_nlink == 1:
+                    logging.debug('pruning %s from store' % (path,))
+                    os.unlink(path)
+
+    def _dl_to_file(self, url, outfile, checksum=None):
+        """Download the file at <url> and save it to the file at <outfile>,
+        verifying it against <checksum> ((sha512, size)) if we have one. If
+        we already have a file matching <checksum> in our store, we link to
+        that instead of downloading anything.
+
+        Returns: (sha512, size) of the downloaded file
+        """
+        digest, size = checksum if checksum else (None, None)
+        if digest is not None:
+            blob = self._store_path(digest)
+            if os.path.exists(blob) and (size is None or
+                                         os.path.getsize(blob) == size):
+                logging.debug('already have %s as %s' % (url, blob))
+                try:
+                    self._link_from_store(blob, outfile)
+                    return (digest, os.path.getsize(outfile))
+                except OSError:
+                    # Pruned out from under us, so get it the hard way
+                    logging.exception('Unable to link to %s' % (blob,))
+
+        progress = DownloadProgress(outfile)
+        digest = stoneridge.download(url, outfile, digest=digest, size=size,
+                                     retries=self.retries, progress=progress)
+        self._add_to_store(outfile, digest)
+        return (digest, os.path.getsize(outfile))
+
+    def _platform_jobs(self, try_subdir, archid, outdir, pkgsrc, pkgdst):
+        """Build the list of downloads needed to clone the firefox package
+        (<pkgsrc>, saved as <pkgdst>) and tests zip for a particular
+        architecture id (<archid>) into <outdir>.
+
+        Returns: list of (url, outfile, checksum) tuples
+        """
+        logging.debug('planning clone of %s into %s' % (archid, outdir))
+        self._ensure_outdir(outdir)
+        checksums = self._get_checksums(try_subdir, archid)
+
+        jobs = []
+        testzip = '%s.%s.tests.zip' % (self.prefix, archid)
+        for srcfile, dstfile in ((pkgsrc, pkgdst), (testzip, 'tests.zip')):
+            logging.debug('source filename: %s' % (srcfile,))
+            url = self._build_dl_url(try_subdir, srcfile)
+            outfile = os.path.join(self.outdir, outdir, dstfile)
+            logging.debug('dest filename: %s' % (outfile,))
+            jobs.append((url, outfile, checksums.get(srcfile)))
+        return jobs
+
+    def _clone_jobs(self):
+        """Build the list of downloads needed to clone every platform we're
+        going to test.
+
+        Returns: list of (url, outfile, checksum) tuples
+        """
+        jobs = []
+        if self.nightly or 'mac' in self.operating_systems:
+            jobs.extend(self._platform_jobs(MAC_SUBDIRS[0], 'mac', 'mac',
+                                            '%s.mac.dmg' % (self.prefix,),
+                                            'firefox.dmg'))
+        if self.nightly or 'linux' in self.operating_systems:
+            # We only do 64-bit linux tests
+            jobs.extend(self._platform_jobs(
+                LINUX_SUBDIRS[0], 'linux-x86_64', 'linux64',
+                '%s.linux-x86_64.tar.bz2' % (self.prefix,),
+                'firefox.tar.bz2'))
+        if self.nightly or 'windows' in self.operating_systems:
+            jobs.extend(self._platform_jobs(WINDOWS_SUBDIRS[0], 'win32',
+                                            'win32',
+                                            '%s.win32.zip' % (self.prefix,),
+                                            'firefox.zip'))
+        return jobs
+
+    def _run_job(self, job):
+        url, outfile, checksum = job
+        return self._dl_to_file(url, outfile, checksum)
+
+    def _clone(self):
+        """Download all the builds and test zipfiles, up to <concurrency> at a
+        time, then save the checksums of what we got for the clients to use.
+        """
+        jobs = self._clone_jobs()
+        logging.debug('running %s downloads, %s at a time' %
+                      (len(jobs), self.concurrency))
+        pool = ThreadPool(min(self.concurrency, len(jobs)) or 1)
+        try:
+            results = pool.map(self._run_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        cloned = {}
+        for (url, outfile, checksum), result in zip(jobs, results):
+            platdir, fname = os.path.split(outfile)
+            cloned.setdefault(os.path.basename(platdir), {})[fname] = result
+        for platdir, checksums in cloned.items():
+            self._write_checksums(platdir, checksums)
 
     def _cleanup_old_directories(self):
-        """We only keep around so many directories of historical firefoxen.
-        This gets rid of ones we don't care about any more
+        """We only keep around so much disk worth of historical firefoxen.
+        This gets rid of the oldest ones, to make room for the one we're about
+        to clone. The actual deleting happens in the background while we
+        download.
         """
         logging.debug('cleaning up old directories')
-        with stoneridge.cwd(self.outroot):
-            listing = os.listdir('.')
-            logging.debug('candidate files: %s' % (listing,))
-
-            # We want to make sure that we're not looking at anything that's
-            # not a directory that may have somehow gotten into our directory.
-            # We also need to ignore dotfiles.
-            directories = [l for l in listing
-                           if os.path.isdir(l) and not l.startswith('.')]
-            logging.debug('directories: %s' % (directories,))
-
-            # Find out when the directories were last modified, and sort the
-            # list by that, so we can delete the oldest ones.
-            times = [(d, os.stat(d).st_mtime) for d in directories]
-            times.sort(key=lambda x: x[1])
-
-            # Now we can figure out which directories to delete!
-            delete_us = [t[0] for t in times[:-self.keep]]
-            logging.debug('directories to delete: %s' % (delete_us,))
-
-            for d in delete_us:
-                logging.debug('removing %s' % (d,))
-                shutil.rmtree(d)
+        evicted = self.evictor.evict()
+        logging.debug('directories deleted: %s' % (evicted,))
+        self.evictor.empty_trash()
 
     def defer(self):
         args = ['srdeferrer.py',
@@ -336,15 +455,12 @@ class StoneRidgeCloner(object):
             logging.debug('creating output directory')
             os.mkdir(self.outdir)
 
-        # Now download all the builds and test zipfiles
-        if self.nightly or 'mac' in self.operating_systems:
-            self._clone_mac()
-        if self.nightly or 'linux' in self.operating_systems:
-            self._clone_linux()
-        if self.nightly or 'windows' in self.operating_systems:
-            self._clone_win()
-
+        # Make room for the new builds, then download all the builds and test
+        # zipfiles
         self._cleanup_old_directories()
+        self._clone()
+        self.evictor.wait()
+        self._prune_store()
 
 
 @stoneridge.main
@@ -10,9 +10,38 @@ import json
 import logging
 import os
 
+import numpy
+
 import stoneridge
 
 
+def summarize(values):
+    """Calculate summary statistics for a list of values from one metric.
+    The trimmed mean leaves out outliers, as defined by Tukey's fences (more
+    than 1.5 times the interquartile range outside the quartiles).
+
+    Returns: a dict of the statistics, or None if there are no values
+    """
+    if not len(values):
+        return None
+
+    a = numpy.asarray(values, dtype=numpy.float64)
+    q1, median, q3, p90, p95, p99 = numpy.percentile(a, [25, 50, 75, 90, 95,
+                                                         99])
+    fence = 1.5 * (q3 - q1)
+    trimmed = a[(a >= q1 - fence) & (a <= q3 + fence)]
+    return {'count': int(a.size),
+            'mean': float(a.mean()),
+            'median': float(median),
+            'stddev': float(a.std(ddof=1)) if a.size > 1 else 0.0,
+            'min': float(a.min()),
+            'max': float(a.max()),
+            'p90': float(p90),
+            'p95': float(p95),
+            'p99': float(p99),
+            'trimmed_mean': float(trimmed.mean())}
+
+
 class StoneRidgeCollator(object):
     """Takes the data we've collected from our tests and puts it into formats
     the graph server can handle. This is saved into json files for the uploader
@@ -20,6 +49,9 @@ class StoneRidgeCollator(object):
     """
     def run(self):
         logging.debug('collator running')
+        # Dumping every raw value to the log gets expensive for big runs, so
+        # we only do it when asked to
+        verbose = stoneridge.get_config_bool('collator', 'verbose')
         outdir = stoneridge.get_config('run', 'out')
         outfiles = glob.glob(os.path.join(outdir, '*.js.out'))
         outfiles.extend(glob.glob(os.path.join(outdir, '*.page.out')))
@@ -32,8 +64,9 @@ class StoneRidgeCollator(object):
 
         for ofile in outfiles:
             logging.debug('processing %s' % (ofile,))
-            # Make a new copy of the base info
-            results = copy.deepcopy(info)
+            # Make a new copy of the base info. We only ever replace (never
+            # modify) the nested parts of it, so a shallow copy is enough.
+            results = copy.copy(info)
             del results['date']
             results['testrun'] = {'date': info['date'],
                                   'suite': None,
@@ -57,42 +90,60 @@ class StoneRidgeCollator(object):
             logging.debug('reading raw data')
             with file(ofile, 'rb') as f:
                 testinfo = json.load(f)
-                logging.debug('raw testinfo: %s' % (testinfo,))
+                if verbose:
+                    logging.debug('raw testinfo: %s' % (testinfo,))
 
             # Stick the raw data into the json to be uploaded
             logging.debug('processing raw data')
             for k, vlist in testinfo.items():
-                logging.debug('k: %s, vlist: %s' % (k, vlist))
-                for v in vlist:
-                    logging.debug('v: %s' % (v,))
-                    if k == 'total':
-                        logging.debug('appending total %s' % (v['total'],))
-                        # The graph server calculates totals for us, we just
-                        # keep our calculations around for verification in case
-                        results['results_aux']['totals'].append(v['total'])
-                    else:
-                        logging.debug('appending %s total %s' %
-                                      (k, v['total']))
-                        results['results'][k].append(v['total'])
-
-                        for s in ('start', 'stop'):
-                            key = '%s_%s' % (k, s)
-                            logging.debug('appending %s %s stamp %s' %
-                                          (k, s, v[s]))
-                            results['results_aux'][key].append(v[s])
+                logging.debug('k: %s, %s values' % (k, len(vlist)))
+                if k == 'total':
+                    # The graph server calculates totals for us, we just keep
+                    # our calculations around for verification in case
+                    results['results_aux']['totals'].extend(
+                        v['total'] for v in vlist)
+                else:
+                    results['results'][k].extend(v['total'] for v in vlist)
+
+                    for s in ('start', 'stop'):
+                        key = '%s_%s' % (k, s)
+                        results['results_aux'][key].extend(
+                            v[s] for v in vlist)
+
+            # Save everyone downstream the trouble of calculating the usual
+            # statistics from the raw values
+            results['results_summary'] = dict(
+                (k, summarize(vlist))
+                for k, vlist in results['results'].items() if vlist)
+            if verbose:
+                logging.debug('summary: %s' % (results['results_summary'],))
+
+            # Add the resource usage of the test process, if we have it
+            resfile = '%s.resources.json' % (ofile[:-len('.out')],)
+            if os.path.exists(resfile):
+                logging.debug('reading resource samples from %s' % (resfile,))
+                with file(resfile, 'rb') as f:
+                    resources = json.load(f)
+                if resources['wall_time'] is not None:
+                    results['results_aux']['wall_time'].append(
+                        resources['wall_time'])
+                for k, samples in resources['samples'].items():
+                    results['results_aux']['resource_%s' % (k,)] = samples
 
             # Turn our defaultdicts into regular dicts for jsonification
             results['results'] = dict(results['results'])
             results['results_aux'] = dict(results['results_aux'])
-            logging.debug('results: %s' % (results['results'],))
-            logging.debug('aux results: %s' % (results['results_aux'],))
+            if verbose:
+                logging.debug('results: %s' % (results['results'],))
+                logging.debug('aux results: %s' % (results['results_aux'],))
 
             # Write our json results for uploading
             upload_filename = 'upload_%s.json' % (suite,)
             logging.debug('upload filename: %s' % (upload_filename,))
             upload_file = os.path.join(outdir, upload_filename)
             with file(upload_file, 'wb') as f:
-                logging.debug('jsonifying %s' % (results,))
+                if verbose:
+                    logging.debug('jsonifying %s' % (results,))
                 json.dump(results, f)
 
 
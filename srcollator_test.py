@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+import srcollator
+
+
+class SummarizeTest(unittest.TestCase):
+
+    def test_known_values(self):
+        summary = srcollator.summarize([3, 1, 100, 2, 4])
+        self.assertEqual(5, summary['count'])
+        self.assertAlmostEqual(22.0, summary['mean'])
+        self.assertAlmostEqual(3.0, summary['median'])
+        self.assertAlmostEqual((7610 / 4.0) ** 0.5, summary['stddev'])
+        self.assertAlmostEqual(1.0, summary['min'])
+        self.assertAlmostEqual(100.0, summary['max'])
+        self.assertAlmostEqual(61.6, summary['p90'])
+        self.assertAlmostEqual(80.8, summary['p95'])
+        self.assertAlmostEqual(96.16, summary['p99'])
+        # 100 is way past the upper fence (4 + 1.5 * 2), so it's trimmed
+        self.assertAlmostEqual(2.5, summary['trimmed_mean'])
+
+    def test_single_value(self):
+        summary = srcollator.summarize([7])
+        self.assertEqual(1, summary['count'])
+        self.assertEqual(0.0, summary['stddev'])
+        for k in ('mean', 'median', 'min', 'max', 'p90', 'p95', 'p99',
+                  'trimmed_mean'):
+            self.assertAlmostEqual(7.0, summary[k])
+
+    def test_empty(self):
+        self.assertEqual(None, srcollator.summarize([]))
+
+    def test_results_are_plain_python(self):
+        summary = srcollator.summarize([1.5, 2.5])
+        for k, v in summary.items():
+            self.assertTrue(type(v) in (int, float), k)
+
+
+if __name__ == '__main__':
+    unittest.main()
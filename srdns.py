@@ -60,6 +60,13 @@ class BaseDnsModifier(SocketServer.BaseRequestHandler):
         elif msgtype == 'r':
             logging.debug('resetting dns')
             self.reset_dns()
+        elif msgtype == 'w':
+            # Wait for a previous set (data 'private') or reset (data
+            # 'public') to actually take effect
+            logging.debug('waiting for %s dns' % (msgdata,))
+            ok, ip = stoneridge.wait_for_dns(msgdata == 'public')
+            if not ok:
+                status = 'no'
         else:
             logging.error('Unknown msg type, erroring')
             status = 'no'
@@ -4,7 +4,6 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 
 import logging
-import socket
 import sys
 
 import stoneridge
@@ -31,52 +30,21 @@ def send_email(check):
     stoneridge.mail(to, subject, msg)
 
 
-def in_private(ip):
-    """Determine if an IP is in our private (172.16/12) network.
-    """
-    bits = map(int, ip.split('.'))
-    return (bits[0] == 172 and (16 <= bits[1] <= 31))
-
-
-def check_private(ip):
-    """Check to make sure the host name resolved to an IP in our private
-    stone ridge network.
-    """
-    if not in_private(ip):
-        logging.error('IP is not in 172.16/12')
-        send_email('private')
-        sys.exit(1)
-
-
-def check_public(ip):
-    """Check to make sure the host name resolved to an IP on the public
-    internet.
-    """
-    if in_private(ip):
-        logging.error('IP is in 172.16/12')
-        send_email('public')
-        sys.exit(1)
-
-
 @stoneridge.main
 def main():
     parser = stoneridge.TestRunArgumentParser()
     parser.add_argument('--public', dest='public', action='store_true')
     args = parser.parse_args()
 
-    logging.debug('Checking dns for example.com')
-    try:
-        ip = socket.gethostbyname('example.com')
-    except:
-        logging.exception('Error retrieving IP')
-        send_email('gethostbyname')
-        sys.exit(1)
-
+    # Give the resolver a little time to catch up with the change of DNS
+    # servers, rather than failing the run if it's slightly slow to flip
+    check = 'public' if args.public else 'private'
+    logging.debug('Checking for a %s result' % (check,))
+    ok, ip = stoneridge.wait_for_dns(args.public)
     logging.debug('ip = %s' % (ip,))
-
-    if args.public:
-        logging.debug('Checking for a public result')
-        check_public(ip)
-    else:
-        logging.debug('Checking for a private result')
-        check_private(ip)
+    if not ok:
+        if ip is None:
+            send_email('gethostbyname')
+        else:
+            send_email(check)
+        sys.exit(1)
@@ -6,7 +6,6 @@
 import logging
 import struct
 import socket
-import time
 
 import stoneridge
 
@@ -15,16 +14,10 @@ class StoneRidgeDnsUpdater(object):
     def __init__(self, restore):
         self.restore = restore
         self.peer = ('127.0.0.1', 63250)
-        os_name = stoneridge.get_config('machine', 'os')
-        if os_name == 'windows':
-            self.is_windows = True
-        else:
-            self.is_windows = False
         self.netconfig = stoneridge.get_config('run', 'netconfig')
         self.unittest = stoneridge.get_config_bool('stoneridge', 'unittest')
         logging.debug('restore: %s' % (restore,))
         logging.debug('peer: %s' % (self.peer,))
-        logging.debug('is windows: %s' % (self.is_windows,))
         logging.debug('netconfig: %s' % (self.netconfig,))
         logging.debug('unittest: %s' % (self.unittest,))
 
@@ -59,17 +52,21 @@ class StoneRidgeDnsUpdater(object):
         sock.close()
 
         if result != 'ok':
-            logging.error('Could not %sset dns server' %
-                          ('re' if msgtype == 'r' else ''))
-
-        # XXX - WARNING! UGLY HACK BELOW!
-        # Since, on Windows, we have to actually disable the WAN interface to
-        # make our DNS switch properly (at least with my current knowledge of
-        # Windows DNS stuff), we have to wait for the interface to be fully
-        # enabled or disabled before we try to do anything else.
-        if self.is_windows:
-            logging.debug('sleeping 15 seconds for the windows hack')
-            time.sleep(15)
+            # No point waiting for a change that isn't going to happen
+            logging.error('Could not %sset dns server (got %r), not waiting '
+                          'for it to take effect' %
+                          ('re' if msgtype == 'r' else '', result))
+            return
+
+        # Changing DNS servers (especially on Windows, where we have to take
+        # the WAN interface up or down to do it) takes a little while to show
+        # up in name resolution, so wait until it has before we move on.
+        public = msgtype == 'r'
+        ok, ip = stoneridge.wait_for_dns(public)
+        if ok:
+            logging.debug('dns change took effect (got %s)' % (ip,))
+        else:
+            logging.error('dns change did not take effect (got %s)' % (ip,))
 
     def _set_dns(self, dnsserver):
         logging.debug('setting dns server to %s' % (dnsserver,))
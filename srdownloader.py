@@ -23,6 +23,7 @@ class StoneRidgeDownloader(object):
                                                      'download_suffix')
         self.srid = stoneridge.get_config('run', 'srid')
         self.downloaddir = stoneridge.get_config('run', 'download')
+        self.cache = stoneridge.BuildCache()
         logging.debug('server = %s' % (self.server,))
         logging.debug('download root = %s' % (self.downloadroot,))
         logging.debug('platform = %s' % (self.download_platform,))
@@ -30,19 +31,36 @@ class StoneRidgeDownloader(object):
         logging.debug('srid = %s' % (self.srid,))
         logging.debug('downloaddir = %s' % (self.downloaddir,))
 
-    def _download_file(self, filename):
-        url = 'http://%s/%s/%s/%s/%s' % (self.server, self.downloadroot,
-                                         self.srid, self.download_platform,
-                                         filename)
-        logging.debug('downloading %s from %s' % (filename, url))
+    def _build_url(self, filename):
+        return 'http://%s/%s/%s/%s/%s' % (self.server, self.downloadroot,
+                                          self.srid, self.download_platform,
+                                          filename)
+
+    def _get_checksums(self):
+        """Get the checksums the cloner saved for this build, so we can verify
+        our downloads.
+
+        Returns: {filename: (sha512, size)}
+        """
+        url = self._build_url('checksums')
+        logging.debug('getting checksums from %s' % (url,))
         r = requests.get(url)
         if r.status_code != 200:
-            msg = 'Error downloading %s: %s' % (filename, r.status_code)
-            logging.critical(msg)
-            raise Exception(msg)
+            logging.warning('No checksums (%s), not verifying downloads' %
+                            (r.status_code,))
+            return {}
+
+        return stoneridge.parse_checksums(r.text)
 
-        with file(filename, 'wb') as f:
-            f.write(r.content)
+    def _download_file(self, filename, checksums):
+        url = self._build_url(filename)
+        logging.debug('downloading %s from %s' % (filename, url))
+        digest, size = checksums.get(filename, (None, None))
+        try:
+            stoneridge.download(url, filename, digest=digest, size=size)
+        except stoneridge.DownloadError as e:
+            logging.critical('Error downloading %s: %s' % (filename, e))
+            raise
 
     def run(self):
         logging.debug('downloader running')
@@ -52,8 +70,24 @@ class StoneRidgeDownloader(object):
             os.mkdir(self.downloaddir)
         os.chdir(self.downloaddir)
 
-        self._download_file('firefox.%s' % (self.download_suffix,))
-        self._download_file('tests.zip')
+        filenames = ['firefox.%s' % (self.download_suffix,), 'tests.zip']
+
+        # We run each build once per netconfig, so there's a good chance we
+        # already have this one
+        cachekey = '%s_%s' % (self.srid, self.download_platform)
+        cached = self.cache.get('packages', cachekey)
+        if cached is not None:
+            for filename in filenames:
+                logging.debug('using cached %s' % (filename,))
+                stoneridge.link_tree(os.path.join(cached, filename), filename)
+            return
+
+        checksums = self._get_checksums()
+        for filename in filenames:
+            self._download_file(filename, checksums)
+
+        self.cache.put('packages', cachekey,
+                       [os.path.join(self.downloaddir, f) for f in filenames])
 
 
 @stoneridge.main
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+
+import stoneridge
+
+
+# The reporter names archive directories <srid>_<netconfig>_<os>, with
+# _<timestamp> on the end if the srid had already been run on that netconfig
+# and os.
+archivepat = re.compile('^(.+)_(%s)_(%s)(_[0-9]+)?$' %
+                        ('|'.join(stoneridge.NETCONFIGS),
+                         '|'.join(stoneridge.OPERATING_SYSTEMS)))
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+class StoneRidgeHistory(object):
+    """Loads the results in the reporter's archives into the results store,
+    and answers questions about the history of metrics from it.
+    """
+    def __init__(self, db=None):
+        self.archives = stoneridge.get_config('stoneridge', 'archives')
+        self.store = stoneridge.ResultsStore(db)
+        logging.debug('archives: %s' % (self.archives,))
+
+    def backfill(self):
+        """Add everything in the archives directory to the results store.
+        Archives that are already in the store are skipped.
+        """
+        total = 0
+        for name in sorted(os.listdir(self.archives)):
+            match = archivepat.match(name)
+            results_file = os.path.join(self.archives, name, 'results.json')
+            if match is None or not os.path.exists(results_file):
+                logging.debug('skipping %s' % (name,))
+                continue
+
+            srid, netconfig, operating_system = match.groups()[:3]
+            try:
+                with file(results_file) as f:
+                    results = json.load(f)
+            except ValueError:
+                logging.exception('Bad results in %s' % (results_file,))
+                continue
+
+            total += self.store.ingest(name, srid, netconfig,
+                                       operating_system, results)
+
+        logging.debug('added %s values' % (total,))
+        return total
+
+    def query(self, operating_system, netconfig, suite=None, metric=None,
+              ldap='nightly', since=None, until=None, limit=None):
+        """Like stoneridge.ResultsStore.series, but easily turned into json.
+
+        Returns: {'suite/metric': [{'date', 'srid', 'values'}]}
+        """
+        series = self.store.series(operating_system, netconfig, suite=suite,
+                                   metric=metric, ldap=ldap, since=since,
+                                   until=until, limit=limit)
+        return dict(('%s/%s' % key,
+                     [{'date': date, 'srid': srid, 'values': values}
+                      for date, srid, values in points])
+                    for key, points in series.items())
+
+
+@stoneridge.main
+def main():
+    """Maintain and query the history of results the reporter keeps.
+
+        srhistory.py ... backfill
+        srhistory.py ... query --os linux --netconfig umts --suite basic \\
+                               --metric total --last 60
+    """
+    parser = stoneridge.ArgumentParser()
+    parser.add_argument('--db', dest='db', default=None,
+                        help='Results store to use (default from config)')
+    # The subcommands don't need their own copies of --config and --log
+    subparsers = parser.add_subparsers(dest='command',
+                                       parser_class=argparse.ArgumentParser)
+
+    subparsers.add_parser('backfill',
+                          help='Add existing archives to the store')
+
+    query = subparsers.add_parser('query', help='Get the history of metrics')
+    query.add_argument('--os', dest='os', required=True,
+                       choices=stoneridge.OPERATING_SYSTEMS)
+    query.add_argument('--netconfig', dest='netconfig', required=True,
+                       choices=stoneridge.NETCONFIGS)
+    query.add_argument('--suite', dest='suite', default=None)
+    query.add_argument('--metric', dest='metric', default=None)
+    query.add_argument('--ldap', dest='ldap', default='nightly',
+                       help='Whose runs to look at (default nightly)')
+    query.add_argument('--since', dest='since', type=int, default=None,
+                       help='Earliest run date (unix time) to include')
+    query.add_argument('--until', dest='until', type=int, default=None,
+                       help='Latest run date (unix time) to include')
+    query.add_argument('--last', dest='limit', type=int, default=None,
+                       help='Only include the most recent LIMIT runs')
+    query.add_argument('--json', dest='json', action='store_true',
+                       default=False, help='Print all the values as json')
+
+    args = parser.parse_args()
+
+    history = StoneRidgeHistory(args.db)
+    if args.command == 'backfill':
+        total = history.backfill()
+        print 'Added %s values' % (total,)
+        return
+
+    series = history.query(args.os, args.netconfig, suite=args.suite,
+                           metric=args.metric, ldap=args.ldap,
+                           since=args.since, until=args.until,
+                           limit=args.limit)
+    if args.json:
+        json.dump(series, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    for name in sorted(series):
+        for point in series[name]:
+            print '%s %s %s %s' % (name, point['date'], point['srid'],
+                                   median(point['values']))
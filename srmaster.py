@@ -6,13 +6,59 @@
 import logging
 import os
 import subprocess
+import threading
 import time
 import uuid
 
 import stoneridge
 
 
+class TimestampAllocator(object):
+    """Hands out unique, strictly increasing timestamps (in seconds since the
+    epoch) for test runs. The last timestamp handed out is saved in
+    <statefile>, so this holds across restarts of the master, too.
+    """
+    def __init__(self, statefile):
+        self.statefile = statefile
+        self.lock = threading.Lock()
+        self.last = 0
+        if os.path.exists(statefile):
+            with file(statefile) as f:
+                try:
+                    self.last = int(f.read().strip())
+                except ValueError:
+                    logging.error('Invalid timestamp state in %s' %
+                                  (statefile,))
+        logging.debug('timestamp state file: %s' % (self.statefile,))
+        logging.debug('last timestamp: %s' % (self.last,))
+
+    def allocate(self):
+        """Get a new timestamp. This is the current time, unless we've
+        already handed that (or a later) one out, in which case it's one
+        second after the last one we handed out.
+        """
+        with self.lock:
+            tstamp = max(int(time.time()), self.last + 1)
+
+            # Write the new state atomically, so a crash can't leave us with
+            # a truncated state file
+            tmpfile = '%s.tmp' % (self.statefile,)
+            with file(tmpfile, 'w') as f:
+                f.write('%s\n' % (tstamp,))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpfile, self.statefile)
+
+            self.last = tstamp
+            logging.debug('allocated timestamp %s' % (tstamp,))
+            return tstamp
+
+
 class StoneRidgeMaster(stoneridge.QueueListener):
+    # Each message runs a cloner, and cloners share the download directory
+    # (and its eviction index and store of files), so they run one at a time.
+    concurrent = False
+
     def setup(self):
         self.queues = {
             'broadband': stoneridge.QueueWriter(
@@ -24,6 +70,8 @@ class StoneRidgeMaster(stoneridge.QueueListener):
         }
         self.logdir = stoneridge.get_config('stoneridge', 'logs')
         self.config = stoneridge.get_config_file()
+        rundir = stoneridge.get_config('stoneridge', 'run')
+        self.tstamps = TimestampAllocator(os.path.join(rundir, 'tstamp'))
 
     def handle(self, nightly, ldap, sha, netconfigs, operating_systems,
                srid=None, attempt=1):
@@ -73,12 +121,10 @@ class StoneRidgeMaster(stoneridge.QueueListener):
         # other for a particular test run (good for graphing), we set the
         # timestamp once we know we're going to actually run the test (which is
         # right now, after we've cloned the builds).
-        # We also sleep for one minute, so we don't accidentally have 2
-        # different runs show up at the same time as each other on the graphs.
-        # Sure, it's unlikely, but sleeping for a minute won't kill us, and
-        # better safe than sorry!
-        tstamp = int(time.time())
-        time.sleep(60)
+        # The allocator makes sure we never hand out the same timestamp twice,
+        # so we don't accidentally have 2 different runs show up at the same
+        # time as each other on the graphs.
+        tstamp = self.tstamps.allocate()
 
         for nc in netconfigs:
             queue = self.queues.get(nc, None)
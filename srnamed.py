@@ -3,7 +3,7 @@ import socket
 import sys
 import time
 
-from dnsproxy import DnsProxyServer, DnsProxyException
+from dnsproxy import AsyncDnsProxyServer, DnsProxyException, TtlDnsLookup
 
 import stoneridge
 
@@ -25,16 +25,25 @@ SR_HOSTS = {
 }
 
 
+def real_lookup(host):
+    try:
+        return socket.gethostbyname(host)
+    except:
+        logging.error('Could not get actual IP for %s' % (host,))
+        # This should result in NXDOMAIN
+        return None
+
+
+# The proxy answers every query from one thread, so we don't want to go out to
+# the real DNS server for every query for one of the hosts we ignore.
+cached_real_lookup = TtlDnsLookup(real_lookup)
+
+
 def srlookup(host):
     logging.debug('srlookup: checking %s' % (host,))
     if host in IGNORE_HOSTS:
         logging.debug('attempting to ignore %s' % (host,))
-        try:
-            return socket.gethostbyname(host)
-        except:
-            logging.error('Could not get actual IP for %s' % (host,))
-            # This should result in NXDOMAIN
-            return None
+        return cached_real_lookup(host)
 
     if host in SR_HOSTS:
         logging.debug('stone ridge host detected: %s' % (host,))
@@ -49,7 +58,7 @@ def daemon():
     global dnssrv
     logging.debug('about to start proxy server')
     try:
-        with DnsProxyServer(srlookup, listen_ip) as dnssrv:
+        with AsyncDnsProxyServer(srlookup, listen_ip) as dnssrv:
             logging.debug('proxy server started')
             while True:
                 time.sleep(1)
@@ -5,10 +5,19 @@
 
 import base64
 import dzclient
+import httplib
 import json
 import logging
+import numpy
+import oauth2
 import os
+import socket
+import threading
 import time
+import urllib
+import uuid
+
+from multiprocessing.pool import ThreadPool
 
 import stoneridge
 
@@ -22,12 +31,550 @@ For your reference, here's the details about this particular run:
     Operating System: %s
     Network Configuration: %s
 
+%s
 Enjoy!
 -The Stone Ridge System
 '''
 
 
+class DatazillaUploadError(Exception):
+    """Exception type for when an upload to datazilla fails in a way that's
+    worth trying again later (the server is down, or unreachable, or broken)
+    """
+    pass
+
+
+class PersistentDatazillaRequest(dzclient.DatazillaRequest):
+    """Like dzclient.DatazillaRequest, but keeps its (https) connection to the
+    datazilla server open between requests, instead of making a new one for
+    every dataset. Each thread gets its own connection.
+    """
+    def __init__(self, *args, **kwargs):
+        dzclient.DatazillaRequest.__init__(self, *args, **kwargs)
+        self.local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            if self.protocol == 'http':
+                conn = httplib.HTTPConnection(self.host)
+            else:
+                conn = httplib.HTTPSConnection(self.host)
+            self.local.conn = conn
+        return conn
+
+    def _reset(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self.local.conn = None
+
+    def _body(self, dataset):
+        """Build the (oauth-signed) body of the request to upload <dataset>,
+        the same way dzclient does.
+        """
+        path = '/%s/api/load_test' % (self.project,)
+        uri = '%s://%s%s' % (self.protocol, self.host, path)
+        params = {'data': urllib.quote(json.dumps(dataset))}
+
+        if not (self.oauth_key and self.oauth_secret):
+            return urllib.urlencode(params)
+
+        params.update({'user': self.project,
+                       'oauth_version': '1.0',
+                       'oauth_nonce': oauth2.generate_nonce(),
+                       'oauth_timestamp': int(time.time())})
+
+        # There is no requirement for the token in two-legged OAuth but we
+        # still need the token object.
+        token = oauth2.Token(key='', secret='')
+        consumer = oauth2.Consumer(key=self.oauth_key,
+                                   secret=self.oauth_secret)
+        params['oauth_token'] = token.key
+        params['oauth_consumer_key'] = consumer.key
+
+        req = oauth2.Request(method='POST', url=uri, parameters=params)
+        req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(), consumer, token)
+        return req.to_postdata()
+
+    def send(self, dataset):
+        """Send <dataset> to the server.
+
+        Returns: (http status, response body)
+        """
+        path = '/%s/api/load_test' % (self.project,)
+        headers = {'Content-type': 'application/x-www-form-urlencoded'}
+
+        # Try twice, since the server may have closed our kept-alive
+        # connection since we last used it
+        for attempt in (1, 2):
+            body = self._body(dataset)
+            try:
+                conn = self._connection()
+                conn.request('POST', path, body, headers)
+                response = conn.getresponse()
+                return (response.status, response.read())
+            except (httplib.HTTPException, socket.error) as e:
+                self._reset()
+                if attempt == 2:
+                    raise DatazillaUploadError('Error talking to %s: %s' %
+                                               (self.host, e))
+
+
+class DatazillaUploader(object):
+    """Uploads datasets to datazilla, up to <concurrency> at a time, over
+    persistent connections. Datasets that can't be uploaded because of
+    problems with (or getting to) the server are saved in a spool directory,
+    which a background thread keeps trying to upload, backing off
+    exponentially for each entry while it keeps failing.
+    """
+    min_backoff = 60
+    max_backoff = 3600
+
+    def __init__(self, host, project, key, secret, concurrency, spooldir):
+        self.request = PersistentDatazillaRequest('https', host, project, key,
+                                                  secret)
+        self.pool = ThreadPool(concurrency)
+        self.spooldir = spooldir
+        if not os.path.exists(self.spooldir):
+            os.makedirs(self.spooldir)
+
+        drainer = threading.Thread(target=self._drain)
+        drainer.daemon = True
+        drainer.start()
+
+    def _send(self, srid, dataset):
+        """Upload one dataset.
+
+        Returns: True if we're done with the dataset (successfully or not),
+                 False if it's worth trying again later
+        """
+        try:
+            status, response_text = self.request.send(dataset)
+        except DatazillaUploadError:
+            logging.exception('Error uploading data for %s' % (srid,))
+            return False
+
+        logging.debug('got status code %s' % (status,))
+        if status >= 500:
+            logging.error('server error %s for %s' % (status, srid))
+            return False
+        if status != 200:
+            logging.error('bad http status %s for %s' % (status, srid))
+
+        try:
+            result = json.loads(response_text)
+        except:
+            logging.exception('Error loading resposne %s' % (response_text,))
+            return True
+
+        logging.debug('got result %s' % (result,))
+        if result['status'] != 'well-formed JSON stored':
+            logging.error('bad status for %s: %s' % (srid, result['status']))
+        return True
+
+    def _spool(self, entry):
+        """Save an entry ({srid, name, dataset, attempts, next}) to the spool
+        """
+        fname = entry.get('file')
+        if fname is None:
+            fname = '%s_%s.json' % (int(time.time()), uuid.uuid4())
+            entry['file'] = fname
+        path = os.path.join(self.spooldir, fname)
+        tmpfile = '%s.tmp' % (path,)
+        with file(tmpfile, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmpfile, path)
+
+    def _upload_one(self, args):
+        srid, name, dataset = args
+        logging.debug('uploading %s for %s' % (name, srid))
+        if not self._send(srid, dataset):
+            logging.warning('spooling %s for %s' % (name, srid))
+            self._spool({'srid': srid, 'name': name, 'dataset': dataset,
+                         'attempts': 1,
+                         'next': time.time() + self.min_backoff})
+
+    def upload(self, srid, datasets):
+        """Upload all of <datasets> ({name: dataset}) for a run, concurrently
+        """
+        self.pool.map(self._upload_one,
+                      [(srid, name, dataset)
+                       for name, dataset in datasets.items()])
+
+    def _drain(self):
+        """Main loop for the background thread that retries spooled uploads
+        """
+        while True:
+            try:
+                self._drain_once()
+            except:
+                logging.exception('Error draining spool')
+            time.sleep(30)
+
+    def _drain_once(self):
+        now = time.time()
+        for fname in sorted(os.listdir(self.spooldir)):
+            if not fname.endswith('.json'):
+                continue
+            path = os.path.join(self.spooldir, fname)
+            with file(path) as f:
+                entry = json.load(f)
+            if entry['next'] > now:
+                continue
+
+            logging.debug('retrying spooled %s for %s (attempt %s)' %
+                          (entry['name'], entry['srid'],
+                           entry['attempts'] + 1))
+            if self._send(entry['srid'], entry['dataset']):
+                os.unlink(path)
+                continue
+
+            backoff = min(self.min_backoff * (2 ** entry['attempts']),
+                          self.max_backoff)
+            entry['attempts'] += 1
+            entry['next'] = time.time() + backoff
+            self._spool(entry)
+
+
+REGRESSION_MESSAGE = '''Hello!
+
+Stone Ridge has found the following regressions in the results of nightly
+run %s on %s (%s). Each compares the median of the %s runs before the change
+to the median of the %s runs starting with the one listed.
+
+%s
+
+-The Stone Ridge System
+'''
+
+
+class RegressionDetector(object):
+    """Looks for step changes (regressions) in the history of every metric
+    of the nightly runs on an os and netconfig. For each metric, we take the
+    median of each of the recent runs, and slide a pair of windows (<window>
+    runs before a possible change, <window> runs after it) along the history,
+    doing a Welch t-test at every split. A metric has regressed when the split
+    with the biggest t shows a big enough, significant enough increase. We
+    only report that once there's a newer split than it (so we're sure of
+    where the change started), and the store remembers what we've reported,
+    so each change gets reported once, not once a night until it falls out
+    of the window.
+
+    All of this is done for every metric at once, with numpy arrays, so
+    checking thousands of metrics takes well under a second.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.window = stoneridge.get_config_int('regression', 'window', 5)
+        self.threshold = float(stoneridge.get_config('regression',
+                                                     'threshold', 4.0))
+        self.min_change = float(stoneridge.get_config('regression',
+                                                      'change', 5)) / 100.0
+        self.to = stoneridge.get_config('regression', 'email')
+        logging.debug('regression window: %s' % (self.window,))
+        logging.debug('regression threshold: %s' % (self.threshold,))
+        logging.debug('regression min change: %s' % (self.min_change,))
+        logging.debug('regression email: %s' % (self.to,))
+
+    def _medians(self, names, histories, length):
+        """Turn <histories> (lists of (date, srid, values), one for each of
+        <names>) into a (metric x run) array of the median value of each run,
+        lined up so the most recent run is in the last column. Metrics with
+        fewer than <length> runs are padded with NaN on the left.
+        """
+        groups = []
+        values = []
+        for i, points in enumerate(histories):
+            first = i * length + length - len(points)
+            for j, (date, srid, vlist) in enumerate(points):
+                groups.extend([first + j] * len(vlist))
+                values.extend(vlist)
+
+        groups = numpy.array(groups, dtype=numpy.int64)
+        values = numpy.array(values, dtype=numpy.float64)
+
+        # Sort the values of each run together, then pick out the middle of
+        # each run's slice of the sorted values
+        order = numpy.lexsort((values, groups))
+        values = values[order]
+        counts = numpy.bincount(groups, minlength=len(names) * length)
+        starts = numpy.cumsum(counts) - counts
+        have = counts > 0
+        lo = (starts + (counts - 1) // 2)[have]
+        hi = (starts + counts // 2)[have]
+
+        medians = numpy.empty(len(names) * length)
+        medians.fill(numpy.nan)
+        medians[have] = (values[lo] + values[hi]) / 2.0
+        return medians.reshape((len(names), length))
+
+    def _scan(self, x):
+        """Do a Welch t-test between each pair of adjacent windows along every
+        row of <x>.
+
+        Returns: (t statistic, relative change in mean), each an array with a
+                 row for every row of <x> and a column for every split, with
+                 NaN wherever a window is missing a run
+        """
+        n = self.window
+        length = x.shape[1]
+        valid = ~numpy.isnan(x)
+
+        # Center each row to keep the sums of squares well behaved
+        centered = x - (numpy.nansum(x, axis=1) /
+                        numpy.maximum(valid.sum(axis=1), 1))[:, None]
+        centered[~valid] = 0.0
+
+        def cumulative(a):
+            c = numpy.zeros((a.shape[0], length + 1))
+            c[:, 1:] = numpy.cumsum(a, axis=1)
+            return c
+
+        sums = cumulative(centered)
+        squares = cumulative(centered * centered)
+        counts = cumulative(valid.astype(numpy.float64))
+        raw = cumulative(numpy.where(valid, x, 0.0))
+
+        splits = numpy.arange(n, length - n + 1)
+
+        def window(c, start):
+            return c[:, start + n] - c[:, start]
+
+        full = ((window(counts, splits - n) == n) &
+                (window(counts, splits) == n))
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            mean_before = window(sums, splits - n) / n
+            mean_after = window(sums, splits) / n
+            var_before = numpy.maximum(
+                (window(squares, splits - n) - n * mean_before ** 2) / (n - 1),
+                0.0)
+            var_after = numpy.maximum(
+                (window(squares, splits) - n * mean_after ** 2) / (n - 1), 0.0)
+            diff = mean_after - mean_before
+            t = diff / numpy.sqrt((var_before + var_after) / n)
+            # Two windows with no spread at all are either identical, or
+            # completely different
+            t[diff == 0] = 0.0
+            change = diff / (window(raw, splits - n) / n)
+
+        t[~full] = numpy.nan
+        change[~full] = numpy.nan
+        return t, change
+
+    def check(self, srid, netconfig, operating_system):
+        """Look for regressions in the nightly history of every metric on
+        <operating_system> and <netconfig>, now that the results of <srid>
+        are in.
+
+        Returns: list of regressions found, as dicts
+        """
+        n = self.window
+        length = 3 * n
+        series = self.store.series(operating_system, netconfig,
+                                   limit=length)
+
+        # Only look at metrics that are part of this run, and have enough of
+        # a history to have a before and an after
+        names = sorted(k for k, points in series.items()
+                       if len(points) >= 2 * n and points[-1][1] == srid)
+        logging.debug('checking %s of %s metrics for regressions' %
+                      (len(names), len(series)))
+        if not names:
+            return []
+
+        histories = [series[k] for k in names]
+        medians = self._medians(names, histories, length)
+        t, change = self._scan(medians)
+
+        # The change point is the split with the biggest t. While that's still
+        # the newest split, the next run may well put it somewhere later, so
+        # we wait until there's at least one split after it to report it.
+        rows = numpy.arange(len(names))
+        peak = numpy.where(numpy.isnan(t), -numpy.inf, t).argmax(axis=1)
+        with numpy.errstate(invalid='ignore'):
+            flagged = ((t[rows, peak] >= self.threshold) &
+                       (change[rows, peak] >= self.min_change) &
+                       (peak < t.shape[1] - 1))
+
+        reported = self.store.regressions(operating_system, netconfig)
+        regressions = []
+        for i in numpy.flatnonzero(flagged):
+            suite, metric = names[i]
+            column = n + peak[i]
+            first = column - (length - len(histories[i]))
+            start = histories[i][first]
+
+            # Noise can move the peak back and forth by a run or two from one
+            # night to the next, so anything already reported within the
+            # windows of this split is the same change
+            nearby = set(p[1] for p in
+                         histories[i][max(first - n, 0):first + n])
+            if nearby & reported.get((suite, metric), set()):
+                continue
+
+            regressions.append({
+                'suite': suite,
+                'metric': metric,
+                'srid': start[1],
+                'date': start[0],
+                'before': float(numpy.median(medians[i, column - n:column])),
+                'after': float(numpy.median(medians[i, column:column + n])),
+                'change': float(change[i, peak[i]]),
+                't': float(t[i, peak[i]])})
+        logging.debug('found %s regressions' % (len(regressions),))
+        return regressions
+
+    def report(self, srid, netconfig, operating_system, regressions):
+        """Email <regressions> (as found by check) to whoever wants them,
+        and remember that they've been reported. If the email can't be sent,
+        they aren't remembered, so check will find them again next time.
+        """
+        lines = []
+        for r in regressions:
+            logging.warning('regression in %s/%s on %s %s starting with %s: '
+                            '%s -> %s' % (r['suite'], r['metric'],
+                                          operating_system, netconfig,
+                                          r['srid'], r['before'], r['after']))
+            lines.append('    %s/%s: %.2f -> %.2f (%+.1f%%, t=%.1f), '
+                         'starting with %s' %
+                         (r['suite'], r['metric'], r['before'], r['after'],
+                          r['change'] * 100, r['t'], r['srid']))
+
+        if self.to is not None:
+            msg_text = REGRESSION_MESSAGE % (srid, operating_system,
+                                             netconfig, self.window,
+                                             self.window, '\n'.join(lines))
+            if not stoneridge.sendmail(self.to,
+                                       'Stone Ridge Regressions (%s %s)' %
+                                       (operating_system, netconfig),
+                                       msg_text):
+                return
+
+        for r in regressions:
+            self.store.add_regression(operating_system, netconfig,
+                                      r['suite'], r['metric'], r['srid'])
+
+
+class BaselineComparer(object):
+    """Compares the results of a pushed (try) run to those of the nightly run
+    on the same os and netconfig that's closest in time to it. For each
+    metric, we find the change in the median, with a bootstrap confidence
+    interval for that change. A change whose interval doesn't include 0 is
+    significant.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.resamples = stoneridge.get_config_int('comparison', 'resamples',
+                                                   2000)
+        self.confidence = float(stoneridge.get_config('comparison',
+                                                      'confidence', 95))
+        logging.debug('comparison resamples: %s' % (self.resamples,))
+        logging.debug('comparison confidence: %s' % (self.confidence,))
+
+    def _bootstrap(self, baseline, pushed, random):
+        """Find the change in median from <baseline> to <pushed>, along with
+        a confidence interval for it.
+
+        Returns: (change, low, high)
+        """
+        baseline = numpy.asarray(baseline, dtype=numpy.float64)
+        pushed = numpy.asarray(pushed, dtype=numpy.float64)
+
+        # Every resample of both sets of values at once
+        b = baseline[random.randint(0, baseline.size,
+                                    (self.resamples, baseline.size))]
+        p = pushed[random.randint(0, pushed.size,
+                                  (self.resamples, pushed.size))]
+        changes = numpy.median(p, axis=1) - numpy.median(b, axis=1)
+
+        tail = (100.0 - self.confidence) / 2
+        low, high = numpy.percentile(changes, [tail, 100.0 - tail])
+        change = numpy.median(pushed) - numpy.median(baseline)
+        return float(change), float(low), float(high)
+
+    def compare(self, srid, netconfig, operating_system, results):
+        """Compare <results> (as sent by the uploader) of the pushed run
+        <srid> to the nearest nightly.
+
+        Returns: (srid of the nightly, [comparison of each metric]), or
+                 (None, []) if there's nothing to compare to
+        """
+        dates = [d['testrun']['date'] for d in results.values()
+                 if isinstance(d, dict) and 'testrun' in d]
+        if not dates:
+            return None, []
+
+        baseline_srid = self.store.nearest(operating_system, netconfig,
+                                           min(dates))
+        if baseline_srid is None:
+            logging.debug('no baseline for %s' % (srid,))
+            return None, []
+        logging.debug('baseline for %s is %s' % (srid, baseline_srid))
+
+        baseline = self.store.series(operating_system, netconfig,
+                                     srid=baseline_srid)
+
+        # Seeded, so the same results always get the same report
+        random = numpy.random.RandomState(0)
+        comparisons = []
+        for dataset in results.values():
+            if not isinstance(dataset, dict) or 'testrun' not in dataset:
+                continue
+            suite = dataset['testrun']['suite']
+            for metric, values in sorted(dataset['results'].items()):
+                points = baseline.get((suite, metric))
+                if not values or not points:
+                    continue
+                base_values = points[-1][2]
+                change, low, high = self._bootstrap(base_values, values,
+                                                    random)
+                base_median = float(numpy.median(base_values))
+                comparisons.append({
+                    'suite': suite,
+                    'metric': metric,
+                    'baseline': base_median,
+                    'pushed': base_median + change,
+                    'change': change,
+                    'low': low,
+                    'high': high,
+                    'significant': low > 0 or high < 0})
+
+        comparisons.sort(key=lambda c: (c['suite'], c['metric']))
+        return baseline_srid, comparisons
+
+    def format(self, baseline_srid, comparisons):
+        """Make a plain-text table out of the results of compare, for email
+        """
+        if not comparisons:
+            return 'There were no nightly results to compare this run to.\n'
+
+        lines = ['Compared to nightly run %s (medians, with %s%% confidence' %
+                 (baseline_srid, int(self.confidence)),
+                 'intervals for the change, * marks significant changes):',
+                 '']
+        names = ['%s/%s' % (c['suite'], c['metric']) for c in comparisons]
+        width = max(len(n) for n in names + ['metric'])
+        lines.append('    %-*s %10s %10s %10s %8s  %s' %
+                     (width, 'metric', 'nightly', 'yours', 'change', '%',
+                      'interval'))
+        for name, c in zip(names, comparisons):
+            if c['baseline']:
+                percent = '%+.1f%%' % (100.0 * c['change'] / c['baseline'],)
+            else:
+                percent = '-'
+            lines.append('    %-*s %10.2f %10.2f %+10.2f %8s  '
+                         '[%+.2f, %+.2f]%s' %
+                         (width, name, c['baseline'], c['pushed'],
+                          c['change'], percent, c['low'], c['high'],
+                          ' *' if c['significant'] else ''))
+        return '\n'.join(lines) + '\n'
+
+
 class StoneRidgeReporter(stoneridge.QueueListener):
+    concurrent = True
+
     def setup(self):
         self.host = stoneridge.get_config('report', 'host')
         self.project = stoneridge.get_config('report', 'project')
@@ -35,6 +582,11 @@ class StoneRidgeReporter(stoneridge.QueueListener):
         self.secret = stoneridge.get_config('report', 'secret')
         self.archives = stoneridge.get_config('stoneridge', 'archives')
         self.unittest = stoneridge.get_config_bool('stoneridge', 'unittest')
+        self.concurrency = stoneridge.get_config_int('report', 'concurrency',
+                                                     4)
+        self.spool = stoneridge.get_config('report', 'spool')
+        if self.spool is None:
+            self.spool = os.path.join(self.archives, 'spool')
 
         logging.debug('report host: %s' % (self.host,))
         logging.debug('project: %s' % (self.project,))
@@ -42,9 +594,21 @@ class StoneRidgeReporter(stoneridge.QueueListener):
         logging.debug('oauth secret: %s' % (self.secret,))
         logging.debug('archives: %s' % (self.archives,))
         logging.debug('unittest: %s' % (self.unittest,))
+        logging.debug('concurrency: %s' % (self.concurrency,))
+        logging.debug('spool: %s' % (self.spool,))
+
+        self.history = stoneridge.ResultsStore()
+        self.detector = RegressionDetector(self.history)
+        self.comparer = BaselineComparer(self.history)
+
+        self.uploader = None
+        if not self.unittest:
+            self.uploader = DatazillaUploader(self.host, self.project,
+                                              self.key, self.secret,
+                                              self.concurrency, self.spool)
 
     def save_data(self, srid, netconfig, operating_system, results,
-                  metadata_b64, ldap):
+                  metadata_b64, metadata_digest, metadata_size, ldap):
         dirname = '%s_%s_%s' % (srid, netconfig, operating_system)
         archivedir = os.path.join(self.archives, dirname)
         if os.path.exists(archivedir):
@@ -57,21 +621,53 @@ class StoneRidgeReporter(stoneridge.QueueListener):
         with file(results_file, 'w') as f:
             json.dump(results, f)
 
-        metadata = base64.b64decode(metadata_b64)
+        # Keep our own history of results, so we can look at trends without
+        # going through every archive
+        try:
+            self.history.ingest(os.path.basename(archivedir), srid, netconfig,
+                                operating_system, results)
+        except:
+            logging.exception('Unable to store history for %s' % (srid,))
+
         metadata_file = os.path.join(archivedir, 'metadata.zip')
-        with file(metadata_file, 'wb') as f:
-            f.write(metadata)
+        if metadata_digest is not None:
+            # Only now that we need the metadata do we go get it from the blob
+            # store, straight to disk.
+            try:
+                stoneridge.fetch_blob(metadata_digest, metadata_size,
+                                      metadata_file)
+            except stoneridge.BlobStoreError:
+                logging.exception('Unable to get metadata blob %s for %s' %
+                                  (metadata_digest, srid))
+        else:
+            metadata = base64.b64decode(metadata_b64)
+            with file(metadata_file, 'wb') as f:
+                f.write(metadata)
 
         if ldap is not None:
+            try:
+                baseline_srid, comparisons = self.comparer.compare(
+                    srid, netconfig, operating_system, results)
+                comparison = self.comparer.format(baseline_srid, comparisons)
+            except:
+                logging.exception('Unable to compare %s to nightly' % (srid,))
+                comparison = ''
             msg_text = EMAIL_MESSAGE % (ldap, srid, operating_system,
-                                        netconfig)
-            stoneridge.sendmail(ldap, 'Stone Ridge Complete',
-                                msg_text, (metadata_file, 'results.zip'))
+                                        netconfig, comparison)
+            attachments = []
+            if os.path.exists(metadata_file):
+                attachments.append((metadata_file, 'results.zip'))
+            else:
+                logging.warning('No metadata for %s, sending email to %s '
+                                'without it' % (srid, ldap))
+            stoneridge.sendmail(ldap, 'Stone Ridge Complete', msg_text,
+                                *attachments)
 
-    def handle(self, srid, netconfig, operating_system, results, metadata,
-               ldap):
+    def handle(self, srid, netconfig, operating_system, results, ldap,
+               metadata=None, metadata_digest=None, metadata_size=None):
         logging.debug('uploading results for %s' % (srid,))
 
+        datasets = {}
         for name in results:
             dataset = results[name]
             if not isinstance(dataset, dict):
@@ -84,36 +680,27 @@ class StoneRidgeReporter(stoneridge.QueueListener):
                               (self.host, self.project))
                 logging.debug('dataset: %s' % (dataset,))
             else:
-                logging.debug('uploading data')
-                request = dzclient.DatazillaRequest('https', self.host,
-                                                    self.project, self.key,
-                                                    self.secret)
-                response = request.send(dataset)
-                logging.debug('got status code %s' % (response.status,))
-                if response.status != 200:
-                    logging.error('bad http status %s for %s' %
-                                  (response.status, srid))
-
-                try:
-                    response_text = response.read()
-                except:
-                    logging.exception('Error reading response')
-                    continue
+                datasets[name] = dataset
 
-                try:
-                    result = json.loads(response_text)
-                except:
-                    logging.exception('Error loading resposne %s' %
-                                      (response_text,))
-                    continue
-
-                logging.debug('got result %s' % (result,))
-                if result['status'] != 'well-formed JSON stored':
-                    logging.error('bad status for %s: %s' %
-                                  (srid, result['status']))
+        if datasets:
+            logging.debug('uploading data')
+            self.uploader.upload(srid, datasets)
 
         self.save_data(srid, netconfig, operating_system, results, metadata,
-                       ldap)
+                       metadata_digest, metadata_size, ldap)
+
+        if ldap is None:
+            # Now that this nightly run is part of our history, see if it
+            # shows anything getting worse
+            try:
+                regressions = self.detector.check(srid, netconfig,
+                                                  operating_system)
+                if regressions:
+                    self.detector.report(srid, netconfig, operating_system,
+                                         regressions)
+            except:
+                logging.exception('Error checking %s for regressions' %
+                                  (srid,))
 
 
 def daemon():
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import srreporter
+import stoneridge
+
+
+class RegressionDetectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = stoneridge.ResultsStore(
+            os.path.join(self.tmpdir, 'history.db'))
+        self.detector = srreporter.RegressionDetector(self.store)
+        self.detector.to = None
+        self.sendmail = stoneridge.sendmail
+
+    def tearDown(self):
+        stoneridge.sendmail = self.sendmail
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def run_nights(self, seed, nights=35, step_at=None, step=1.2):
+        """Add <nights> nightly runs of a noisy (5-10%) metric to the store,
+        checking for (and reporting) regressions after each one, like the
+        reporter does. The metric goes up by <step> starting with run number
+        <step_at>.
+
+        Returns: [(night, srid the reported regression started with)]
+        """
+        rand = random.Random(seed)
+        found = []
+        for night in range(nights):
+            base = 100.0
+            if step_at is not None and night >= step_at:
+                base *= step
+            sigma = base * rand.uniform(0.05, 0.10)
+            srid = 'n%d' % (night,)
+            results = {'suite': {
+                'testrun': {'date': night, 'suite': 'suite',
+                            'options': {'ldap': 'nightly'}},
+                'results': {'metric': [rand.gauss(base, sigma)
+                                       for _ in range(5)]}}}
+            self.store.ingest('archive%d' % (night,), srid, 'broadband',
+                              'linux', results)
+            regressions = self.detector.check(srid, 'broadband', 'linux')
+            for r in regressions:
+                found.append((night, r['srid']))
+            if regressions:
+                self.detector.report(srid, 'broadband', 'linux', regressions)
+        return found
+
+    def test_step_reported_once(self):
+        # The newest split gets closer to the step every night up to the 24th,
+        # and t grows with it, but it's only reported once, once we can see
+        # it's really at n20
+        self.assertEqual([(25, 'n20')], self.run_nights(3, step_at=20))
+
+    def test_step_reported_once_other_noise(self):
+        self.assertEqual([(25, 'n20')], self.run_nights(5, step_at=20))
+
+    def test_not_reported_again_by_new_detector(self):
+        found = self.run_nights(3, nights=26, step_at=20)
+        self.assertEqual([(25, 'n20')], found)
+
+        # A restarted reporter shouldn't report it all over again
+        self.detector = srreporter.RegressionDetector(self.store)
+        self.assertEqual([], self.detector.check('n25', 'broadband', 'linux'))
+
+    def test_reported_again_when_email_fails(self):
+        sent = []
+
+        def sendmail(to, subject, message, *attachments):
+            # The mail server is down for the first two tries
+            sent.append(subject)
+            return len(sent) > 2
+
+        stoneridge.sendmail = sendmail
+        self.detector.to = 'alerts@example.com'
+        self.assertEqual([(25, 'n20'), (26, 'n20'), (27, 'n20')],
+                         self.run_nights(3, step_at=20))
+        self.assertEqual(3, len(sent))
+
+    def test_no_change(self):
+        self.assertEqual([], self.run_nights(3))
+
+
+class BaselineComparerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = stoneridge.ResultsStore(
+            os.path.join(self.tmpdir, 'history.db'))
+        self.comparer = srreporter.BaselineComparer(self.store)
+        self.rand = random.Random(7)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def make_results(self, date, base, ldap):
+        """Results (as sent by the uploader) of a run on <date> by <ldap>,
+        with 10 noisy (5%) values around <base> for the metric.
+        """
+        return {'suite': {
+            'testrun': {'date': date, 'suite': 'suite',
+                        'options': {'ldap': ldap}},
+            'results': {'metric': [self.rand.gauss(base, base * 0.05)
+                                   for _ in range(10)]}}}
+
+    def add_nightly(self, srid, date, base=100.0):
+        self.store.ingest('archive-%s' % (srid,), srid, 'broadband', 'linux',
+                          self.make_results(date, base, 'nightly'))
+
+    def compare(self, date, base):
+        results = self.make_results(date, base, 'someone@example.com')
+        return self.comparer.compare('pushed', 'broadband', 'linux', results)
+
+    def test_nearest_nightly(self):
+        self.add_nightly('early', 1000)
+        self.add_nightly('late', 2000)
+        self.assertEqual('early', self.store.nearest('linux', 'broadband',
+                                                     1400))
+        self.assertEqual('late', self.store.nearest('linux', 'broadband',
+                                                    1600))
+        self.assertEqual('late', self.store.nearest('linux', 'broadband',
+                                                    5000))
+        self.assertEqual(None, self.store.nearest('mac', 'broadband', 1400))
+
+        baseline_srid, comparisons = self.compare(1900, 100.0)
+        self.assertEqual('late', baseline_srid)
+        self.assertEqual([('suite', 'metric')],
+                         [(c['suite'], c['metric']) for c in comparisons])
+
+    def test_no_baseline(self):
+        self.assertEqual((None, []), self.compare(1000, 100.0))
+        self.assertEqual('There were no nightly results to compare this run '
+                         'to.\n', self.comparer.format(None, []))
+
+    def test_clearly_worse(self):
+        self.add_nightly('nightly', 1000)
+        _, comparisons = self.compare(1000, 150.0)
+        c = comparisons[0]
+        self.assertTrue(c['significant'])
+        self.assertTrue(0 < c['low'] <= c['change'] <= c['high'])
+        self.assertTrue(self.comparer.format('nightly', comparisons)
+                        .endswith(' *\n'))
+
+    def test_clearly_better(self):
+        self.add_nightly('nightly', 1000)
+        _, comparisons = self.compare(1000, 50.0)
+        c = comparisons[0]
+        self.assertTrue(c['significant'])
+        self.assertTrue(c['low'] <= c['change'] <= c['high'] < 0)
+
+    def test_no_change(self):
+        self.add_nightly('nightly', 1000)
+        _, comparisons = self.compare(1000, 100.0)
+        c = comparisons[0]
+        self.assertFalse(c['significant'])
+        self.assertTrue(c['low'] < 0 < c['high'])
+        self.assertFalse(self.comparer.format('nightly', comparisons)
+                         .endswith(' *\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -127,10 +127,13 @@ class StoneRidgeRunner(object):
                 process_out_file = '%s.process.out' % (test,)
                 process_out_file = os.path.join(outdir, process_out_file)
                 logging.debug('process output at %s' % (process_out_file,))
+                samples_file = '%s.resources.json' % (test,)
+                samples_file = os.path.join(outdir, samples_file)
+                logging.debug('resource samples at %s' % (samples_file,))
                 timed_out = False
                 with file(process_out_file, 'wb') as f:
                     try:
-                        res = runner(args, f)
+                        res = runner(args, f, samples=samples_file)
                     except stoneridge.TestProcessTimeout:
                         logging.exception('test process timed out!')
                         timed_out = True
@@ -9,6 +9,8 @@ import stoneridge
 
 
 class StoneRidgeScheduler(stoneridge.QueueListener):
+    concurrent = True
+
     def setup(self, netconfig):
         self.netconfig = netconfig
 
@@ -4,6 +4,7 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 
 import logging
+import multiprocessing
 import os
 import shutil
 import subprocess
@@ -47,6 +48,10 @@ class StoneRidgeUnpacker(object):
         logging.debug('firefox package: %s' % (self.firefoxpkg,))
         self.testzip = os.path.join(downloaddir, 'tests.zip')
         logging.debug('test zip file: %s' % (self.testzip,))
+        self.srid = stoneridge.get_config('run', 'srid')
+        self.download_platform = stoneridge.get_config('machine',
+                                                       'download_platform')
+        self.cache = stoneridge.BuildCache()
 
     def _copy_tree(self, srcdir, name):
         logging.debug('_copy_tree(%s, %s)' % (srcdir, name))
@@ -69,42 +74,79 @@ class StoneRidgeUnpacker(object):
                 logging.debug('copy %s -> %s' % (src, dst))
                 shutil.copyfile(src, dst)
 
-    def run(self):
-        logging.debug('unpacker running')
-        # Get our firefox
-        logging.debug('unpacking firefox')
-        self.unpack_firefox()
+    def _extract_tests(self):
+        """Extract xpcshell, the components and the plugins from the tests
+        zipfile directly to where they belong in bindir, without unpacking
+        anything else.
+        """
+        xpcshell_bin = stoneridge.get_config('machine', 'xpcshell')
+        xpcshell_member = 'bin/%s' % (xpcshell_bin,)
+        prefixes = ('bin/components/', 'bin/plugins/')
 
-        # Unzip the stuff we need from the tests zipfile
-        unzipdir = os.path.join(self.workdir, 'tests')
-        logging.debug('creating unzip dir %s' % (unzipdir,))
-        os.mkdir(unzipdir)
         z = zipfile.ZipFile(self.testzip, 'r')
-        members = [f for f in z.namelist() if f.startswith('bin')]
-        logging.debug('unzipping %s' % (str(members),))
-        z.extractall(unzipdir, members)
-
-        # Put the xpcshell binary where it belongs
-        unzipbin = os.path.join(unzipdir, 'bin')
-        xpcshell_bin = stoneridge.get_config('machine', 'xpcshell')
-        xpcshell = os.path.join(unzipbin, xpcshell_bin)
-        logging.debug('xpcshell: %s' % (xpcshell,))
+        try:
+            for info in z.infolist():
+                name = info.filename
+                if name != xpcshell_member and not name.startswith(prefixes):
+                    continue
+
+                dst = os.path.join(self.bindir, *name[4:].split('/'))
+                if name.endswith('/'):
+                    if not os.path.exists(dst):
+                        os.makedirs(dst)
+                    continue
+
+                dstdir = os.path.dirname(dst)
+                if not os.path.exists(dstdir):
+                    os.makedirs(dstdir)
+                src = z.open(info)
+                try:
+                    with file(dst, 'wb') as f:
+                        shutil.copyfileobj(src, f, 1024 * 1024)
+                finally:
+                    src.close()
+        finally:
+            z.close()
 
         # Apparently xpcshell stopped being executable in the tests zip at some
-        # point, so we need to fix that before copying
-        logging.debug('setting permissions on xpcshell')
+        # point, so we need to fix that
+        xpcshell = os.path.join(self.bindir, xpcshell_bin)
+        logging.debug('setting permissions on xpcshell %s' % (xpcshell,))
         os.chmod(xpcshell, 0755)
 
-        logging.debug('copy xpcshell %s -> %s' % (xpcshell, self.bindir))
-        shutil.copy(xpcshell, self.bindir)
+    def run(self):
+        logging.debug('unpacker running')
 
-        # Put our components into place
-        logging.debug('copying components')
-        self._copy_tree(unzipbin, 'components')
+        # The unpacked build only depends on the contents of the packages we
+        # got it from, so if we've already unpacked those once, we can just
+        # use that (already fully set up) build.
+        pkgkey = '%s_%s' % (self.srid, self.download_platform)
+        treekey = self.cache.digest('packages', pkgkey)
+        if treekey is not None:
+            cached = self.cache.get('trees', treekey)
+            if cached is not None:
+                for name in os.listdir(cached):
+                    logging.debug('using cached %s' % (name,))
+                    stoneridge.link_tree(os.path.join(cached, name),
+                                         os.path.join(self.workdir, name))
+                return
+
+        before = set(os.listdir(self.workdir))
+        self.unpack()
+
+        if treekey is not None:
+            # Save everything we created for the next run of this build
+            created = set(os.listdir(self.workdir)) - before
+            self.cache.put('trees', treekey,
+                           [os.path.join(self.workdir, c) for c in created])
+
+    def unpack(self):
+        # Get our firefox
+        logging.debug('unpacking firefox')
+        self.unpack_firefox()
 
-        # Put the plugins in place, in case we need them
-        logging.debug('copying plugins')
-        self._copy_tree(unzipbin, 'plugins')
+        # Pull the stuff we need out of the tests zipfile, straight into place
+        self._extract_tests()
 
         # Put the pageloader components into place
         srroot = stoneridge.get_config('stoneridge', 'root')
@@ -127,15 +169,16 @@ class StoneRidgeUnpacker(object):
         plmanifest = os.path.join(pageloader, 'chrome.manifest')
         fxmanifest = os.path.join(self.bindir, 'chrome.manifest')
         logging.debug('append %s to %s' % (plmanifest, fxmanifest))
-        if os.path.exists(fxmanifest):
-            with file(fxmanifest, 'rb') as f:
-                lines = f.readlines()
-        else:
-            lines = []
-        with file(plmanifest, 'rb') as f:
-            lines.extend(f.readlines())
-        with file(fxmanifest, 'wb') as f:
-            f.writelines(lines)
+        with file(fxmanifest, 'ab+') as f:
+            # Make sure we don't glue our first line onto the end of the last
+            # line of the existing manifest
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != '\n':
+                    f.write('\n')
+            with file(plmanifest, 'rb') as pl:
+                shutil.copyfileobj(pl, f)
 
     def unpack_firefox(self):
         logging.critical('Base unpack_firefox called!')
@@ -151,11 +194,37 @@ class WindowsUnpacker(StoneRidgeUnpacker):
 
 
 class LinuxUnpacker(StoneRidgeUnpacker):
+    # Parallel bzip2 decompressors we can have tar use, in order of preference
+    parallel_bunzip2 = ('lbzip2', 'pbzip2')
+
+    def _find_bunzip2(self):
+        """Find a parallel bzip2 decompressor, if we have more than one core to
+        run it on and one is installed.
+
+        Returns: path to the decompressor, or None
+        """
+        if multiprocessing.cpu_count() < 2:
+            return None
+
+        path = os.environ.get('PATH', os.defpath).split(os.pathsep)
+        for prog in self.parallel_bunzip2:
+            for d in path:
+                candidate = os.path.join(d, prog)
+                if os.access(candidate, os.X_OK):
+                    return candidate
+        return None
+
     def unpack_firefox(self):
         logging.debug('untarring linux package %s in %s' %
                       (self.firefoxpkg, self.workdir))
-        subprocess.call(['tar', 'xjvf', self.firefoxpkg],
-                        cwd=self.workdir)
+        bunzip2 = self._find_bunzip2()
+        if bunzip2:
+            logging.debug('decompressing with %s' % (bunzip2,))
+            args = ['tar', '--use-compress-program=%s' % (bunzip2,), '-xf',
+                    self.firefoxpkg]
+        else:
+            args = ['tar', 'xjf', self.firefoxpkg]
+        subprocess.call(args, cwd=self.workdir)
 
 
 class MacUnpacker(StoneRidgeUnpacker):
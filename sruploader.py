@@ -36,11 +36,23 @@ class StoneRidgeUploader(object):
             with file(filename) as f:
                 results[fname] = json.load(f)
 
+        # The metadata goes to the blob store on the master, so all we have
+        # to send along with the results is the name of the blob. If we can't
+        # do that, we fall back to sending the metadata inline.
+        metadata = None
+        metadata_digest = None
+        metadata_size = None
         metadata_file = stoneridge.get_config('run', 'metadata')
         if os.path.exists(metadata_file):
-            with file(metadata_file, 'rb') as f:
-                contents = f.read()
-            metadata = base64.b64encode(contents)
+            try:
+                metadata_digest, metadata_size = \
+                    stoneridge.upload_blob(metadata_file)
+            except stoneridge.BlobStoreError:
+                logging.exception('Unable to upload metadata to blob store, '
+                                  'sending it inline')
+                with file(metadata_file, 'rb') as f:
+                    contents = f.read()
+                metadata = base64.b64encode(contents)
         else:
             # Missing metadata, but we can still report results
             logging.warning('missing metadata, continuing anyway')
@@ -51,6 +63,8 @@ class StoneRidgeUploader(object):
         ldap = stoneridge.get_config('run', 'ldap')
         operating_system = stoneridge.get_config('machine', 'os')
         self.queue.enqueue(srid=srid, results=results, metadata=metadata,
+                           metadata_digest=metadata_digest,
+                           metadata_size=metadata_size,
                            netconfig=netconfig,
                            operating_system=operating_system,
                            ldap=ldap)
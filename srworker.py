@@ -19,8 +19,11 @@ class StoneRidgeWorker(stoneridge.QueueListener):
         self.srconffile = stoneridge.get_config_file()
         self.unittest = stoneridge.get_config_bool('stoneridge', 'unittest')
         self.workroot = stoneridge.get_config('stoneridge', 'work')
+        isolate = stoneridge.get_config('worker', 'isolate', default='')
+        self.isolated = [s.strip() for s in isolate.split(',') if s.strip()]
         logging.debug('srconffile: %s' % (self.srconffile,))
         logging.debug('unittest: %s' % (self.unittest,))
+        logging.debug('isolated stages: %s' % (self.isolated,))
 
         self.runconfig = None  # Needs to be here so reset doesn't barf
         self.reset()
@@ -119,8 +122,10 @@ class StoneRidgeWorker(stoneridge.QueueListener):
                                   (stage, self.childlog))
 
     def run_process(self, stage, *args):
-        """Run a particular subprocess with the default arguments, as well as
-        any arguments requested by the caller
+        """Run a particular stage with the default arguments, as well as any
+        arguments requested by the caller. Stages run inside the worker unless
+        they are listed in worker.isolate, in which case they get their own
+        python process.
         """
         script = 'sr%s.py' % (stage,)
         logfile = os.path.join(self.logdir, '%02d_%s_%s.log' %
@@ -139,7 +144,11 @@ class StoneRidgeWorker(stoneridge.QueueListener):
             return
 
         try:
-            stoneridge.run_process(*command, logger=self.logger)
+            if stage in self.isolated:
+                stoneridge.run_process(*command, logger=self.logger)
+            else:
+                stoneridge.run_inprocess(*command, logger=self.logger,
+                                         logfile=logfile)
         except subprocess.CalledProcessError:
             # The process failed to run correctly, we need to say so
             self.childlog = logfile
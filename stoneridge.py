@@ -3,23 +3,42 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import collections
 import ConfigParser
 import copy
 import email
+import hashlib
+import httplib
+import importlib
 import inspect
 import json
 import logging
 import os
 import platform
+import Queue
 import requests
+import shutil
 import signal
 import smtplib
+import socket
+import sqlite3
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
 
 import pika
+import pika.exceptions
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
 
 # Quiet logging from pika so it doesn't mess with our local logs
@@ -230,6 +249,7 @@ _timeouts = {
     'firefox': None,
     'xpcshell': None
 }
+_sample_interval = None
 
 
 class TestProcessTimeout(Exception):
@@ -296,52 +316,271 @@ def _ensure_timeout(proctype):
         _timeouts[proctype] = get_config_int(proctype, 'timeout', 900)
 
 
-def _run_test_process(proctype, args, stdout):
+def _ensure_sample_interval():
+    """Make sure we know how often to check on (and sample the resource usage
+    of) the test process. We default to every 100 milliseconds.
+    """
+    global _sample_interval
+
+    if _sample_interval is None:
+        interval = get_config_int('sampler', 'interval', 100)
+        if interval <= 0:
+            interval = 100
+        _sample_interval = interval / 1000.0
+
+
+class ResourceSampler(object):
+    """Samples the resource usage (cpu time, rss, context switches and i/o) of
+    a process and all of its descendants. This reads from /proc, so it only
+    gathers data on linux. Everywhere else, sampling does nothing.
+
+    Descendants are found through /proc/<pid>/task/<tid>/children where the
+    kernel has it. Otherwise, finding them means reading the stat of every
+    process on the system, so we only do that every RESCAN_INTERVAL seconds
+    and sample the descendants we already know about in between.
+    """
+    RESCAN_INTERVAL = 5
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.enabled = os.path.exists('/proc/%s/stat' % (pid,))
+        self.has_children = os.path.exists('/proc/%s/task/%s/children' %
+                                           (pid, pid))
+        self.tree = None
+        self.scanned = None
+        self.start = time.time()
+        self.wall_time = None
+        self.samples = {'time': [], 'cpu_time': [], 'rss': [],
+                        'ctx_switches': [], 'read_bytes': [],
+                        'write_bytes': []}
+        if self.enabled:
+            self.ticks = float(os.sysconf('SC_CLK_TCK'))
+            self.pagesize = os.sysconf('SC_PAGE_SIZE')
+        logging.debug('resource sampling enabled for %s: %s' %
+                      (pid, self.enabled))
+
+    def _read_stat(self, pid):
+        """Return (ppid, cpu seconds, rss bytes) for <pid>. The cpu time
+        includes that of children that have already exited.
+        """
+        with file('/proc/%s/stat' % (pid,)) as f:
+            stat = f.read()
+        # The command name may contain spaces, so skip past it before splitting
+        fields = stat[stat.rindex(')') + 2:].split()
+        ticks = sum(int(t) for t in fields[11:15])
+        return (int(fields[1]), ticks / self.ticks,
+                int(fields[21]) * self.pagesize)
+
+    def _read_keyed(self, pid, name, keys):
+        """Return the sum of the values of <keys> in /proc/<pid>/<name>
+        """
+        total = 0
+        try:
+            with file('/proc/%s/%s' % (pid, name)) as f:
+                for line in f:
+                    k, _, v = line.partition(':')
+                    if k in keys:
+                        total += int(v.split()[0])
+        except (IOError, OSError, ValueError):
+            # Some of these (io in particular) may not be readable by us
+            pass
+        return total
+
+    def _children(self, pid):
+        """Return the pids of the children of <pid>, from the children files
+        of each of its threads
+        """
+        children = []
+        try:
+            tids = os.listdir('/proc/%s/task' % (pid,))
+        except OSError:
+            # Process went away while we were looking at it
+            return children
+        for tid in tids:
+            try:
+                with file('/proc/%s/task/%s/children' % (pid, tid)) as f:
+                    children.extend(int(c) for c in f.read().split())
+            except (IOError, OSError, ValueError):
+                continue
+        return children
+
+    def _tree(self):
+        """Return the pids of our process and all of its descendants
+        """
+        if self.has_children:
+            pids = [self.pid]
+            for pid in pids:
+                pids.extend(self._children(pid))
+            return pids
+
+        now = time.time()
+        if self.tree is None or now - self.scanned >= self.RESCAN_INTERVAL:
+            self.tree = self._scan_tree()
+            self.scanned = now
+        return self.tree
+
+    def _scan_tree(self):
+        """Return the pids of our process and all of its descendants, by
+        looking at the parent of every process in /proc
+        """
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                ppid = self._read_stat(entry)[0]
+            except (IOError, OSError, ValueError):
+                # Process went away while we were looking at it
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+
+        pids = [self.pid]
+        for pid in pids:
+            pids.extend(children.get(pid, []))
+        return pids
+
+    def sample(self):
+        """Take one sample of the resource usage of our process tree
+        """
+        if not self.enabled:
+            return
+
+        now = time.time() - self.start
+        cpu = rss = ctxsw = rbytes = wbytes = 0
+        for pid in self._tree():
+            try:
+                _, pcpu, prss = self._read_stat(pid)
+            except (IOError, OSError, ValueError):
+                continue
+            cpu += pcpu
+            rss += prss
+            ctxsw += self._read_keyed(pid, 'status',
+                                      ('voluntary_ctxt_switches',
+                                       'nonvoluntary_ctxt_switches'))
+            rbytes += self._read_keyed(pid, 'io', ('read_bytes',))
+            wbytes += self._read_keyed(pid, 'io', ('write_bytes',))
+
+        self.samples['time'].append(round(now, 3))
+        self.samples['cpu_time'].append(round(cpu, 3))
+        self.samples['rss'].append(rss)
+        self.samples['ctx_switches'].append(ctxsw)
+        self.samples['read_bytes'].append(rbytes)
+        self.samples['write_bytes'].append(wbytes)
+
+    def finish(self):
+        """Note that the process has exited
+        """
+        self.wall_time = round(time.time() - self.start, 3)
+
+    def save(self, filename):
+        """Write our samples out as json to <filename>
+        """
+        logging.debug('saving %s resource samples to %s' %
+                      (len(self.samples['time']), filename))
+        with file(filename, 'wb') as f:
+            json.dump({'wall_time': self.wall_time,
+                       'samples': self.samples}, f)
+
+
+def _run_test_process(proctype, args, stdout, samples=None):
     """Run a test process, either xpcshell or firefox.
 
     proctype - one of 'xpcshell' or 'firefox'
     args - list of arguments to be passed to the process
     stdout - where to shove the stdout data from the process
+    samples - optional file to save resource usage samples of the process in
     """
-    start = int(time.time())
+    start = time.time()
 
     procargs = [_binaries[proctype]] + args
 
     proc = Process(procargs, stdout=stdout, cwd=_bindir,
                    env=_test_process_environ)
+    sampler = ResourceSampler(proc.pid)
 
     timeout = _timeouts[proctype]
-    while (int(time.time()) - start) < timeout:
-        time.sleep(5)
+    try:
+        while (time.time() - start) < timeout:
+            sampler.sample()
+            time.sleep(_sample_interval)
 
-        if proc.poll() is not None:
-            return proc.returncode
+            if proc.poll() is not None:
+                sampler.finish()
+                return proc.returncode
 
-    # If we get here, that means we hit the timeout
-    proc.kill()
-    raise TestProcessTimeout(proctype, timeout, proc.stdout)
+        # If we get here, that means we hit the timeout
+        proc.kill()
+        sampler.finish()
+        raise TestProcessTimeout(proctype, timeout, proc.stdout)
+    finally:
+        if samples:
+            sampler.save(samples)
 
 
-def run_firefox(args, stdout):
+def run_firefox(args, stdout, samples=None):
     """Run firefox with the appropriate args
     """
     _ensure_bindir()
     _ensure_test_process_environ()
     _ensure_binary('firefox')
     _ensure_timeout('firefox')
+    _ensure_sample_interval()
 
-    return _run_test_process('firefox', args, stdout)
+    return _run_test_process('firefox', args, stdout, samples=samples)
 
 
-def run_xpcshell(args, stdout):
+def run_xpcshell(args, stdout, samples=None):
     """Run xpcshell with the appropriate args.
     """
     _ensure_bindir()
     _ensure_test_process_environ()
     _ensure_binary('xpcshell')
     _ensure_timeout('xpcshell')
+    _ensure_sample_interval()
+
+    return _run_test_process('xpcshell', args, stdout, samples=samples)
+
+
+def in_private(ip):
+    """Determine if an IP is in our private (172.16/12) network.
+    """
+    bits = map(int, ip.split('.'))
+    return (bits[0] == 172 and (16 <= bits[1] <= 31))
+
+
+def wait_for_dns(public, timeout=None, interval=None):
+    """Wait until the probe name (dns.probe) resolves to a public (if
+    <public> is True) or private address, checking every <interval> (default
+    dns.probe_interval) seconds for up to <timeout> (default
+    dns.probe_timeout) seconds. This is how we find out that a change of DNS
+    servers has actually taken effect.
+
+    Returns: (True if we got the answer we wanted, last address we got)
+    """
+    name = get_config('dns', 'probe', 'example.com')
+    if timeout is None:
+        timeout = float(get_config('dns', 'probe_timeout', 30))
+    if interval is None:
+        interval = float(get_config('dns', 'probe_interval', 0.25))
+    logging.debug('waiting up to %s seconds for %s address for %s' %
+                  (timeout, 'a public' if public else 'a private', name))
+
+    deadline = time.time() + timeout
+    ip = None
+    while True:
+        try:
+            ip = socket.gethostbyname(name)
+            logging.debug('%s => %s' % (name, ip))
+            if in_private(ip) != public:
+                return True, ip
+        except socket.error as e:
+            logging.debug('unable to resolve %s: %s' % (name, e))
 
-    return _run_test_process('xpcshell', args, stdout)
+        if time.time() + interval > deadline:
+            logging.error('%s still resolves to %s after %s seconds' %
+                          (name, ip, timeout))
+            return False, ip
+        time.sleep(interval)
 
 
 _os_version = None
@@ -366,6 +605,897 @@ def get_os_version():
     return _os_version
 
 
+class DownloadError(Exception):
+    """Exception type for when we can't download a file (or what we downloaded
+    doesn't match what we expected)
+    """
+    pass
+
+
+def parse_checksums(text, algorithm='sha512'):
+    """Parse the contents of a build's .checksums file, which has lines of the
+    form "<digest> <algorithm> <size> <filename>".
+
+    Returns: {filename: (digest, size)} for the lines using <algorithm>
+    """
+    checksums = {}
+    for line in text.splitlines():
+        parts = line.split(None, 3)
+        if len(parts) != 4 or parts[1] != algorithm:
+            continue
+        digest, _, size, filename = parts
+        checksums[filename] = (digest.lower(), int(size))
+    return checksums
+
+
+def _replace(src, dst):
+    """Atomically (where possible) rename <src> to <dst>, even if <dst> exists
+    """
+    if os.path.exists(dst) and platform.system() == 'Windows':
+        # Windows won't rename over an existing file
+        os.unlink(dst)
+    os.rename(src, dst)
+
+
+def download(url, outfile, digest=None, size=None, retries=3,
+             chunk_size=256 * 1024, timeout=300, progress=None,
+             algorithm='sha512'):
+    """Download the file at <url> to <outfile>, streaming it to disk
+    <chunk_size> bytes at a time instead of holding it all in memory. Data
+    goes to <outfile>.part until we have all of it, and if the transfer fails
+    partway through, we pick up where we left off (using an HTTP Range
+    request) up to <retries> times. If <digest> (a hex digest using the hash
+    named by <algorithm>) or <size> are given, the download is checked against
+    them before it's renamed into place. If given, <progress> is called with
+    the number of bytes we have so far and the total size (or None if we don't
+    know it) after every chunk.
+
+    Returns: the hex digest of the downloaded file
+    """
+    partfile = '%s.part' % (outfile,)
+    logging.debug('downloading %s => %s' % (url, outfile))
+
+    def hash_partfile():
+        h = hashlib.new(algorithm)
+        with file(partfile, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                h.update(chunk)
+        return h
+
+    for attempt in range(1, retries + 1):
+        have = 0
+        if os.path.exists(partfile):
+            have = os.path.getsize(partfile)
+
+        headers = {}
+        if have:
+            logging.debug('resuming %s at byte %s' % (url, have))
+            headers['Range'] = 'bytes=%s-' % (have,)
+
+        try:
+            r = requests.get(url, headers=headers, prefetch=False,
+                             timeout=timeout)
+            if r.status_code == 206:
+                mode = 'ab'
+                h = hash_partfile()
+            elif r.status_code == 200:
+                # Either a fresh download, or the server doesn't do ranges
+                mode = 'wb'
+                h = hashlib.new(algorithm)
+            elif r.status_code == 416 and have:
+                # We already have the whole thing
+                mode = None
+                h = hash_partfile()
+            else:
+                msg = 'Error downloading %s: %s' % (url, r.status_code)
+                logging.error(msg)
+                raise DownloadError(msg)
+
+            if mode is not None:
+                done = have if mode == 'ab' else 0
+                total = size
+                if total is None and r.headers.get('content-length'):
+                    total = done + int(r.headers['content-length'])
+                with file(partfile, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        h.update(chunk)
+                        done += len(chunk)
+                        if progress is not None:
+                            progress(done, total)
+                if total is not None and done < total:
+                    # The connection went away early, without an error. What
+                    # we have is fine, we just need the rest of it.
+                    raise httplib.IncompleteRead('', total - done)
+            break
+        except (requests.exceptions.RequestException, socket.error,
+                IOError, httplib.IncompleteRead):
+            logging.exception('Error downloading %s (attempt %s)' %
+                              (url, attempt))
+            if attempt == retries:
+                raise DownloadError('Unable to download %s after %s '
+                                    'attempts' % (url, attempt))
+
+    got_size = os.path.getsize(partfile)
+
+    if (size is not None and got_size != size) or \
+            (digest is not None and h.hexdigest() != digest.lower()):
+        # Don't resume from bad data next time
+        os.unlink(partfile)
+        msg = 'Checksum mismatch for %s (got %s bytes, %s %s)' % \
+              (url, got_size, algorithm, h.hexdigest())
+        logging.error(msg)
+        raise DownloadError(msg)
+
+    _replace(partfile, outfile)
+    logging.debug('downloaded %s bytes to %s' % (got_size, outfile))
+    return h.hexdigest()
+
+
+_blobstore_url = None
+
+
+def _get_blobstore_url():
+    global _blobstore_url
+
+    if _blobstore_url is None:
+        _blobstore_url = get_config('blobstore', 'url')
+        if _blobstore_url is None:
+            raise BlobStoreError('No blob store configured')
+
+    return _blobstore_url
+
+
+class BlobStoreError(Exception):
+    """Exception type for when we can't put a file into (or get a file out
+    of) the blob store on the master
+    """
+    pass
+
+
+def _blobstore_request(method, path, **kwargs):
+    """Make a request to the blob store, and return the data from its
+    response.
+    """
+    url = '%s/%s' % (_get_blobstore_url(), path)
+    try:
+        r = requests.request(method, url, timeout=300, **kwargs)
+    except requests.exceptions.RequestException as e:
+        raise BlobStoreError('Error talking to %s: %s' % (url, e))
+    if r.status_code != 200:
+        raise BlobStoreError('Non-200 response from %s: %s' %
+                             (url, r.status_code))
+    res = json.loads(r.text)
+    if res['status'] != 'ok':
+        raise BlobStoreError('Error from %s: %s' % (url, res['message']))
+    return res['data']
+
+
+def upload_blob(filename, chunk_size=1024 * 1024, retries=3):
+    """Put the file at <filename> into the blob store on the master, in
+    chunks of <chunk_size> bytes. If the upload fails partway through (or a
+    previous upload of the same file did), we pick up where the blob store
+    says we left off, up to <retries> times.
+
+    Returns: (sha256 hex digest, size) naming the blob
+    """
+    h = hashlib.sha256()
+    with file(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    size = os.path.getsize(filename)
+    logging.debug('uploading %s as blob %s (%s bytes)' %
+                  (filename, digest, size))
+
+    for attempt in range(1, retries + 1):
+        try:
+            status = _blobstore_request('GET', 'status/%s' % (digest,))
+            with file(filename, 'rb') as f:
+                f.seek(status['size'])
+                while not status['complete'] and status['size'] < size:
+                    chunk = f.read(chunk_size)
+                    status = _blobstore_request(
+                        'POST', 'upload/%s/%s' % (digest, status['size']),
+                        data=chunk)
+            if not status['complete']:
+                _blobstore_request('POST', 'finish/%s' % (digest,))
+            return (digest, size)
+        except BlobStoreError:
+            logging.exception('Error uploading blob %s (attempt %s)' %
+                              (digest, attempt))
+
+    raise BlobStoreError('Unable to upload %s after %s attempts' %
+                         (filename, retries))
+
+
+def fetch_blob(digest, size, outfile):
+    """Get the blob named <digest> out of the blob store on the master,
+    streaming it to <outfile>, and making sure it's what we expected.
+    """
+    url = '%s/blob/%s' % (_get_blobstore_url(), digest)
+    try:
+        download(url, outfile, digest=digest, size=size, algorithm='sha256')
+    except DownloadError as e:
+        raise BlobStoreError(str(e))
+
+
+def link_tree(src, dst):
+    """Make <dst> a copy of the file or directory tree at <src>, using hard
+    links wherever we can, and falling back to regular copies where we can't
+    (different filesystems, or no os.link on windows). Symlinks are copied as
+    symlinks.
+    """
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+    elif os.path.isdir(src):
+        os.mkdir(dst)
+        for name in os.listdir(src):
+            link_tree(os.path.join(src, name), os.path.join(dst, name))
+        shutil.copystat(src, dst)
+    else:
+        try:
+            os.link(src, dst)
+        except (AttributeError, OSError):
+            shutil.copy2(src, dst)
+            # A copy isn't shared with anyone, so it doesn't need to keep the
+            # build cache's read-only bits.
+            os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+
+
+def _make_read_only(path):
+    """Take away write permission from every regular file under <path>, so
+    anything that tries to modify one of them in place fails instead of
+    changing every other hard link to it.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            p = os.path.join(dirpath, name)
+            if os.path.islink(p):
+                continue
+            mode = os.stat(p).st_mode
+            os.chmod(p, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def _rmtree(path):
+    """shutil.rmtree, except it can also get rid of read-only files (which
+    windows won't delete otherwise)
+    """
+    def onerror(func, p, exc_info):
+        os.chmod(p, stat.S_IWRITE)
+        func(p)
+    shutil.rmtree(path, onerror=onerror)
+
+
+def _tree_usage(path):
+    """Find out how much space the files under <path> use. Files with more
+    than one hard link (like the builds we link out of the cloner's store or
+    the build cache) may be shared with other trees, so they're kept
+    separate, to be counted once no matter how many trees they're in.
+
+    Returns: (bytes in files with only one link,
+              {'<st_dev>:<st_ino>': bytes} for the files with more)
+    """
+    size = 0
+    shared = {}
+    paths = [path]
+    while paths:
+        p = paths.pop()
+        st = os.lstat(p)
+        if stat.S_ISDIR(st.st_mode):
+            paths.extend(os.path.join(p, name) for name in os.listdir(p))
+        elif st.st_nlink > 1 and not stat.S_ISLNK(st.st_mode):
+            shared['%s:%s' % (st.st_dev, st.st_ino)] = st.st_size
+        else:
+            size += st.st_size
+    return size, shared
+
+
+def _tree_size(path):
+    """Return the number of bytes used by the files under <path>, counting
+    each hard linked file once
+    """
+    size, shared = _tree_usage(path)
+    return size + sum(shared.values())
+
+
+def _file_digest(path):
+    """Return the hex sha256 of the contents of the file at <path>
+    """
+    h = hashlib.sha256()
+    with file(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BuildCache(object):
+    """A cache, on a test client, of the build packages we've downloaded and
+    the fully unpacked builds we've made from them, so that running the same
+    build under each netconfig only downloads and unpacks it once. Packages
+    are keyed by srid and platform, and unpacked builds by the content hash
+    of the packages they came from. Runs get hard links into the cache rather
+    than copies. Since a run and the cache share those files, everything in
+    the cache is made read-only, so a run that tries to change one of them in
+    place (instead of replacing it) fails loudly rather than quietly changing
+    the build for every later run. When the cache grows past its size budget,
+    the least recently used entries are thrown away.
+
+    The cache is disabled (and never has anything in it) unless cache.root is
+    configured.
+    """
+    def __init__(self):
+        self.root = get_config('cache', 'root')
+        self.budget = get_config_int('cache', 'size', 4096) * 1024 * 1024
+        self.enabled = self.root is not None
+        self.indexfile = None
+        if self.enabled:
+            self.indexfile = os.path.join(self.root, 'index.json')
+            if not os.path.exists(self.root):
+                os.makedirs(self.root)
+        logging.debug('cache root: %s' % (self.root,))
+        logging.debug('cache budget: %s' % (self.budget,))
+
+    def _load_index(self):
+        if not os.path.exists(self.indexfile):
+            return {}
+        with file(self.indexfile, 'rb') as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                logging.exception('Corrupt cache index, starting over')
+                return {}
+
+    def _save_index(self, index):
+        tmpfile = '%s.tmp' % (self.indexfile,)
+        with file(tmpfile, 'wb') as f:
+            json.dump(index, f)
+        _replace(tmpfile, self.indexfile)
+
+    def _entry_name(self, kind, key):
+        return '%s/%s' % (kind, key)
+
+    def _entry_path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def get(self, kind, key):
+        """Return the directory holding the cache entry <key> of type <kind>
+        ('packages' or 'trees'), or None if it's not in the cache.
+        """
+        if not self.enabled:
+            return None
+
+        index = self._load_index()
+        name = self._entry_name(kind, key)
+        path = self._entry_path(name)
+        if name not in index or not os.path.isdir(path):
+            logging.debug('cache miss for %s' % (name,))
+            return None
+
+        logging.debug('cache hit for %s' % (name,))
+        index[name]['atime'] = time.time()
+        self._save_index(index)
+        return path
+
+    def digest(self, kind, key):
+        """Return the content hash of the cache entry <key> of type <kind>, or
+        None if it's not in the cache.
+        """
+        if not self.enabled:
+            return None
+        entry = self._load_index().get(self._entry_name(kind, key))
+        if entry is None:
+            return None
+        return entry['digest']
+
+    def put(self, kind, key, paths):
+        """Add the files and directories in <paths> to the cache as entry
+        <key> of type <kind>.
+        """
+        if not self.enabled:
+            return
+
+        name = self._entry_name(kind, key)
+        path = self._entry_path(name)
+        index = self._load_index()
+        if name in index and os.path.isdir(path):
+            logging.debug('%s already cached' % (name,))
+            return
+
+        # Build the entry off to the side, so nobody can ever see a partial
+        # entry in the cache.
+        logging.debug('caching %s as %s' % (paths, name))
+        tmpdir = os.path.join(self.root, 'tmp-%s-%s' % (kind, key))
+        if os.path.exists(tmpdir):
+            _rmtree(tmpdir)
+        os.mkdir(tmpdir)
+        h = hashlib.sha256()
+        for p in sorted(paths):
+            dst = os.path.join(tmpdir, os.path.basename(p))
+            link_tree(p, dst)
+            if os.path.isfile(p):
+                h.update(_file_digest(p))
+        _make_read_only(tmpdir)
+        kinddir = os.path.dirname(path)
+        if not os.path.exists(kinddir):
+            os.mkdir(kinddir)
+        if os.path.exists(path):
+            _rmtree(path)
+        os.rename(tmpdir, path)
+
+        index[name] = {'size': _tree_size(path),
+                       'atime': time.time(),
+                       'digest': h.hexdigest()}
+        self._evict(index, name)
+        self._save_index(index)
+
+    def _evict(self, index, keep):
+        """Throw away the least recently used entries in <index> (other than
+        <keep>) until we're within our size budget.
+        """
+        total = sum(e['size'] for e in index.values())
+        logging.debug('cache size: %s' % (total,))
+        for name in sorted(index, key=lambda n: index[n]['atime']):
+            if total <= self.budget:
+                break
+            if name == keep:
+                continue
+            logging.debug('evicting %s from cache' % (name,))
+            path = self._entry_path(name)
+            if os.path.exists(path):
+                _rmtree(path)
+            total -= index[name]['size']
+            del index[name]
+
+
+def _free_space(path):
+    """How many bytes are free on the filesystem <path> is on, or None if we
+    can't tell on this platform.
+    """
+    if not hasattr(os, 'statvfs'):
+        return None
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+class _FileLock(object):
+    """An exclusive lock on the file <path> (created if need be), held
+    against every other process for as long as the with block runs.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def __enter__(self):
+        self.f = file(self.path, 'a+b')
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        else:
+            self.f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    # LK_LOCK gives up after 10 seconds, but we don't
+                    pass
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+            else:
+                self.f.seek(0)
+                msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.f.close()
+            self.f = None
+        return False
+
+
+def _entry_mtime(path):
+    """The newest mtime of <path> and, if it's a directory, of everything
+    directly in it (so a run writing into <path>/<netconfig> counts as
+    modifying <path>).
+    """
+    mtime = os.lstat(path).st_mtime
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in os.listdir(path):
+            try:
+                mtime = max(mtime, os.lstat(os.path.join(path, name)).st_mtime)
+            except OSError:
+                # Deleted since we listed it
+                pass
+    return mtime
+
+
+class Evictor(object):
+    """Keeps the entries (files or directories, like builds or test runs)
+    directly under <root> within a size budget of <budget> bytes, and makes
+    sure there are at least <min_free> bytes free on the disk, by throwing
+    away the entries that were modified longest ago. The newest entry is never
+    thrown away.
+
+    The size and mtime of each entry are kept in an index, so an entry only
+    has to be measured again when it's been modified since we last looked at
+    it. Files hard linked into more than one entry are only counted once, and
+    only count as freed when the last entry they're in is thrown away. The index is locked against other processes using the same root while
+    we're using it. Entries are thrown away by renaming them into a trash
+    directory, which a background thread empties, so nobody has to wait for
+    a big rmtree to finish.
+    """
+    def __init__(self, root, budget, min_free=0):
+        self.root = root
+        self.budget = budget
+        self.min_free = min_free
+        self.indexfile = os.path.join(self.root, '.evictor.json')
+        self.lockfile = os.path.join(self.root, '.evictor.lock')
+        self.trash = os.path.join(self.root, '.trash')
+        self.lock = threading.Lock()
+        self.emptier = None
+        if not os.path.exists(self.trash):
+            os.makedirs(self.trash)
+        logging.debug('evictor root: %s' % (self.root,))
+        logging.debug('evictor budget: %s' % (self.budget,))
+        logging.debug('evictor min free: %s' % (self.min_free,))
+
+    def _load_index(self):
+        if not os.path.exists(self.indexfile):
+            return {}
+        with file(self.indexfile, 'rb') as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                logging.exception('Corrupt evictor index, starting over')
+                return {}
+
+    def _save_index(self, index):
+        tmpfile = '%s.tmp' % (self.indexfile,)
+        with file(tmpfile, 'wb') as f:
+            json.dump(index, f)
+        _replace(tmpfile, self.indexfile)
+
+    def _scan(self, index):
+        """Bring <index> up to date with what's actually in our root.
+        Entries we've never seen before are measured, as are entries that
+        have been modified since we last measured them, and the newest entry
+        (which may still be getting written to). Anything else is the same
+        size it was last time.
+
+        Returns: names of the entries, oldest first
+        """
+        names = [n for n in os.listdir(self.root) if not n.startswith('.')]
+        for name in set(index) - set(names):
+            del index[name]
+
+        for name in names:
+            mtime = _entry_mtime(os.path.join(self.root, name))
+            entry = index.get(name)
+            if entry is None or mtime > entry.get('mtime', 0):
+                index[name] = {'mtime': mtime, 'final': False}
+
+        names.sort(key=lambda n: index[n]['mtime'])
+        for name in names:
+            entry = index[name]
+            if not entry['final']:
+                entry['size'], entry['shared'] = _tree_usage(
+                    os.path.join(self.root, name))
+                entry['final'] = name != names[-1]
+        return names
+
+    def evict(self):
+        """Throw away the entries modified longest ago until we're back
+        within our budget, and have enough free space.
+
+        Returns: names of the entries thrown away
+        """
+        with self.lock, _FileLock(self.lockfile):
+            index = self._load_index()
+            names = self._scan(index)
+            # How many entries each hard linked file is in
+            links = collections.defaultdict(int)
+            shared = {}
+            for n in names:
+                for key, size in index[n].get('shared', {}).items():
+                    links[key] += 1
+                    shared[key] = size
+            total = (sum(index[n]['size'] for n in names) +
+                     sum(shared.values()))
+            free = _free_space(self.root)
+            logging.debug('evictor: %s entries, %s bytes, %s free' %
+                          (len(names), total, free))
+
+            evicted = []
+            for name in names[:-1]:
+                short = free is not None and free < self.min_free
+                if total <= self.budget and not short:
+                    break
+
+                logging.debug('evicting %s' % (name,))
+                entry = index.pop(name)
+                size = entry['size']
+                for key in entry.get('shared', {}):
+                    links[key] -= 1
+                    if not links[key]:
+                        size += shared[key]
+                dst = os.path.join(self.trash,
+                                   '%s.%s' % (name, int(time.time() * 1000)))
+                os.rename(os.path.join(self.root, name), dst)
+                evicted.append(name)
+                total -= size
+                if free is not None:
+                    # Not quite free yet, but it will be soon
+                    free += size
+
+            self._save_index(index)
+
+        # Also try again on anything we couldn't delete last time
+        if evicted or os.listdir(self.trash):
+            self.empty_trash()
+        return evicted
+
+    def _empty_trash(self):
+        """Make one pass over the trash, deleting everything we can. Anything
+        we can't delete is logged and left for the next time the trash is
+        emptied.
+        """
+        for g in os.listdir(self.trash):
+            path = os.path.join(self.trash, g)
+            logging.debug('deleting %s' % (path,))
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    _rmtree(path)
+                else:
+                    os.unlink(path)
+            except (IOError, OSError):
+                if os.path.lexists(path):
+                    logging.exception('Unable to delete %s, leaving it in the '
+                                      'trash' % (path,))
+                # Otherwise another process's emptier got to it first
+
+    def empty_trash(self):
+        """Start emptying the trash in the background, if we aren't already
+        """
+        with self.lock:
+            if self.emptier is not None and self.emptier.is_alive():
+                return
+            self.emptier = threading.Thread(target=self._empty_trash)
+            self.emptier.daemon = True
+            self.emptier.start()
+
+    def wait(self):
+        """Wait for the trash to finish being emptied
+        """
+        emptier = self.emptier
+        if emptier is not None:
+            emptier.join()
+
+
+class ResultsStore(object):
+    """A local (sqlite) database of the results of every run the reporter has
+    seen, indexed so that the history of a metric on a particular os and
+    netconfig can be pulled out in one query instead of by opening the
+    results.json in every archive directory. Each value we get for a metric
+    is one row, attached to the row for the (srid, os, netconfig, suite) run
+    it came from.
+
+    The database lives wherever history.db says (by default, history.db in
+    the archives directory).
+    """
+    schema = (
+        '''CREATE TABLE IF NOT EXISTS runs (
+               id INTEGER PRIMARY KEY,
+               archive TEXT NOT NULL,
+               srid TEXT NOT NULL,
+               date INTEGER NOT NULL,
+               os TEXT NOT NULL,
+               netconfig TEXT NOT NULL,
+               suite TEXT NOT NULL,
+               ldap TEXT NOT NULL,
+               buildid TEXT,
+               revision TEXT,
+               UNIQUE (archive, suite))''',
+        '''CREATE TABLE IF NOT EXISTS results (
+               run INTEGER NOT NULL REFERENCES runs (id),
+               metric TEXT NOT NULL,
+               value REAL NOT NULL)''',
+        '''CREATE INDEX IF NOT EXISTS runs_series
+               ON runs (os, netconfig, suite, ldap, date)''',
+        '''CREATE INDEX IF NOT EXISTS runs_srid ON runs (srid)''',
+        '''CREATE INDEX IF NOT EXISTS results_run ON results (run, metric)''',
+        '''CREATE TABLE IF NOT EXISTS regressions (
+               os TEXT NOT NULL,
+               netconfig TEXT NOT NULL,
+               suite TEXT NOT NULL,
+               metric TEXT NOT NULL,
+               srid TEXT NOT NULL,
+               UNIQUE (os, netconfig, suite, metric, srid))''',
+    )
+
+    def __init__(self, path=None):
+        if path is None:
+            path = get_config('history', 'db')
+        if path is None:
+            path = os.path.join(get_config('stoneridge', 'archives'),
+                                'history.db')
+        self.path = path
+        logging.debug('results store: %s' % (self.path,))
+
+        # The reporter handles messages on multiple threads, so we share one
+        # connection between them, and take turns using it.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock:
+            # WAL lets people query the store while the reporter writes to it
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            for statement in self.schema:
+                self.conn.execute(statement)
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def ingest(self, archive, srid, netconfig, operating_system, results):
+        """Add the <results> ({name: dataset}, as sent by the uploader) of
+        the run saved in the archive directory named <archive> to the store.
+        Ingesting the same archive twice does nothing the second time.
+
+        Returns: the number of values added
+        """
+        added = 0
+        with self.lock:
+            cursor = self.conn.cursor()
+            for name, dataset in results.items():
+                if not isinstance(dataset, dict) or \
+                        'testrun' not in dataset:
+                    logging.warning('not storing bad dataset %s' % (name,))
+                    continue
+
+                testrun = dataset['testrun']
+                build = dataset.get('test_build', {})
+                ldap = testrun.get('options', {}).get('ldap', 'nightly')
+                cursor.execute('''INSERT OR IGNORE INTO runs
+                                  (archive, srid, date, os, netconfig, suite,
+                                   ldap, buildid, revision)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                               (archive, srid, testrun['date'],
+                                operating_system, netconfig, testrun['suite'],
+                                ldap, build.get('original_buildid'),
+                                build.get('revision')))
+                if not cursor.rowcount:
+                    logging.debug('%s of %s already stored' %
+                                  (testrun['suite'], archive))
+                    continue
+
+                run = cursor.lastrowid
+                rows = [(run, metric, value)
+                        for metric, values in dataset['results'].items()
+                        for value in values]
+                cursor.executemany('''INSERT INTO results (run, metric, value)
+                                      VALUES (?, ?, ?)''', rows)
+                added += len(rows)
+            self.conn.commit()
+
+        logging.debug('stored %s values from %s' % (added, archive))
+        return added
+
+    def nearest(self, operating_system, netconfig, date, ldap='nightly'):
+        """Find the run by <ldap> on <operating_system> and <netconfig>
+        that's closest in time to <date>.
+
+        Returns: the srid of that run, or None if there isn't one
+        """
+        with self.lock:
+            row = self.conn.execute('''SELECT srid FROM runs
+                                       WHERE os = ? AND netconfig = ?
+                                         AND ldap = ?
+                                       ORDER BY ABS(date - ?) LIMIT 1''',
+                                    (operating_system, netconfig, ldap,
+                                     date)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def series(self, operating_system, netconfig, suite=None, metric=None,
+               ldap='nightly', since=None, until=None, limit=None,
+               srid=None):
+        """Get the history of every metric matching the arguments (None
+        matches anything) on <operating_system> and <netconfig>, oldest run
+        first. If <limit> is given, only the most recent <limit> runs of each
+        suite are included.
+
+        Returns: {(suite, metric): [(date, srid, [values])]}
+        """
+        where = ['runs.os = ?', 'runs.netconfig = ?']
+        params = [operating_system, netconfig]
+        for column, value in (('runs.suite', suite), ('runs.ldap', ldap),
+                              ('runs.srid', srid)):
+            if value is not None:
+                where.append('%s = ?' % (column,))
+                params.append(value)
+        if since is not None:
+            where.append('runs.date >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('runs.date <= ?')
+            params.append(until)
+
+        with self.lock:
+            if limit is not None:
+                # Find the most recent <limit> runs of each suite up front, so
+                # the big query only has to look at those
+                query = '''SELECT runs.id, runs.suite FROM runs WHERE %s
+                           ORDER BY runs.date DESC''' % (' AND '.join(where),)
+                counts = collections.defaultdict(int)
+                ids = []
+                for run, run_suite in self.conn.execute(query, params):
+                    if counts[run_suite] < limit:
+                        counts[run_suite] += 1
+                        ids.append(run)
+                if not ids:
+                    return {}
+                where.append('runs.id IN (%s)' %
+                             (','.join(str(i) for i in ids),))
+
+            if metric is not None:
+                where.append('results.metric = ?')
+                params.append(metric)
+
+            query = '''SELECT runs.suite, results.metric, runs.date,
+                              runs.srid, runs.id, results.value
+                       FROM runs JOIN results ON results.run = runs.id
+                       WHERE %s
+                       ORDER BY runs.suite, results.metric, runs.date, runs.id
+                    ''' % (' AND '.join(where),)
+
+            series = collections.defaultdict(list)
+            last = None
+            for run_suite, run_metric, date, srid, run, value in \
+                    self.conn.execute(query, params):
+                key = (run_suite, run_metric)
+                points = series[key]
+                if last != (key, run):
+                    points.append((date, srid, []))
+                    last = (key, run)
+                points[-1][2].append(value)
+
+        return dict(series)
+
+    def regressions(self, operating_system, netconfig):
+        """Get the regressions that have already been reported on
+        <operating_system> and <netconfig>.
+
+        Returns: {(suite, metric): set([srid the regression started with])}
+        """
+        reported = collections.defaultdict(set)
+        with self.lock:
+            for suite, metric, srid in self.conn.execute(
+                    '''SELECT suite, metric, srid FROM regressions
+                       WHERE os = ? AND netconfig = ?''',
+                    (operating_system, netconfig)):
+                reported[(suite, metric)].add(srid)
+        return dict(reported)
+
+    def add_regression(self, operating_system, netconfig, suite, metric,
+                       srid):
+        """Remember that a regression in <suite>/<metric> on
+        <operating_system> and <netconfig>, starting with <srid>, has been
+        reported.
+
+        Returns: False if it had already been reported, True otherwise
+        """
+        with self.lock:
+            cursor = self.conn.execute(
+                '''INSERT OR IGNORE INTO regressions
+                   (os, netconfig, suite, metric, srid)
+                   VALUES (?, ?, ?, ?, ?)''',
+                (operating_system, netconfig, suite, metric, srid))
+            self.conn.commit()
+        return cursor.rowcount == 1
+
+
 _netconfig_ids = {
     'broadband': '0',
     'umts': '1',
@@ -425,6 +1555,100 @@ def run_process(procname, *args, **kwargs):
         raise  # Do this in case caller has any special handling
 
 
+# Module-level caches that are derived from the config files in use, and so
+# must be reset whenever we switch to a different set of config files.
+_config_globals = ('_cp', '_srconf', '_runconf', '_bindir',
+                   '_test_process_environ', '_sample_interval', '_os_version',
+                   '_buildid_suffix', '_root', '_mailurl', '_blobstore_url')
+
+
+class config_scope(object):
+    """A context manager that gives the code run inside the context a fresh
+    view of the stone ridge configuration (and everything we cache based on
+    it), and then restores our original view when we exit the context
+    """
+    def __enter__(self):
+        g = globals()
+        self.saved = dict((name, g[name]) for name in _config_globals)
+        self.saved_binaries = dict(_binaries)
+        self.saved_timeouts = dict(_timeouts)
+        logging.debug('entering new config scope')
+        for name in _config_globals:
+            g[name] = None
+        for proctype in _binaries:
+            _binaries[proctype] = None
+            _timeouts[proctype] = None
+
+    def __exit__(self, *args):
+        logging.debug('restoring previous config scope')
+        globals().update(self.saved)
+        _binaries.update(self.saved_binaries)
+        _timeouts.update(self.saved_timeouts)
+
+
+class log_scope(object):
+    """A context manager that sends everything logged (or printed) by the code
+    run inside the context to its own log file, just like running that code as
+    its own process with --log would.
+    """
+    def __init__(self, logfile):
+        self.logfile = logfile
+
+    def __enter__(self):
+        self.logger = logging.getLogger()
+        self.oldlevel = self.logger.level
+        self.oldstreams = (sys.stdout, sys.stderr)
+
+        self.handler = logging.FileHandler(self.logfile)
+        self.handler.setFormatter(logging.Formatter(fmt=LOG_FMT))
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.DEBUG)
+        sys.stdout = sys.stderr = StreamLogger(self.logger)
+
+    def __exit__(self, *args):
+        sys.stdout, sys.stderr = self.oldstreams
+        self.logger.setLevel(self.oldlevel)
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+
+def run_inprocess(procname, *args, **kwargs):
+    """Like run_process, but runs the main function of a stone ridge program
+    inside this process instead of starting a new python interpreter for it.
+    The program gets its own config scope, working directory and log file
+    (given by the logfile keyword argument). Failures are reported by raising
+    subprocess.CalledProcessError, just like run_process does.
+    """
+    logger = kwargs.get('logger', logging)
+    logfile = kwargs['logfile']
+    argv = [procname] + map(str, args)
+    logger.debug('Running %s in-process' % (procname,))
+    logger.debug(' '.join(argv))
+
+    module = importlib.import_module(os.path.splitext(procname)[0])
+
+    returncode = 0
+    oldargv = sys.argv
+    sys.argv = argv
+    try:
+        with log_scope(logfile), config_scope(), cwd(os.getcwd()):
+            try:
+                module.main()
+            except SystemExit as e:
+                if e.code:
+                    returncode = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                logging.exception('EXCEPTION')
+                returncode = 1
+    finally:
+        sys.argv = oldargv
+
+    if returncode:
+        logger.error('FAILED: %s (%s)' % (procname, returncode))
+        raise subprocess.CalledProcessError(returncode, argv)
+    logger.debug('SUCCEEDED: %s' % (procname,))
+
+
 class ArgumentParser(argparse.ArgumentParser):
     """An argument parser for stone ridge programs that handles the arguments
     required by all of them.
@@ -605,16 +1829,60 @@ class TestRunArgumentParser(ArgumentParser):
         return args
 
 
+class QueueListenerDisconnect(Exception):
+    """Exception type for when the channel a QueueListener is consuming from
+    gets closed out from under it
+    """
+    pass
+
+
 class QueueListener(object):
     """A class to be used as the base for stone ridge daemons that need to
     respond to entries on a queue.
+
+    By default, messages are handled one at a time. Subclasses whose handlers
+    are safe to run concurrently can set concurrent = True, in which case
+    up to listener.concurrency messages are handled at once by a pool of
+    threads. A message the pool fails to handle is requeued once; if it fails
+    again, it is saved in listener.failed (and logged) instead of being
+    retried forever.
     """
+    concurrent = False
+
+    # Bounds (in seconds) on how long to wait between attempts to reconnect
+    min_backoff = 1
+    max_backoff = 300
+
     def __init__(self, queue, **kwargs):
         self._host = get_config('stoneridge', 'mqhost')
         self._queue = queue
         self._params = pika.ConnectionParameters(host=self._host)
         self._args = kwargs
         self._connection = None
+        self._channel = None
+        # Bumped every time we lose our connection, so the pool can tell which
+        # messages came from a channel that's gone
+        self._generation = 0
+
+        self._concurrency = 1
+        if self.concurrent:
+            self._concurrency = max(1, get_config_int('listener',
+                                                      'concurrency', 1))
+        self._prefetch = get_config_int('listener', 'prefetch',
+                                        self._concurrency)
+        self._prefetch = max(self._prefetch, self._concurrency)
+        self._work = None
+        self._finished = None
+        if self._concurrency > 1:
+            self._work = Queue.Queue()
+            self._finished = Queue.Queue()
+            for i in range(self._concurrency):
+                t = threading.Thread(target=self._pool_worker)
+                t.daemon = True
+                t.start()
+        logging.debug('%s: concurrency %s, prefetch %s' %
+                      (queue, self._concurrency, self._prefetch))
+
         self.setup(**kwargs)
 
     def setup(self, **kwargs):
@@ -631,37 +1899,225 @@ class QueueListener(object):
 
     def _handle(self, channel, method, properties, body):
         """Internal callback for when a message is received. Deserializes the
-        message and calls handle. Once handle succeeds, the message is
-        acknowledged.
+        message and calls handle (or hands it off to the pool to do so). Once
+        handle succeeds, the message is acknowledged.
         """
         msg = json.loads(body)
+        if self._work is not None:
+            self._work.put((self._generation, method.delivery_tag, msg,
+                            method.redelivered))
+            return
+
         self.handle(**msg)
         channel.basic_ack(delivery_tag=method.delivery_tag)
 
+    def _pool_worker(self):
+        """Main loop for the threads in our pool. A message that fails to be
+        handled is requeued the first time. If it has already been redelivered,
+        it is saved and rejected instead, so one bad message can't keep the
+        pool busy forever. Messages that were still waiting for the pool when
+        their channel went away are dropped, since the server redelivers them
+        on our new channel.
+        """
+        while True:
+            generation, tag, msg, redelivered = self._work.get()
+            if generation != self._generation:
+                logging.debug('Dropping message from old channel: %s' %
+                              (msg,))
+                continue
+            try:
+                self.handle(**msg)
+                action = 'ack'
+            except:
+                logging.exception('Error handling message %s' % (msg,))
+                action = 'requeue'
+                if redelivered:
+                    self._save_failed(msg)
+                    action = 'reject'
+            self._finished.put((generation, tag, action))
+
+    def _save_failed(self, msg):
+        """Keep a copy of a message we've given up on in the failed messages
+        directory, so it can be looked at (and resubmitted) by hand.
+        """
+        faileddir = get_config('listener', 'failed')
+        if faileddir is None:
+            faileddir = os.path.join(get_config('stoneridge', 'logs'),
+                                     'failed')
+        try:
+            if not os.path.exists(faileddir):
+                os.makedirs(faileddir)
+            fd, fname = tempfile.mkstemp(prefix='%s_' % (self._queue,),
+                                         suffix='.json', dir=faileddir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(msg, f)
+            logging.error('Gave up on message, saved in %s: %s' %
+                          (fname, msg))
+        except:
+            logging.exception('Unable to save failed message: %s' % (msg,))
+
+    def _flush_finished(self):
+        """Acknowledge (or reject) messages the pool is done with. This runs
+        on the connection's thread, since pika connections are not safe to
+        use from multiple threads.
+        """
+        while True:
+            try:
+                generation, tag, action = self._finished.get_nowait()
+            except Queue.Empty:
+                break
+            if generation != self._generation:
+                # Channel went away since we got this message, so the server
+                # will redeliver it, and there's nothing to acknowledge
+                continue
+            if action == 'ack':
+                self._channel.basic_ack(delivery_tag=tag)
+            else:
+                self._channel.basic_reject(delivery_tag=tag,
+                                           requeue=(action == 'requeue'))
+
+        self._connection.add_timeout(0.1, self._flush_finished)
+
     def _handle_onclose(self, method_frame):
-        """Handle the case when our connection drops out from under us, for
-        whatever reason, by re-connecting (and trying to do so indefinitely).
+        """Handle the case when our channel closes out from under us, for
+        whatever reason, by bailing out to the reconnect loop in run.
         """
         logging.debug('Got close on channel, retrying')
-        self._connection.close()
+        raise QueueListenerDisconnect('Channel for %s closed' % (self._queue,))
+
+    def _disconnect(self):
+        self._generation += 1
+        self._channel = None
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except:
+                # We're throwing this connection away anyway
+                logging.exception('Error closing listener connection')
         self._connection = None
-        self.run()
+
+    def _consume(self):
+        """Connect to the queue server and handle messages until something
+        goes wrong with the connection.
+        """
+        self._connection = pika.BlockingConnection(self._params)
+        self._channel = self._connection.channel()
+        self._channel.add_on_close_callback(self._handle_onclose)
+
+        self._channel.basic_qos(prefetch_count=self._prefetch)
+        self._channel.basic_consume(self._handle, queue=self._queue)
+        if self._finished is not None:
+            self._connection.add_timeout(0.1, self._flush_finished)
+
+        # We made it this far, so the next time we need to reconnect we can
+        # start with a short wait again.
+        self._backoff = self.min_backoff
+
+        self._channel.start_consuming()
 
     def run(self):
-        """Main event loop for a queue listener.
+        """Main event loop for a queue listener. If our connection to the
+        queue server fails, we reconnect (indefinitely), waiting exponentially
+        longer between attempts.
         """
         logging.debug('Running queue listener for %s' % (self._queue,))
         if self._queue is None:
             raise Exception('You must set queue for %s' % (type(self),))
 
+        self._backoff = self.min_backoff
+        while True:
+            try:
+                self._consume()
+            except (pika.exceptions.AMQPError, socket.error,
+                    QueueListenerDisconnect):
+                logging.exception('Lost connection for %s' % (self._queue,))
+            self._disconnect()
+
+            logging.debug('Reconnecting in %s seconds' % (self._backoff,))
+            time.sleep(self._backoff)
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+
+
+class QueuePublishError(Exception):
+    """Exception type for when we can't get a message onto a queue
+    """
+    pass
+
+
+class QueuePublisher(object):
+    """A long-lived connection to the queue server that is shared by all the
+    QueueWriters in a process. Publisher confirms are enabled on the channel,
+    so once publish returns, the server has taken responsibility for the
+    messages. If the connection drops, we reconnect and carry on from the
+    first unconfirmed message.
+    """
+    def __init__(self, host, retries=3):
+        self._params = pika.ConnectionParameters(host=host)
+        self._retries = retries
+        self._connection = None
+        self._channel = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        logging.debug('connecting publisher to %s' % (self._params.host,))
         self._connection = pika.BlockingConnection(self._params)
-        channel = self._connection.channel()
-        channel.add_on_close_callback(self._handle_onclose)
+        self._channel = self._connection.channel()
+        self._channel.confirm_delivery()
 
-        channel.basic_qos(prefetch_count=1)
-        channel.basic_consume(self._handle, queue=self._queue)
+    def _disconnect(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except:
+                # We're throwing this connection away anyway
+                logging.exception('Error closing publisher connection')
+        self._connection = None
+        self._channel = None
 
-        channel.start_consuming()
+    def publish(self, queue, bodies):
+        """Publish each of the (already serialized) <bodies> as a durable
+        message on <queue>, in order.
+        """
+        properties = pika.BasicProperties(delivery_mode=2)  # Durable
+        sent = 0
+        attempt = 0
+        with self._lock:
+            while sent < len(bodies):
+                try:
+                    if self._channel is None:
+                        self._connect()
+                    while sent < len(bodies):
+                        if not self._channel.basic_publish(
+                                exchange='', routing_key=queue,
+                                body=bodies[sent], properties=properties):
+                            raise QueuePublishError('Message to %s was not '
+                                                    'confirmed' % (queue,))
+                        sent += 1
+                except (pika.exceptions.AMQPError, socket.error,
+                        QueuePublishError):
+                    attempt += 1
+                    logging.exception('Error publishing to %s (attempt %s)' %
+                                      (queue, attempt))
+                    self._disconnect()
+                    if attempt >= self._retries:
+                        raise QueuePublishError('Unable to publish to %s '
+                                                'after %s attempts' %
+                                                (queue, attempt))
+        logging.debug('published %s messages to %s' % (sent, queue))
+
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(host):
+    """Get the shared QueuePublisher for the queue server on <host>, creating
+    it if need be.
+    """
+    with _publishers_lock:
+        if host not in _publishers:
+            _publishers[host] = QueuePublisher(host)
+        return _publishers[host]
 
 
 class QueueWriter(object):
@@ -669,21 +2125,21 @@ class QueueWriter(object):
     """
     def __init__(self, queue):
         self._host = get_config('stoneridge', 'mqhost')
-        self._params = pika.ConnectionParameters(host=self._host)
         self._queue = queue
 
     def enqueue(self, **msg):
         """Place a message on the queue. The message is serialized as a JSON
         string before being placed on the queue.
         """
-        connection = pika.BlockingConnection(self._params)
-        channel = connection.channel()
+        self.enqueue_many([msg])
 
-        body = json.dumps(msg)
-        properties = pika.BasicProperties(delivery_mode=2)  # Durable
-        channel.basic_publish(exchange='', routing_key=self._queue, body=body,
-                              properties=properties)
-        connection.close()  # Ensures the message is sent
+    def enqueue_many(self, msgs):
+        """Place a list of messages (dicts) on the queue in one go. Each
+        message is serialized as a JSON string before being placed on the
+        queue.
+        """
+        bodies = [json.dumps(msg) for msg in msgs]
+        get_publisher(self._host).publish(self._queue, bodies)
 
 
 def enqueue(nightly=True, ldap='', sha='', netconfigs=None,
@@ -728,6 +2184,8 @@ def sendmail(to, subject, message, *attachments):
     attachments - optional (path, name) tuples, where <path> is the path to
                   the file to be attached on disk, and <name> is the name to
                   be used as the attachment's name in the email.
+
+    Returns: True if the email was sent, False if it couldn't be
     """
     msg = email.MIMEMultipart.MIMEMultipart()
     msg['from'] = 'stoneridge@noreply.mozilla.com'
@@ -756,6 +2214,8 @@ def sendmail(to, subject, message, *attachments):
         smtp.close()
     except:
         logging.exception('Error sending email to %s' % (to,))
+        return False
+    return True
 
 
 _mailurl = None
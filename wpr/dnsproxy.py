@@ -16,9 +16,11 @@
 import daemonserver
 import errno
 import logging
+import select
 import socket
 import SocketServer
 import threading
+import time
 
 import third_party
 import dns.flags
@@ -124,6 +126,81 @@ class PrivateIpDnsLookup(object):
     self.archive_hosts = set('%s.' % req.host for req in self.http_archive)
 
 
+def _Domain(wire_domain):
+  domain = ''
+  index = 0
+  length = ord(wire_domain[index])
+  while length:
+    domain += wire_domain[index + 1:index + length + 1] + '.'
+    index += length + 1
+    length = ord(wire_domain[index])
+  return domain
+
+
+def _DnsResponse(data, wire_domain, ip):
+  return (
+      data[0] +           # transaction id
+      data[1] +
+      '\x81\x80' +        # standard query response, no error
+      data[4:6] * 2 + '\x00\x00\x00\x00' +  # Q&A counts
+      wire_domain +
+      '\xc0\x0c'          # pointer to domain name
+      '\x00\x01'          # resource record type ("A" host address)
+      '\x00\x01'          # class of the data
+      '\x00\x00\x00\x3c'  # ttl (seconds)
+      '\x00\x04' +        # resource data length (4 bytes for ip)
+      socket.inet_aton(ip)
+      )
+
+
+def _DnsNoSuchNameResponse(data):
+  query_message = dns.message.from_wire(data)
+  response_message = dns.message.make_response(query_message)
+  response_message.flags |= dns.flags.AA | dns.flags.RA
+  response_message.set_rcode(dns.rcode.NXDOMAIN)
+  return response_message.to_wire()
+
+
+STANDARD_QUERY_OPERATION_CODE = 0
+
+
+def MakeDnsResponse(data, dns_lookup, server_ip):
+  """Build the response to a DNS query.
+
+  IPv6 requests (with rdtype AAAA) receive mismatched IPv4 responses
+  (with rdtype A). To properly support IPv6, the http proxy would
+  need both types of addresses. By default, Windows XP does not
+  support IPv6.
+
+  Args:
+    data: the DNS query packet.
+    dns_lookup: a function that resolves a host to an IP address.
+    server_ip: the IP address of the web proxy (only used for logging).
+  Returns:
+    the DNS response packet.
+  """
+  domain = ''
+  wire_domain = ''
+  operation_code = (ord(data[2]) >> 3) & 15
+  if operation_code == STANDARD_QUERY_OPERATION_CODE:
+    wire_domain = data[12:]
+    domain = _Domain(wire_domain)
+  else:
+    logging.debug("DNS request with non-zero operation code: %s",
+                  operation_code)
+  ip = dns_lookup(domain)
+  if ip is None:
+    logging.debug('dnsproxy: %s -> NXDOMAIN', domain)
+    return _DnsNoSuchNameResponse(data)
+  if ip == server_ip:
+    logging.debug('dnsproxy: %s -> %s (replay web proxy)', domain, ip)
+  else:
+    logging.debug('dnsproxy: %s -> %s', domain, ip)
+  if not domain:
+    return ''
+  return _DnsResponse(data, wire_domain, ip)
+
+
 class UdpDnsHandler(SocketServer.DatagramRequestHandler):
   """Resolve DNS queries to localhost.
 
@@ -131,75 +208,27 @@ class UdpDnsHandler(SocketServer.DatagramRequestHandler):
   http://howl.play-bow.org/pipermail/dnspython-users/2010-February/000119.html
   """
 
-  STANDARD_QUERY_OPERATION_CODE = 0
-
   def handle(self):
-    """Handle a DNS query.
-
-    IPv6 requests (with rdtype AAAA) receive mismatched IPv4 responses
-    (with rdtype A). To properly support IPv6, the http proxy would
-    need both types of addresses. By default, Windows XP does not
-    support IPv6.
-    """
+    """Handle a DNS query."""
     self.data = self.rfile.read()
-    self.transaction_id = self.data[0]
-    self.flags = self.data[1]
-    self.qa_counts = self.data[4:6]
-    self.domain = ''
-    operation_code = (ord(self.data[2]) >> 3) & 15
-    if operation_code == self.STANDARD_QUERY_OPERATION_CODE:
-      self.wire_domain = self.data[12:]
-      self.domain = self._domain(self.wire_domain)
-    else:
-      logging.debug("DNS request with non-zero operation code: %s",
-                    operation_code)
-    ip = self.server.dns_lookup(self.domain)
-    if ip is None:
-      logging.debug('dnsproxy: %s -> NXDOMAIN', self.domain)
-      response = self.get_dns_no_such_name_response()
-    else:
-      if ip == self.server.server_address[0]:
-        logging.debug('dnsproxy: %s -> %s (replay web proxy)', self.domain, ip)
-      else:
-        logging.debug('dnsproxy: %s -> %s', self.domain, ip)
-      response = self.get_dns_response(ip)
-    self.wfile.write(response)
-
-  @classmethod
-  def _domain(cls, wire_domain):
-    domain = ''
-    index = 0
-    length = ord(wire_domain[index])
-    while length:
-      domain += wire_domain[index + 1:index + length + 1] + '.'
-      index += length + 1
-      length = ord(wire_domain[index])
-    return domain
-
-  def get_dns_response(self, ip):
-    packet = ''
-    if self.domain:
-      packet = (
-          self.transaction_id +
-          self.flags +
-          '\x81\x80' +        # standard query response, no error
-          self.qa_counts * 2 + '\x00\x00\x00\x00' +  # Q&A counts
-          self.wire_domain +
-          '\xc0\x0c'          # pointer to domain name
-          '\x00\x01'          # resource record type ("A" host address)
-          '\x00\x01'          # class of the data
-          '\x00\x00\x00\x3c'  # ttl (seconds)
-          '\x00\x04' +        # resource data length (4 bytes for ip)
-          socket.inet_aton(ip)
-          )
-    return packet
-
-  def get_dns_no_such_name_response(self):
-    query_message = dns.message.from_wire(self.data)
-    response_message = dns.message.make_response(query_message)
-    response_message.flags |= dns.flags.AA | dns.flags.RA
-    response_message.set_rcode(dns.rcode.NXDOMAIN)
-    return response_message.to_wire()
+    self.wfile.write(MakeDnsResponse(self.data, self.server.dns_lookup,
+                                     self.server.server_address[0]))
+
+
+def _BindUdpSocket(host, port):
+  """Returns a UDP socket bound to (host, port), raising DnsProxyException if
+  we are not allowed to bind it."""
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    sock.bind((host, port))
+  except socket.error, (error_number, msg):
+    sock.close()
+    if error_number == errno.EACCES:
+      raise DnsProxyException(
+          'Unable to bind DNS server on (%s:%s)' % (host, port))
+    raise
+  return sock
+
 
 class DnsProxyServer(SocketServer.ThreadingUDPServer,
                      daemonserver.DaemonServer):
@@ -226,3 +255,150 @@ class DnsProxyServer(SocketServer.ThreadingUDPServer,
   def cleanup(self):
     self.shutdown()
     logging.info('Shutdown DNS server')
+
+
+class TtlDnsLookup(object):
+  """Remember the answers of another dns lookup function for a while.
+
+  Failed lookups (None) are remembered for a shorter time than successful
+  ones, so a host that comes back is not treated as missing for long.
+  """
+  def __init__(self, dns_lookup, ttl=60, negative_ttl=5, timer=time.time):
+    """Initialize TtlDnsLookup.
+
+    Args:
+      dns_lookup: a function that resolves a host to an IP (or None).
+      ttl: how many seconds to remember an IP for.
+      negative_ttl: how many seconds to remember a failed lookup for.
+      timer: a function returning the current time in seconds.
+    """
+    self.dns_lookup = dns_lookup
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.timer = timer
+    self.lock = threading.Lock()
+    self.cache = {}
+
+  def __call__(self, host):
+    now = self.timer()
+    with self.lock:
+      entry = self.cache.get(host)
+    if entry and entry[0] > now:
+      return entry[1]
+    ip = self.dns_lookup(host)
+    expires = now + (self.ttl if ip else self.negative_ttl)
+    with self.lock:
+      self.cache[host] = (expires, ip)
+    return ip
+
+  def ClearCache(self):
+    """Forget everything we have looked up."""
+    with self.lock:
+      self.cache.clear()
+
+
+class AsyncDnsProxyServer(daemonserver.DaemonServer):
+  """A single-threaded DNS proxy, serving every query from one event loop.
+
+  Unlike DnsProxyServer, no thread is started per query. Rendered responses
+  are cached by everything in the query except its transaction id, so a
+  repeated question costs a dict lookup and a string concatenation. Cached
+  responses are kept for as long as the TTL we put in them. Errors (like
+  NXDOMAIN) are never cached here, so how long a failed lookup is remembered
+  is up to dns_lookup (see TtlDnsLookup's negative_ttl).
+
+  dns_lookup is called from the event loop, so it should be quick (or
+  wrapped in a TtlDnsLookup if it goes to the network).
+  """
+
+  ANSWER_TTL = 60  # seconds, the same as the ttl in our responses
+  MAX_CACHED_ANSWERS = 10000
+  POLL_TIMEOUT = 0.5  # seconds between checks for shutdown
+
+  def __init__(self, dns_lookup=None, host='', port=53, timer=time.time):
+    """Initialize AsyncDnsProxyServer.
+
+    Args:
+      dns_lookup: a function that resolves a host to an IP address.
+      host: a host string (name or IP) to bind the dns proxy and to which
+        DNS requests will be resolved.
+      port: an integer port on which to bind the proxy.
+      timer: a function returning the current time in seconds.
+    """
+    self.socket = _BindUdpSocket(host, port)
+    self.socket.setblocking(0)
+    self.server_address = self.socket.getsockname()
+    self.dns_lookup = dns_lookup or (lambda host: self.server_address[0])
+    self.timer = timer
+    self.answer_cache = {}
+    self.is_running = False
+    self.stopped = threading.Event()
+    logging.info('Started DNS server on %s...', self.server_address)
+
+  def HandleQuery(self, data):
+    """Returns the response to the DNS query packet data."""
+    key = data[2:]
+    now = self.timer()
+    entry = self.answer_cache.get(key)
+    if entry and entry[0] > now:
+      return data[:2] + entry[1]
+    response = MakeDnsResponse(data, self.dns_lookup, self.server_address[0])
+    if response and not ord(response[3]) & 0x0f:  # rcode: no error
+      if len(self.answer_cache) >= self.MAX_CACHED_ANSWERS:
+        self.answer_cache.clear()
+      self.answer_cache[key] = (now + self.ANSWER_TTL, response[2:])
+    return response
+
+  def ClearCache(self):
+    """Forget all the rendered responses."""
+    self.answer_cache.clear()
+
+  def _HandleReadable(self):
+    """Answer every query waiting on the socket."""
+    while True:
+      try:
+        data, address = self.socket.recvfrom(512)
+      except socket.error, e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          logging.debug('dnsproxy: error receiving query: %s', e)
+        return
+      if len(data) < 12:
+        continue
+      try:
+        response = self.HandleQuery(data)
+      except Exception:
+        logging.exception('dnsproxy: unable to answer query from %s',
+                          address)
+        continue
+      if response:
+        try:
+          self.socket.sendto(response, address)
+        except socket.error, e:
+          logging.debug('dnsproxy: unable to answer %s: %s', address, e)
+
+  def serve_forever(self):
+    self.is_running = True
+    fd = self.socket.fileno()
+    epoll = None
+    if hasattr(select, 'epoll'):
+      epoll = select.epoll()
+      epoll.register(fd, select.EPOLLIN)
+    try:
+      while self.is_running:
+        if epoll:
+          ready = epoll.poll(self.POLL_TIMEOUT)
+        else:
+          ready, _, _ = select.select([fd], [], [], self.POLL_TIMEOUT)
+        if ready:
+          self._HandleReadable()
+    finally:
+      if epoll:
+        epoll.close()
+      self.stopped.set()
+
+  def cleanup(self):
+    if self.is_running:
+      self.is_running = False
+      self.stopped.wait(self.POLL_TIMEOUT * 4)
+    self.socket.close()
+    logging.info('Shutdown DNS server')
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how many queries per second a DNS proxy server can answer.
+
+Starts a proxy on a local port, keeps a number of queries (for a set of
+host names) outstanding at all times, and reports the query rate and the
+latency of the answers.
+
+Usage:
+  dnsproxy_benchmark.py [--server=async|threaded] [--queries=N]
+                        [--outstanding=N] [--hosts=N]
+"""
+
+import dnsproxy
+import logging
+import optparse
+import select
+import socket
+import struct
+import time
+
+import third_party
+import dns.message
+
+
+SERVERS = {
+    'async': dnsproxy.AsyncDnsProxyServer,
+    'threaded': dnsproxy.DnsProxyServer,
+}
+
+
+def RunBenchmark(server_class, num_queries, outstanding, num_hosts):
+  """Returns (queries per second, sorted list of latencies in seconds)."""
+  queries = []
+  for i in range(num_hosts):
+    queries.append(
+        dns.message.make_query('host%d.example.com' % i, 'A').to_wire())
+
+  latencies = []
+  with server_class(lambda host: '10.0.0.1', '127.0.0.1', 0) as server:
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.connect(server.server_address)
+    sent_at = {}
+    sent = 0
+    start = time.time()
+
+    def Send():
+      query_id = sent % 65536
+      query = queries[sent % num_hosts]
+      sent_at[query_id] = time.time()
+      client.send(struct.pack('!H', query_id) + query[2:])
+
+    while sent < min(outstanding, num_queries):
+      Send()
+      sent += 1
+    while len(latencies) < num_queries:
+      ready, _, _ = select.select([client], [], [], 5)
+      if not ready:
+        logging.error('Timed out waiting for answers')
+        break
+      response = client.recv(512)
+      query_id = struct.unpack('!H', response[:2])[0]
+      latencies.append(time.time() - sent_at.pop(query_id))
+      if sent < num_queries:
+        Send()
+        sent += 1
+    elapsed = time.time() - start
+    client.close()
+
+  latencies.sort()
+  return len(latencies) / elapsed, latencies
+
+
+def main():
+  option_parser = optparse.OptionParser(usage=__doc__)
+  option_parser.add_option('--server', default='async',
+                           choices=sorted(SERVERS.keys()),
+                           help='Which server to benchmark.')
+  option_parser.add_option('--queries', default=20000, type='int',
+                           help='How many queries to send.')
+  option_parser.add_option('--outstanding', default=20, type='int',
+                           help='How many queries to have in flight at once.')
+  option_parser.add_option('--hosts', default=50, type='int',
+                           help='How many different host names to look up.')
+  options, args = option_parser.parse_args()
+
+  qps, latencies = RunBenchmark(SERVERS[options.server], options.queries,
+                                options.outstanding, options.hosts)
+  print '%s: %.0f queries/second' % (options.server, qps)
+  for percentile in (50, 90, 99):
+    index = min(len(latencies) - 1, len(latencies) * percentile / 100)
+    print '  p%d latency: %.3f ms' % (percentile, latencies[index] * 1000)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import dnsproxy
+import socket
+import unittest
+
+import third_party
+import dns.message
+import dns.rcode
+
+
+def make_query(host, query_id):
+  query = dns.message.make_query(host, 'A')
+  query.id = query_id
+  return query.to_wire()
+
+
+class CountingLookup(object):
+  def __init__(self, answers):
+    self.answers = answers
+    self.calls = []
+
+  def __call__(self, host):
+    self.calls.append(host)
+    return self.answers.get(host)
+
+
+class FakeTimer(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class MakeDnsResponseTest(unittest.TestCase):
+
+  def testAnswer(self):
+    lookup = CountingLookup({'www.example.com.': '10.1.2.3'})
+    response = dns.message.from_wire(dnsproxy.MakeDnsResponse(
+        make_query('www.example.com', 1234), lookup, '127.0.0.1'))
+    self.assertEqual(1234, response.id)
+    self.assertEqual('10.1.2.3', str(response.answer[0][0]))
+    self.assertEqual(['www.example.com.'], lookup.calls)
+
+  def testNoSuchName(self):
+    lookup = CountingLookup({})
+    response = dns.message.from_wire(dnsproxy.MakeDnsResponse(
+        make_query('www.example.com', 1234), lookup, '127.0.0.1'))
+    self.assertEqual(dns.rcode.NXDOMAIN, response.rcode())
+
+
+class TtlDnsLookupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.lookup = CountingLookup({'a.com.': '10.0.0.1'})
+    self.timer = FakeTimer()
+    self.ttl_lookup = dnsproxy.TtlDnsLookup(
+        self.lookup, ttl=60, negative_ttl=5, timer=self.timer)
+
+  def testCachesUntilTtl(self):
+    self.assertEqual('10.0.0.1', self.ttl_lookup('a.com.'))
+    self.timer.now += 59
+    self.assertEqual('10.0.0.1', self.ttl_lookup('a.com.'))
+    self.assertEqual(1, len(self.lookup.calls))
+    self.timer.now += 2
+    self.assertEqual('10.0.0.1', self.ttl_lookup('a.com.'))
+    self.assertEqual(2, len(self.lookup.calls))
+
+  def testFailuresExpireSooner(self):
+    self.assertEqual(None, self.ttl_lookup('b.com.'))
+    self.assertEqual(None, self.ttl_lookup('b.com.'))
+    self.assertEqual(1, len(self.lookup.calls))
+    self.timer.now += 6
+    self.lookup.answers['b.com.'] = '10.0.0.2'
+    self.assertEqual('10.0.0.2', self.ttl_lookup('b.com.'))
+
+  def testClearCache(self):
+    self.ttl_lookup('a.com.')
+    self.ttl_lookup.ClearCache()
+    self.ttl_lookup('a.com.')
+    self.assertEqual(2, len(self.lookup.calls))
+
+
+class AsyncDnsProxyServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.lookup = CountingLookup({'www.example.com.': '10.1.2.3'})
+    self.timer = FakeTimer()
+    self.server = dnsproxy.AsyncDnsProxyServer(
+        self.lookup, '127.0.0.1', 0, timer=self.timer)
+
+  def tearDown(self):
+    self.server.cleanup()
+
+  def testCachedAnswerGetsNewTransactionId(self):
+    first = self.server.HandleQuery(make_query('www.example.com', 1))
+    second = self.server.HandleQuery(make_query('www.example.com', 2))
+    self.assertEqual(1, len(self.lookup.calls))
+    self.assertEqual(first[2:], second[2:])
+    self.assertEqual(2, dns.message.from_wire(second).id)
+
+  def testCachedAnswerExpires(self):
+    self.server.HandleQuery(make_query('www.example.com', 1))
+    self.timer.now += self.server.ANSWER_TTL + 1
+    self.server.HandleQuery(make_query('www.example.com', 2))
+    self.assertEqual(2, len(self.lookup.calls))
+
+  def testNoSuchNameNotCached(self):
+    query = make_query('missing.example.com', 1)
+    response = dns.message.from_wire(self.server.HandleQuery(query))
+    self.assertEqual(dns.rcode.NXDOMAIN, response.rcode())
+    self.lookup.answers['missing.example.com.'] = '10.1.2.4'
+    response = dns.message.from_wire(self.server.HandleQuery(query))
+    self.assertEqual('10.1.2.4', str(response.answer[0][0]))
+    self.assertEqual(2, len(self.lookup.calls))
+
+  def testSameAsThreadedServer(self):
+    for host in ('www.example.com', 'missing.example.com'):
+      query = make_query(host, 77)
+      self.assertEqual(
+          dnsproxy.MakeDnsResponse(query, self.lookup, '127.0.0.1'),
+          self.server.HandleQuery(query))
+
+  def testServesOverUdp(self):
+    with self.server:
+      client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      client.settimeout(5)
+      try:
+        for query_id in (10, 11):
+          client.sendto(make_query('www.example.com', query_id),
+                        self.server.server_address)
+          response = dns.message.from_wire(client.recv(512))
+          self.assertEqual(query_id, response.id)
+          self.assertEqual('10.1.2.3', str(response.answer[0][0]))
+      finally:
+        client.close()
+    self.assertEqual(1, len(self.lookup.calls))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -29,43 +29,291 @@ To view the content of all URLs:
 
 To edit a particular URL:
   $ ./httparchive.py edit --host www.example.com --path /foo archive.wpr
+
+To convert an archive to the indexed format (which loads much faster):
+  $ ./httparchive.py convert archive.wpr indexed.wpr
 """
 
 import difflib
 import email.utils
+import gc
 import httplib
 import httpzlib
 import json
 import logging
+import marshal
+import mmap
 import optparse
 import os
 import persistentmixin
 import StringIO
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import urlparse
 
 import platformsettings
 
 
+# How many characters are in each of the shingles that find_closest_request
+# compares.
+SIGNATURE_SIZE = 3
+
+
 class HttpArchiveException(Exception):
   """Base class for all exceptions in httparchive."""
   pass
 
 
+def _GetPathWithoutQuery(host, path):
+  """Return the hierarchical part of path (what matches() compares)."""
+  return urlparse.urlparse('http://%s%s' % (host or '', path or '')).path
+
+
+def _GetSignature(text):
+  """Return the set of SIGNATURE_SIZE-character shingles of text."""
+  return frozenset(text[i:i + SIGNATURE_SIZE]
+                   for i in xrange(max(1, len(text) - SIGNATURE_SIZE + 1)))
+
+
+class MappedChunks(object):
+  """Read-only list of response chunks stored in a memory-mapped archive.
+
+  A chunk is only read from the map when it is asked for, so loading an
+  indexed archive neither reads nor keeps in memory any response bodies.
+  Copying or pickling gives a plain list of strings.
+  """
+  __slots__ = ('_data', '_spans')
+
+  def __init__(self, data, spans):
+    """Initialize a MappedChunks.
+
+    Args:
+      data: a buffer (e.g. an mmap.mmap) holding the chunks.
+      spans: list of (offset, length) tuples, one per chunk.
+    """
+    self._data = data
+    self._spans = spans
+
+  def __len__(self):
+    return len(self._spans)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in xrange(*index.indices(len(self._spans)))]
+    offset, length = self._spans[index]
+    return self._data[offset:offset + length]
+
+  def __iter__(self):
+    for offset, length in self._spans:
+      yield self._data[offset:offset + length]
+
+  def __eq__(self, other):
+    return list(self) == list(other)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return repr(list(self))
+
+  def __reduce__(self):
+    return (list, (list(self),))
+
+  def __deepcopy__(self, memo):
+    return list(self)
+
+  def get_buffers(self):
+    """Return the chunks as buffers into the map, without copying them."""
+    return [buffer(self._data, offset, length)
+            for offset, length in self._spans]
+
+
 class HttpArchive(dict, persistentmixin.PersistentMixin):
   """Dict with ArchivedHttpRequest keys and ArchivedHttpResponse values.
 
   PersistentMixin adds CreateNew(filename), Load(filename), and Persist().
 
+  Archives are stored either as a pickle or in an indexed format:
+
+    INDEXED_MAGIC
+    response chunks, one after another
+    marshalled index: {'server_rtt': {...}, 'entries': [...]}
+    offset of the index (8 bytes, little-endian)
+
+  The index holds everything but the response bodies, sorted by request,
+  including the trimmed request headers, so loading it is cheap. The bodies
+  are memory-mapped and paged in when a response is sent. Because the
+  trimmed headers are stored, an indexed archive needs to be converted again
+  if _TrimHeaders changes.
+
+  To keep lookups that don't use the whole request cheap, the archive also
+  keeps sets of requests by (command, host) and (command, host, path without
+  query), and the signatures find_closest_request compares. These are built
+  the first time they are needed (all at once, so that the proxy's other
+  threads never see them half built), kept up to date by __setitem__ and
+  __delitem__, and thrown away by the other methods that change the archive.
+  They are not persisted.
+
   Attributes:
     server_rtt: dict of {hostname, server rtt in milliseconds}
+    indexed: True if Persist() writes the indexed format.
   """
+  INDEXED_MAGIC = 'WPR-INDEXED-1\n'
+  indexed = False
+
+  # (requests by host, requests by path, signatures), or None if not built.
+  _indexes = None
+  # Held while the indexes are built or changed. Shared by all archives, since
+  # a lock can't be pickled, and there is rarely more than one.
+  _index_lock = threading.Lock()
 
   def __init__(self):
     self.server_rtt = {}
 
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.pop('_indexes', None)
+    return state
+
+  def __setitem__(self, request, response):
+    with self._index_lock:
+      is_new = request not in self
+      dict.__setitem__(self, request, response)
+      if is_new and self._indexes is not None:
+        self._AddToIndexes(self._indexes, request)
+
+  def __delitem__(self, request):
+    with self._index_lock:
+      dict.__delitem__(self, request)
+      if self._indexes is not None:
+        requests_by_host, requests_by_path, signatures = self._indexes
+        requests_by_host[(request.command, request.host)].discard(request)
+        requests_by_path[(
+            request.command, request.host,
+            _GetPathWithoutQuery(request.host, request.path))].discard(request)
+        signatures.pop(request, None)
+
+  def clear(self):
+    dict.clear(self)
+    self._ResetIndexes()
+
+  def pop(self, *args):
+    self._ResetIndexes()
+    return dict.pop(self, *args)
+
+  def popitem(self):
+    self._ResetIndexes()
+    return dict.popitem(self)
+
+  def setdefault(self, request, default=None):
+    self._ResetIndexes()
+    return dict.setdefault(self, request, default)
+
+  def update(self, *args, **kwargs):
+    self._ResetIndexes()
+    dict.update(self, *args, **kwargs)
+
+  def _ResetIndexes(self):
+    self._indexes = None
+
+  def _GetIndexes(self):
+    """Returns the indexes, building them first if need be."""
+    indexes = self._indexes
+    if indexes is None:
+      with self._index_lock:
+        indexes = self._indexes
+        if indexes is None:
+          indexes = ({}, {}, {})
+          for request in self.keys():
+            self._AddToIndexes(indexes, request)
+          self._indexes = indexes
+    return indexes
+
+  @staticmethod
+  def _AddToIndexes(indexes, request):
+    requests_by_host, requests_by_path, _ = indexes
+    requests_by_host.setdefault(
+        (request.command, request.host), set()).add(request)
+    requests_by_path.setdefault(
+        (request.command, request.host,
+         _GetPathWithoutQuery(request.host, request.path)), set()).add(request)
+
+  @classmethod
+  def Load(cls, filename):
+    """Load an archive in either the pickle or the indexed format."""
+    with open(filename, 'rb') as f:
+      if f.read(len(cls.INDEXED_MAGIC)) != cls.INDEXED_MAGIC:
+        return super(HttpArchive, cls).Load(filename)
+      f.seek(-8, os.SEEK_END)
+      end = f.tell()
+      index_offset = struct.unpack('<Q', f.read(8))[0]
+      f.seek(index_offset)
+      index_data = f.read(end - index_offset)
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Loading allocates lots of small containers and nothing that can form a
+    # cycle, so don't let that set off the garbage collector over and over.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+      index = marshal.loads(index_data)
+      archive = cls()
+      archive.indexed = True
+      archive.server_rtt = index['server_rtt']
+      for request_state, response_state, spans in index['entries']:
+        (command, host, path, request_body, headers, is_ssl,
+         trimmed_headers) = request_state
+        request = ArchivedHttpRequest(command, host, path, request_body,
+                                      headers, is_ssl,
+                                      trimmed_headers=trimmed_headers)
+        version, status, reason, response_headers, delays = response_state
+        # Nothing else can see the archive yet, so skip the index upkeep.
+        dict.__setitem__(archive, request, ArchivedHttpResponse(
+            version, status, reason, response_headers,
+            MappedChunks(data, spans), delays))
+    finally:
+      if gc_was_enabled:
+        gc.enable()
+    return archive
+
+  def Persist(self, filename):
+    """Persist the archive in the format given by self.indexed."""
+    if not self.indexed:
+      super(HttpArchive, self).Persist(filename)
+      return
+
+    # The archive may be mapped from filename, so it can't be overwritten in
+    # place.
+    tmp_filename = '%s.tmp' % filename
+    entries = []
+    with open(tmp_filename, 'wb') as f:
+      f.write(self.INDEXED_MAGIC)
+      offset = len(self.INDEXED_MAGIC)
+      for request in sorted(self, key=lambda r: (r.host, r.path, r.command,
+                                                 r.is_ssl, r.trimmed_headers)):
+        response = self[request]
+        spans = []
+        for chunk in response.response_data:
+          f.write(chunk)
+          spans.append((offset, len(chunk)))
+          offset += len(chunk)
+        entries.append((
+            (request.command, request.host, request.path,
+             request.request_body, request.headers, request.is_ssl,
+             request.trimmed_headers),
+            (response.version, response.status, response.reason,
+             response.headers, response.delays),
+            spans))
+      f.write(marshal.dumps({'server_rtt': self.server_rtt,
+                             'entries': entries}))
+      f.write(struct.pack('<Q', offset))
+    if os.name == 'nt' and os.path.exists(filename):
+      os.remove(filename)
+    os.rename(tmp_filename, filename)
+
   def get_server_rtt(self, server):
     """Retrieves the round trip time (rtt) to the server
 
@@ -173,8 +421,18 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
 
   def get_requests(self, command=None, host=None, path=None, use_query=True):
     """Return a list of requests that match the given args."""
-    return [r for r in self if r.matches(command, host, path,
-                                         use_query=use_query)]
+    if command is None or host is None:
+      return [r for r in self if r.matches(command, host, path,
+                                           use_query=use_query)]
+    requests_by_host, requests_by_path, _ = self._GetIndexes()
+    with self._index_lock:
+      if path is None:
+        return list(requests_by_host.get((command, host), ()))
+      requests = list(requests_by_path.get(
+          (command, host, _GetPathWithoutQuery(host, path)), ()))
+    if use_query:
+      return [r for r in requests if r.path == path]
+    return requests
 
   def ls(self, command=None, host=None, path=None):
     """List all URLs that match given params."""
@@ -271,19 +529,28 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
       Otherwise, return None.
     """
     best_match = None
-    request_lines = self._format_request_lines(request)
-    matcher = difflib.SequenceMatcher(b=''.join(request_lines))
     path = None
     if use_path:
       path = request.path
-    for candidate in self.get_requests(request.command, request.host, path,
-                                       use_query=not use_path):
-      candidate_lines = self._format_request_lines(candidate)
-      matcher.set_seq1(''.join(candidate_lines))
-      best_match = max(best_match, (matcher.ratio(), candidate))
-    if best_match:
-      return best_match[1]
-    return None
+    candidates = self.get_requests(request.command, request.host, path,
+                                   use_query=not use_path)
+    if not candidates:
+      return None
+    # Candidates are scored by the fraction of shingles (short substrings of
+    # the text diff() would show) that they share with the request. Ties go
+    # to the greatest repr so that the answer doesn't depend on dict order.
+    signature = _GetSignature(''.join(self._format_request_lines(request)))
+    signatures = self._GetIndexes()[2]
+    for candidate in candidates:
+      candidate_signature = signatures.get(candidate)
+      if candidate_signature is None:
+        candidate_signature = _GetSignature(
+            ''.join(self._format_request_lines(candidate)))
+        signatures[candidate] = candidate_signature
+      score = (float(len(signature & candidate_signature)) /
+               len(signature | candidate_signature))
+      best_match = max(best_match, (score, repr(candidate), candidate))
+    return best_match[2]
 
   def diff(self, request):
     """Diff the given request to the closest matching request in the archive.
@@ -315,12 +582,24 @@ class ArchivedHttpRequest(object):
 
   For unpickling, 'trimmed_headers' is recreated from 'headers'. That
   allows for changes to the trim function and can help with debugging.
+
+  Requests are compared and hashed many times during replay, so the string
+  they are compared by (their repr) is built and interned once, along with
+  its hash, whenever the request is created or unpickled.
   """
+  __slots__ = ('command', 'host', 'path', 'request_body', 'headers', 'is_ssl',
+               'trimmed_headers', '_key', '_hash')
+
+  # The state that gets pickled (trimmed_headers and the key are recreated).
+  PICKLED_ATTRIBUTES = ('command', 'host', 'path', 'request_body', 'headers',
+                        'is_ssl')
+
   CONDITIONAL_HEADERS = [
       'if-none-match', 'if-match',
       'if-modified-since', 'if-unmodified-since']
 
-  def __init__(self, command, host, path, request_body, headers, is_ssl=False):
+  def __init__(self, command, host, path, request_body, headers, is_ssl=False,
+               trimmed_headers=None):
     """Initialize an ArchivedHttpRequest.
 
     Args:
@@ -330,6 +609,8 @@ class ArchivedHttpRequest(object):
       request_body: a request body string for a POST or None.
       headers: {key: value, ...} where key and value are strings.
       is_ssl: a boolean which is True iff request is make via SSL.
+      trimmed_headers: the result of _TrimHeaders(headers), if it is already
+          known (e.g. from an indexed archive).
     """
     self.command = command
     self.host = host
@@ -337,7 +618,17 @@ class ArchivedHttpRequest(object):
     self.request_body = request_body
     self.headers = headers
     self.is_ssl = is_ssl
-    self.trimmed_headers = self._TrimHeaders(headers)
+    if trimmed_headers is None:
+      trimmed_headers = self._TrimHeaders(headers)
+    self.trimmed_headers = trimmed_headers
+    self._SetKey()
+
+  def _SetKey(self):
+    """Compute the key the request is compared and hashed by."""
+    self._key = intern(repr((self.command, self.host, self.path,
+                             self.request_body, self.trimmed_headers,
+                             self.is_ssl)))
+    self._hash = hash(self._key)
 
   def __str__(self):
     scheme = 'https' if self.is_ssl else 'http'
@@ -345,16 +636,21 @@ class ArchivedHttpRequest(object):
         self.command, scheme, self.host, self.path, self.trimmed_headers)
 
   def __repr__(self):
-    return repr((self.command, self.host, self.path, self.request_body,
-                 self.trimmed_headers, self.is_ssl))
+    return self._key
 
   def __hash__(self):
     """Return a integer hash to use for hashed collections including dict."""
-    return hash(repr(self))
+    return self._hash
 
   def __eq__(self, other):
     """Define the __eq__ method to match the hash behavior."""
-    return repr(self) == repr(other)
+    if isinstance(other, ArchivedHttpRequest):
+      # Interned keys of equal requests are the same object.
+      return self._key is other._key
+    return self._key == repr(other)
+
+  def __ne__(self, other):
+    return not self == other
 
   def __setstate__(self, state):
     """Influence how to unpickle.
@@ -364,7 +660,7 @@ class ArchivedHttpRequest(object):
     during replay.
 
     Args:
-      state: a dictionary for __dict__
+      state: a dictionary of attributes
     """
     if 'full_headers' in state:
       # Fix older version of archive.
@@ -374,10 +670,12 @@ class ArchivedHttpRequest(object):
       raise HttpArchiveException(
           'Archived HTTP request is missing "headers". The HTTP archive is'
           ' likely from a previous version and must be re-recorded.')
-    state['trimmed_headers'] = self._TrimHeaders(dict(state['headers']))
     if 'is_ssl' not in state:
       state['is_ssl'] = False
-    self.__dict__.update(state)
+    for name in self.PICKLED_ATTRIBUTES:
+      setattr(self, name, state[name])
+    self.trimmed_headers = self._TrimHeaders(dict(self.headers))
+    self._SetKey()
 
   def __getstate__(self):
     """Influence how to pickle.
@@ -385,9 +683,8 @@ class ArchivedHttpRequest(object):
     Returns:
       a dict to use for pickling
     """
-    state = self.__dict__.copy()
-    del state['trimmed_headers']
-    return state
+    return dict((name, getattr(self, name))
+                for name in self.PICKLED_ATTRIBUTES)
 
   def matches(self, command=None, host=None, path_with_query=None,
               use_query=True):
@@ -413,11 +710,8 @@ class ArchivedHttpRequest(object):
     """
     path_match = path_with_query == self.path
     if not use_query:
-      self_path = urlparse.urlparse('http://%s%s' % (
-          self.host or '', self.path or '')).path
-      other_path = urlparse.urlparse('http://%s%s' % (
-          host or '', path_with_query or '')).path
-      path_match = self_path == other_path
+      path_match = (_GetPathWithoutQuery(self.host, self.path) ==
+                    _GetPathWithoutQuery(host, path_with_query))
     return ((command is None or command == self.command) and
             (host is None or host == self.host) and
             (path_with_query is None or path_match))
@@ -478,6 +772,8 @@ class ArchivedHttpRequest(object):
 
 class ArchivedHttpResponse(object):
   """All the data needed to recreate all HTTP response."""
+  __slots__ = ('version', 'status', 'reason', 'headers', 'response_data',
+               'delays')
 
   # CHUNK_EDIT_SEPARATOR is used to edit and view text content.
   # It is not sent in responses. It is added by get_data_as_text()
@@ -544,7 +840,7 @@ class ArchivedHttpResponse(object):
     """Influence how to unpickle.
 
     Args:
-      state: a dictionary for __dict__
+      state: a dictionary of attributes
     """
     if 'server_delays' in state:
       state['delays'] = {
@@ -554,9 +850,18 @@ class ArchivedHttpResponse(object):
       del state['server_delays']
     elif 'delays' not in state:
       state['delays'] = None
-    self.__dict__.update(state)
+    for name in self.__slots__:
+      setattr(self, name, state[name])
     self.fix_delays()
 
+  def __getstate__(self):
+    """Influence how to pickle.
+
+    Returns:
+      a dict to use for pickling
+    """
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
   def get_header(self, key, default=None):
     for k, v in self.headers:
       if key == k:
@@ -692,7 +997,7 @@ def main():
         return ''
 
   option_parser = optparse.OptionParser(
-      usage='%prog [ls|cat|edit] [options] replay_file',
+      usage='%prog [ls|cat|edit|convert] [options] replay_file [output_file]',
       formatter=PlainHelpFormatter(),
       description=__doc__,
       epilog='http://code.google.com/p/web-page-replay/')
@@ -712,7 +1017,7 @@ def main():
 
   options, args = option_parser.parse_args()
 
-  if len(args) != 2:
+  if len(args) != 2 and not (len(args) == 3 and args[0] == 'convert'):
     print 'args: %s' % args
     option_parser.error('Must specify a command and replay_file')
 
@@ -730,6 +1035,11 @@ def main():
   elif command == 'edit':
     http_archive.edit(options.command, options.host, options.path)
     http_archive.Persist(replay_file)
+  elif command == 'convert':
+    if len(args) != 3:
+      option_parser.error('Must specify an output_file to convert to')
+    http_archive.indexed = True
+    http_archive.Persist(args[2])
   else:
     option_parser.error('Unknown command "%s"' % command)
   return 0
@@ -14,8 +14,13 @@
 # limitations under the License.
 
 import ast
+import copy
+import cPickle
 import httparchive
 import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 
@@ -343,5 +348,206 @@ class HttpArchiveTest(unittest.TestCase):
     self.assertEqual(archive.get(request), response)
 
 
+class HttpArchiveIndexTest(unittest.TestCase):
+
+  PATHS = ['/', '/a', '/a?x=1', '/a?x=2', '/a/b?x=1', '/b#frag', '/b?y']
+
+  def setUp(self):
+    self.archive = httparchive.HttpArchive()
+    for command in ('GET', 'POST'):
+      for host in ('www.test.com', 'img.test.com'):
+        for path in self.PATHS:
+          request = httparchive.ArchivedHttpRequest(
+              command, host, path, None, {})
+          self.archive[request] = create_response([])
+
+  def assert_same_as_scan(self, archive):
+    for command in ('GET', 'POST', None):
+      for host in ('www.test.com', 'img.test.com', 'none.test.com', None):
+        for path in self.PATHS + ['/c', None]:
+          for use_query in (True, False):
+            expected = sorted(
+                repr(r) for r in archive
+                if r.matches(command, host, path, use_query=use_query))
+            found = sorted(repr(r) for r in archive.get_requests(
+                command, host, path, use_query=use_query))
+            self.assertEqual(expected, found)
+
+  def test_get_requests(self):
+    self.assert_same_as_scan(self.archive)
+
+  def test_get_requests_after_changes(self):
+    self.archive.get_requests('GET', 'www.test.com')
+    del self.archive[httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/a?x=1', None, {})]
+    self.archive[httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/c?z', None, {})] = create_response([])
+    self.assert_same_as_scan(self.archive)
+    self.archive.pop(httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/', None, {}))
+    self.assert_same_as_scan(self.archive)
+    self.archive.clear()
+    self.assertEqual([], self.archive.get_requests('GET', 'www.test.com'))
+
+  def test_indexes_not_pickled(self):
+    self.archive.find_closest_request(create_request({}))
+    archive = cPickle.loads(cPickle.dumps(self.archive, 2))
+    self.assertEqual(None, archive._indexes)
+    self.assertEqual(len(self.archive), len(archive))
+    self.assert_same_as_scan(archive)
+
+  def test_indexes_built_while_serving(self):
+    archive = httparchive.HttpArchive()
+    for i in range(5000):
+      archive[httparchive.ArchivedHttpRequest(
+          'GET', 'www%d.test.com' % (i % 10), '/%d' % i, None, {})] = (
+              create_response([]))
+    misses = []
+    def Lookup():
+      for i in range(0, 5000, 97):
+        if not archive.get_requests('GET', 'www%d.test.com' % (i % 10),
+                                    '/%d' % i):
+          misses.append(i)
+    for _ in range(5):
+      archive._ResetIndexes()
+      threads = [threading.Thread(target=Lookup) for _ in range(8)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    self.assertEqual([], misses)
+
+  def test_find_closest_request_with_cache_buster(self):
+    archive = httparchive.HttpArchive()
+    for path in ('/img.png?t=1000', '/style.css?t=1000', '/img.jpeg?t=1000'):
+      archive[httparchive.ArchivedHttpRequest(
+          'GET', 'www.test.com', path, None, {})] = create_response([])
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/img.png?t=2000', None, {})
+    self.assertEqual('/img.png?t=1000',
+                     archive.find_closest_request(request).path)
+    self.assertEqual('/img.png?t=1000',
+                     archive.find_closest_request(request, use_path=True).path)
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'other.test.com', '/img.png?t=2000', None, {})
+    self.assertEqual(None, archive.find_closest_request(request))
+
+
+class ArchivedHttpRequestTest(unittest.TestCase):
+
+  def test_equal_requests_share_key(self):
+    request1 = create_request({'accept-encoding': 'gzip', 'user-agent': 'a'})
+    request2 = create_request({'accept-encoding': 'gzip', 'user-agent': 'b'})
+    self.assertTrue(repr(request1) is repr(request2))
+    self.assertEqual(hash(request1), hash(request2))
+    self.assertEqual(request1, request2)
+    self.assertFalse(request1 != request2)
+    self.assertNotEqual(request1, create_request({'accept-encoding': 'br'}))
+
+  def test_no_instance_dict(self):
+    request = create_request({})
+    self.assertRaises(AttributeError, setattr, request, 'extra', 1)
+    response = create_response([])
+    self.assertRaises(AttributeError, setattr, response, 'extra', 1)
+
+  def test_pickle(self):
+    request = create_request({'accept-encoding': 'gzip', 'cookie': 'c'})
+    self.assertEqual(['command', 'headers', 'host', 'is_ssl', 'path',
+                      'request_body'], sorted(request.__getstate__()))
+    unpickled = cPickle.loads(cPickle.dumps(request, 2))
+    self.assertEqual(request, unpickled)
+    self.assertEqual(hash(request), hash(unpickled))
+    self.assertEqual(request.headers, unpickled.headers)
+
+  def test_unpickle_old_request(self):
+    request = httparchive.ArchivedHttpRequest.__new__(
+        httparchive.ArchivedHttpRequest)
+    request.__setstate__({
+        'command': 'GET', 'host': 'www.test.com', 'path': '/',
+        'request_body': None, 'full_headers': {'cookie': 'c', 'x-a': 'b'}})
+    self.assertEqual(create_request({'x-a': 'b'}), request)
+    self.assertFalse(request.is_ssl)
+
+  def test_unpickle_old_response(self):
+    response = httparchive.ArchivedHttpResponse.__new__(
+        httparchive.ArchivedHttpResponse)
+    response.__setstate__({
+        'version': 11, 'status': 200, 'reason': 'OK', 'headers': [],
+        'response_data': ['a', 'b'], 'server_delays': [10, 20]})
+    self.assertEqual({'headers': 0, 'data': [10, 20]}, response.delays)
+    unpickled = cPickle.loads(cPickle.dumps(response, 2))
+    self.assertEqual(response, unpickled)
+    self.assertEqual(response.delays, unpickled.delays)
+
+
+class IndexedArchiveTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.archive = httparchive.HttpArchive()
+    self.archive.server_rtt['www.test.com'] = 0.25
+    self.request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/index.html?q=1', None,
+        {'accept-encoding': 'gzip,sdch', 'user-agent': 'test'})
+    self.response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('content-type', 'text/html')],
+        ['<html>', '', '</html>'], {'headers': 10, 'data': [1, 2, 3]})
+    self.archive[self.request] = self.response
+    post_request = httparchive.ArchivedHttpRequest(
+        'POST', 'www.test.com', '/form', 'a=b', {}, is_ssl=True)
+    self.archive[post_request] = httparchive.create_response(404)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def persist(self, archive, indexed=True):
+    filename = os.path.join(self.tmp_dir, 'archive.wpr')
+    archive.indexed = indexed
+    archive.Persist(filename)
+    return filename
+
+  def test_round_trip(self):
+    archive = httparchive.HttpArchive.Load(self.persist(self.archive))
+    self.assertTrue(archive.indexed)
+    self.assertEqual({'www.test.com': 0.25}, archive.server_rtt)
+    self.assertEqual(sorted(repr(r) for r in self.archive),
+                     sorted(repr(r) for r in archive))
+    for request, response in self.archive.items():
+      self.assertEqual(repr(response), repr(archive[request]))
+      self.assertEqual(response.delays, archive[request].delays)
+    response = archive[self.request]
+    self.assertTrue(isinstance(response.response_data,
+                               httparchive.MappedChunks))
+    self.assertEqual('</html>', response.response_data[2])
+    self.assertEqual(['', '</html>'], response.response_data[1:])
+
+  def test_convert_from_pickle(self):
+    archive = httparchive.HttpArchive.Load(
+        self.persist(self.archive, indexed=False))
+    self.assertFalse(archive.indexed)
+    archive = httparchive.HttpArchive.Load(self.persist(archive))
+    self.assertTrue(archive.indexed)
+    self.assertEqual(repr(self.response), repr(archive[self.request]))
+
+  def test_persist_over_loaded_archive(self):
+    filename = self.persist(self.archive)
+    archive = httparchive.HttpArchive.Load(filename)
+    archive[self.request].set_data(
+        httparchive.ArchivedHttpResponse.CHUNK_EDIT_SEPARATOR.join(
+            ['<html>', 'edited', '</html>']))
+    archive.Persist(filename)
+    archive = httparchive.HttpArchive.Load(filename)
+    self.assertEqual(['<html>', 'edited', '</html>'],
+                     list(archive[self.request].response_data))
+
+  def test_copies_are_lists(self):
+    archive = httparchive.HttpArchive.Load(self.persist(self.archive))
+    response = archive[self.request]
+    self.assertEqual(['<html>', '', '</html>'],
+                     copy.deepcopy(response).response_data)
+    unpickled = cPickle.loads(cPickle.dumps(response, 2))
+    self.assertEqual(['<html>', '', '</html>'], unpickled.response_data)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -15,6 +15,7 @@
 
 """Retrieve web resources over http."""
 
+import collections
 import copy
 import httparchive
 import httplib
@@ -22,6 +23,7 @@ import logging
 import os
 import platformsettings
 import re
+import threading
 import util
 
 
@@ -61,8 +63,7 @@ def _InjectScripts(response, inject_script):
   """
   if type(response) == tuple:
     logging.warn('tuple response: %s', response)
-  content_type = response.get_header('content-type')
-  if content_type and content_type.startswith('text/html'):
+  if _IsHtml(response):
     text = response.get_data_as_text()
 
     def InsertScriptAfter(matchobj):
@@ -81,6 +82,82 @@ def _InjectScripts(response, inject_script):
   return response
 
 
+def _IsHtml(response):
+  content_type = response.get_header('content-type')
+  return bool(content_type and content_type.startswith('text/html'))
+
+
+class InjectedResponseCache(object):
+  """Thread-safe cache of archived HTML responses with scripts injected.
+
+  Injecting scripts uncompresses, edits, copies and recompresses a response,
+  so replay keeps the result for each response it has served. Entries are
+  keyed by the identity of the archived response (which the entry keeps
+  alive, so the identity can't be reused) and the script. Once the injected
+  bodies add up to more than max_size bytes, the least recently used entries
+  are evicted.
+  """
+
+  DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+  def __init__(self, max_size=DEFAULT_MAX_SIZE):
+    self.max_size = max_size
+    # {(id(response), inject_script): (response, injected_response, size)}
+    self._entries = collections.OrderedDict()
+    self._size = 0
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def Get(self, response, inject_script):
+    """Return _InjectScripts(response, inject_script), from the cache if we can.
+
+    Args:
+      response: an ArchivedHttpResponse (that will not be modified)
+      inject_script: JavaScript string
+    Returns:
+      an ArchivedHttpResponse
+    """
+    if not _IsHtml(response):
+      return response
+    key = (id(response), inject_script)
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._entries[key] = entry
+        return entry[1]
+
+    injected_response = _InjectScripts(response, inject_script)
+    size = 0
+    if injected_response is not response:
+      size = sum(len(chunk) for chunk in injected_response.response_data)
+    if size > self.max_size:
+      return injected_response
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._size -= entry[2]
+      self._entries[key] = (response, injected_response, size)
+      self._size += size
+      while self._size > self.max_size:
+        _, (_, _, evicted_size) = self._entries.popitem(last=False)
+        self._size -= evicted_size
+    return injected_response
+
+  def Fill(self, responses, inject_script):
+    """Inject scripts into all the given responses ahead of time."""
+    for response in responses:
+      self.Get(response, inject_script)
+    logging.debug('Injected scripts into %d responses (%d bytes)',
+                  len(self._entries), self._size)
+
+  def Clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._size = 0
+
+
 class DetailedHTTPResponse(httplib.HTTPResponse):
   """Preserve details relevant to replaying responses.
 
@@ -275,7 +352,7 @@ class ReplayHttpArchiveFetch(object):
 
   def __init__(self, http_archive, inject_script,
                use_diff_on_unknown_requests=False, cache_misses=None,
-               use_closest_match=False):
+               use_closest_match=False, inject_at_load=False):
     """Initialize ReplayHttpArchiveFetch.
 
     Args:
@@ -287,12 +364,17 @@ class ReplayHttpArchiveFetch(object):
         Callback updates archive on cache misses
       use_closest_match: If True, on replay mode, serve the closest match
         in the archive instead of giving a 404.
+      inject_at_load: If True, inject scripts into all the pages in the
+        archive now, instead of as each is first served.
     """
     self.http_archive = http_archive
     self.inject_script = inject_script
     self.use_diff_on_unknown_requests = use_diff_on_unknown_requests
     self.cache_misses = cache_misses
     self.use_closest_match = use_closest_match
+    self.injected_responses = InjectedResponseCache()
+    if inject_at_load:
+      self.injected_responses.Fill(http_archive.values(), inject_script)
 
   def __call__(self, request):
     """Fetch the request and return the response.
@@ -327,7 +409,7 @@ class ReplayHttpArchiveFetch(object):
               "('-' for archived request, '+' for current request):\n%s" % diff)
       logging.warning('Could not replay: %s', reason)
     else:
-      response = _InjectScripts(response, self.inject_script)
+      response = self.injected_responses.Get(response, self.inject_script)
     return response
 
 
@@ -336,7 +418,8 @@ class ControllableHttpArchiveFetch(object):
 
   def __init__(self, http_archive, real_dns_lookup,
                inject_script, use_diff_on_unknown_requests,
-               use_record_mode, cache_misses, use_closest_match):
+               use_record_mode, cache_misses, use_closest_match,
+               inject_at_load=False):
     """Initialize HttpArchiveFetch.
 
     Args:
@@ -349,13 +432,15 @@ class ControllableHttpArchiveFetch(object):
       cache_misses: Instance of CacheMissArchive.
       use_closest_match: If True, on replay mode, serve the closest match
         in the archive instead of giving a 404.
+      inject_at_load: If True, inject scripts into all the pages in the
+        archive now, instead of as each is first replayed.
     """
     self.record_fetch = RecordHttpArchiveFetch(
         http_archive, real_dns_lookup, inject_script,
         cache_misses)
     self.replay_fetch = ReplayHttpArchiveFetch(
         http_archive, inject_script, use_diff_on_unknown_requests, cache_misses,
-        use_closest_match)
+        use_closest_match, inject_at_load)
     if use_record_mode:
       self.SetRecordMode()
     else:
@@ -364,6 +449,8 @@ class ControllableHttpArchiveFetch(object):
   def SetRecordMode(self):
     self.fetch = self.record_fetch
     self.is_record_mode = True
+    # Recording replaces the responses, so don't keep the old ones alive.
+    self.replay_fetch.injected_responses.Clear()
 
   def SetReplayMode(self):
     self.fetch = self.replay_fetch
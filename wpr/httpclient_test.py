@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import httparchive
+import httpclient
+import threading
+import unittest
+
+
+def create_html_response(body, gzip=False):
+  headers = [('content-type', 'text/html')]
+  if gzip:
+    headers.append(('content-encoding', 'gzip'))
+  response = httparchive.ArchivedHttpResponse(11, 200, 'OK', headers, [''])
+  response.set_data(body)
+  return response
+
+
+class InjectedResponseCacheTest(unittest.TestCase):
+
+  SCRIPT = 'Math.random = function() { return 0.5; };'
+
+  def setUp(self):
+    self.cache = httpclient.InjectedResponseCache()
+
+  def test_same_as_inject_scripts(self):
+    for gzip in (False, True):
+      response = create_html_response('<html><head></head></html>', gzip)
+      injected = self.cache.Get(response, self.SCRIPT)
+      self.assertEqual(repr(httpclient._InjectScripts(response, self.SCRIPT)),
+                       repr(injected))
+      self.assertTrue(self.SCRIPT in injected.get_data_as_text())
+      self.assertFalse(self.SCRIPT in response.get_data_as_text())
+
+  def test_reuses_injected_response(self):
+    response = create_html_response('<html><head></head></html>')
+    injected = self.cache.Get(response, self.SCRIPT)
+    self.assertTrue(injected is self.cache.Get(response, self.SCRIPT))
+    other_script = self.cache.Get(response, 'var x;')
+    self.assertFalse(other_script is injected)
+    self.assertTrue('var x;' in other_script.get_data_as_text())
+
+  def test_not_html(self):
+    response = httparchive.create_response(200, body='<head>')
+    self.assertTrue(response is self.cache.Get(response, self.SCRIPT))
+    self.assertEqual(0, len(self.cache))
+
+  def test_not_injected(self):
+    response = create_html_response('no tags here')
+    self.assertTrue(response is self.cache.Get(response, self.SCRIPT))
+    self.assertTrue(response is self.cache.Get(response, self.SCRIPT))
+    self.assertEqual(1, len(self.cache))
+
+  def test_evicts_least_recently_used(self):
+    responses = [create_html_response('<head>%d</head>' % i)
+                 for i in range(3)]
+    size = len(self.cache.Get(responses[0], self.SCRIPT).response_data[0])
+    self.cache.max_size = 2 * size
+    self.cache.Get(responses[1], self.SCRIPT)
+    self.cache.Get(responses[0], self.SCRIPT)
+    self.cache.Get(responses[2], self.SCRIPT)
+    self.assertEqual(2, len(self.cache))
+    injected = self.cache.Get(responses[0], self.SCRIPT)
+    self.assertTrue(injected is self.cache.Get(responses[0], self.SCRIPT))
+    self.assertEqual(
+        sorted([(id(responses[0]), self.SCRIPT),
+                (id(responses[2]), self.SCRIPT)]),
+        sorted(self.cache._entries.keys()))
+
+  def test_fill_and_clear(self):
+    responses = [create_html_response('<head>%d</head>' % i)
+                 for i in range(3)]
+    self.cache.Fill(responses, self.SCRIPT)
+    self.assertEqual(3, len(self.cache))
+    self.cache.Clear()
+    self.assertEqual(0, len(self.cache))
+
+  def test_threads(self):
+    responses = [create_html_response('<head>%d</head>' % i)
+                 for i in range(20)]
+    self.cache.max_size = 10 * len(
+        self.cache.Get(responses[0], self.SCRIPT).response_data[0])
+    errors = []
+
+    def Run():
+      try:
+        for _ in range(20):
+          for response in responses:
+            text = self.cache.Get(response, self.SCRIPT).get_data_as_text()
+            assert self.SCRIPT in text
+      except Exception, e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=Run) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual([], errors)
+    self.assertTrue(len(self.cache) <= 10)
+
+
+class ReplayHttpArchiveFetchTest(unittest.TestCase):
+
+  def test_inject_at_load(self):
+    archive = httparchive.HttpArchive()
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/', None, {})
+    archive[request] = create_html_response('<html></html>')
+    fetch = httpclient.ReplayHttpArchiveFetch(archive, 'var x;',
+                                              inject_at_load=True)
+    self.assertEqual(1, len(fetch.injected_responses))
+    response = fetch(request)
+    self.assertTrue(response is fetch(request))
+    self.assertEqual('<html><script>var x;</script></html>',
+                     response.get_data_as_text())
+
+
+if __name__ == '__main__':
+  unittest.main()
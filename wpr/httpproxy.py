@@ -14,13 +14,22 @@
 # limitations under the License.
 
 import BaseHTTPServer
+import collections
 import daemonserver
+import email.utils
+import errno
+import heapq
 import httparchive
 import logging
+import mimetools
 import os
+import select
+import socket
 import SocketServer
 import ssl
+import StringIO
 import subprocess
+import threading
 import time
 import urlparse
 
@@ -34,6 +43,14 @@ class HttpProxyServerError(HttpProxyError):
   pass
 
 
+def _GetFullPath(path):
+  """Return the path, query and fragment of a request path or URL."""
+  parsed = urlparse.urlparse(path)
+  query = '?%s' % parsed.query if parsed.query else ''
+  fragment = '#%s' % parsed.fragment if parsed.fragment else ''
+  return '%s%s%s' % (parsed.path, query, fragment)
+
+
 class HttpArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   protocol_version = 'HTTP/1.1'  # override BaseHTTPServer setting
 
@@ -61,15 +78,10 @@ class HttpArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       logging.error('Request without host header')
       return None
 
-    parsed = urlparse.urlparse(self.path)
-    query = '?%s' % parsed.query if parsed.query else ''
-    fragment = '#%s' % parsed.fragment if parsed.fragment else ''
-    full_path = '%s%s%s' % (parsed.path, query, fragment)
-
     return httparchive.ArchivedHttpRequest(
         self.command,
         host,
-        full_path,
+        _GetFullPath(self.path),
         self.read_request_body(),
         self.get_header_dict(),
         self.server.is_ssl)
@@ -199,3 +211,463 @@ class HttpsProxyServer(HttpProxyServer):
     self.socket = ssl.wrap_socket(
         self.socket, certfile=certfile, server_side=True)
     # Ancestor class, deamonserver, calls serve_forever() during its __init__.
+
+
+class _Poller(object):
+  """Waits for sockets to become ready, using epoll where there is one."""
+
+  def __init__(self):
+    self._epoll = None
+    if hasattr(select, 'epoll'):
+      self._epoll = select.epoll()
+    self._fds = {}  # {fd: (wants to read, wants to write)}
+
+  def Register(self, fd, readable=True, writable=False):
+    """Start (or change) waiting for fd."""
+    if self._fds.get(fd) == (readable, writable):
+      return
+    if self._epoll:
+      events = ((select.EPOLLIN if readable else 0) |
+                (select.EPOLLOUT if writable else 0))
+      if fd in self._fds:
+        self._epoll.modify(fd, events)
+      else:
+        self._epoll.register(fd, events)
+    self._fds[fd] = (readable, writable)
+
+  def Unregister(self, fd):
+    if self._fds.pop(fd, None) is not None and self._epoll:
+      self._epoll.unregister(fd)
+
+  def Poll(self, timeout):
+    """Returns a list of (fd, is readable, is writable)."""
+    if self._epoll:
+      ready = []
+      for fd, events in self._epoll.poll(timeout):
+        # Errors and hangups show up when the socket is next read.
+        readable = bool(events & (select.EPOLLIN | select.EPOLLERR |
+                                  select.EPOLLHUP))
+        ready.append((fd, readable, bool(events & select.EPOLLOUT)))
+      return ready
+    readers = [fd for fd, (r, _) in self._fds.iteritems() if r]
+    writers = [fd for fd, (_, w) in self._fds.iteritems() if w]
+    if not readers and not writers:
+      time.sleep(timeout)
+      return []
+    readable, writable, _ = select.select(readers, writers, [], timeout)
+    readable, writable = set(readable), set(writable)
+    return [(fd, fd in readable, fd in writable) for fd in readable | writable]
+
+  def Close(self):
+    if self._epoll:
+      self._epoll.close()
+
+
+class _AsyncHttpConnection(object):
+  """The state of one client connection to an AsyncHttpProxyServer."""
+
+  def __init__(self, sock, address):
+    self.socket = sock
+    self.address = address
+    self.in_data = ''
+    # Strings and buffers waiting to be sent.
+    self.out_data = collections.deque()
+    # The rest of the response being sent, as a deque of
+    # (delay in seconds, [strings and buffers]). None when no response has
+    # been started.
+    self.steps = None
+    self.is_busy = False  # True from reading a request to sending its response
+    self.close_when_done = False
+    self.is_eof = False  # True once the client has shut down its side
+    self.is_closed = False
+    self.request = None
+    self.start_time = None
+
+
+class AsyncHttpProxyServer(daemonserver.DaemonServer):
+  """An HTTP proxy serving every connection from one event loop.
+
+  HttpProxyServer starts a thread per connection, and those threads sleep
+  through the recorded server delays. Here requests are read and responses
+  written by a single thread, the delays before the headers and each chunk
+  are timers, and any number of connections can be waiting on them at once.
+
+  Headers (and other small pieces of a response) are sent together, and
+  bodies loaded from an indexed archive are sent straight from the memory
+  map without being copied.
+
+  Replay lookups happen on the event loop, so they need to be quick (the
+  archive and script injection caches see to that). In record mode,
+  responses are fetched on a thread per request, since they come from the
+  network.
+
+  Only plain HTTP is served; use HttpsProxyServer for SSL.
+  """
+
+  POLL_TIMEOUT = 0.5  # seconds between checks for shutdown
+  FETCH_POLL_TIMEOUT = 0.01  # seconds between checks for finished fetches
+  MAX_HEADER_SIZE = 65536
+  RECV_SIZE = 65536
+  COALESCE_SIZE = 16384  # send pieces smaller than this together
+
+  is_ssl = False
+
+  def __init__(self, http_archive_fetch, custom_handlers,
+               host='localhost', port=80, use_delays=False, timer=time.time):
+    """Initialize AsyncHttpProxyServer.
+
+    Args:
+      http_archive_fetch: a ControllableHttpArchiveFetch.
+      custom_handlers: a CustomHandlers.
+      host: the host name or IP to listen on.
+      port: the port to listen on.
+      use_delays: If True, use the recorded server delays during replay.
+      timer: a function returning the current time in seconds.
+    """
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+      self.socket.bind((host, port))
+      self.socket.listen(HttpProxyServer.request_queue_size)
+    except socket.error, e:
+      self.socket.close()
+      raise HttpProxyServerError('Could not start HTTPServer on port %d: %s' %
+                                 (port, e))
+    self.socket.setblocking(0)
+    self.server_address = self.socket.getsockname()
+    self.http_archive_fetch = http_archive_fetch
+    self.custom_handlers = custom_handlers
+    self.use_delays = use_delays
+    self.timer = timer
+    self.poller = _Poller()
+    self.poller.Register(self.socket.fileno())
+    self.connections = {}  # {fd: _AsyncHttpConnection}
+    # heap of (time, sequence number, connection, function, args)
+    self.timers = []
+    self.timer_count = 0
+    self.num_fetching = 0
+    self.finished_fetches = collections.deque()
+    self.is_running = False
+    self.stopped = threading.Event()
+    logging.info('Started async HTTP server on %s...', self.server_address)
+
+  def serve_forever(self):
+    self.is_running = True
+    try:
+      while self.is_running:
+        timeout = self.POLL_TIMEOUT
+        if self.timers:
+          timeout = max(0, min(timeout, self.timers[0][0] - self.timer()))
+        if self.num_fetching:
+          timeout = min(timeout, self.FETCH_POLL_TIMEOUT)
+        try:
+          ready = self.poller.Poll(timeout)
+        except (select.error, IOError), e:
+          if e.args[0] == errno.EINTR:
+            continue
+          raise
+        for fd, readable, writable in ready:
+          if fd == self.socket.fileno():
+            self._Accept()
+            continue
+          connection = self.connections.get(fd)
+          if connection is None:
+            continue
+          try:
+            if readable:
+              self._Read(connection)
+            if writable and not connection.is_closed:
+              self._Write(connection)
+          except Exception:
+            logging.exception('Error serving %s', connection.address)
+            self._Close(connection)
+        self._RunTimers()
+        self._FinishFetches()
+    finally:
+      for connection in self.connections.values():
+        self._Close(connection)
+      self.poller.Close()
+      self.stopped.set()
+
+  def cleanup(self):
+    if self.is_running:
+      self.is_running = False
+      self.stopped.wait(self.POLL_TIMEOUT * 4)
+    self.socket.close()
+    logging.info('Stopped HTTP server')
+
+  def _CallLater(self, delay, connection, function, *args):
+    """Call function(*args) for connection after delay seconds."""
+    self.timer_count += 1
+    heapq.heappush(self.timers, (self.timer() + delay, self.timer_count,
+                                 connection, function, args))
+
+  def _RunTimers(self):
+    now = self.timer()
+    while self.timers and self.timers[0][0] <= now:
+      _, _, connection, function, args = heapq.heappop(self.timers)
+      try:
+        function(*args)
+      except Exception:
+        # The rest of the response is never going to be sent, so don't leave
+        # the client waiting for it.
+        logging.exception('Error serving %s', connection.address)
+        self._Close(connection)
+
+  def _Accept(self):
+    while True:
+      try:
+        sock, address = self.socket.accept()
+      except socket.error, e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          logging.error('Error accepting connection: %s', e)
+        return
+      sock.setblocking(0)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      connection = _AsyncHttpConnection(sock, address)
+      self.connections[sock.fileno()] = connection
+      self.poller.Register(sock.fileno())
+
+  def _Close(self, connection):
+    if connection.is_closed:
+      return
+    connection.is_closed = True
+    fd = connection.socket.fileno()
+    self.poller.Unregister(fd)
+    del self.connections[fd]
+    connection.socket.close()
+
+  def _Read(self, connection):
+    if connection.is_eof:
+      # We stopped asking to read, so this is a hangup: nobody is left to
+      # send the rest of the response to.
+      self._Close(connection)
+      return
+    while True:
+      try:
+        data = connection.socket.recv(self.RECV_SIZE)
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          break
+        logging.debug('Error reading from %s: %s', connection.address, e)
+        self._Close(connection)
+        return
+      if not data:
+        # The client may have only shut down its side after sending its
+        # requests, so answer those before closing.
+        connection.is_eof = True
+        break
+      connection.in_data += data
+    self._StartRequest(connection)
+    if connection.is_eof and not connection.is_closed:
+      if connection.is_busy:
+        # Stop waiting to read, but keep sending the response.
+        self._UpdateConnection(connection)
+      else:
+        self._Close(connection)
+
+  def _Write(self, connection):
+    out_data = connection.out_data
+    while out_data:
+      data = out_data[0]
+      if len(data) < self.COALESCE_SIZE and len(out_data) > 1:
+        pieces = []
+        size = 0
+        while out_data and size + len(out_data[0]) <= self.COALESCE_SIZE:
+          piece = out_data.popleft()
+          pieces.append(str(piece))
+          size += len(piece)
+        data = ''.join(pieces)
+        out_data.appendleft(data)
+      try:
+        sent = connection.socket.send(data)
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          break
+        logging.debug('Error writing to %s: %s', connection.address, e)
+        self._Close(connection)
+        return
+      if sent < len(data):
+        out_data[0] = buffer(data, sent)
+        break
+      out_data.popleft()
+    self._UpdateConnection(connection)
+
+  def _UpdateConnection(self, connection):
+    """Finish the response if it is all sent, and wait for the right events."""
+    if connection.is_closed:
+      return
+    if (connection.is_busy and connection.steps is not None and
+        not connection.steps and not connection.out_data):
+      logging.debug('Served: %s (%dms)', connection.request,
+                    (self.timer() - connection.start_time) * 1000.0)
+      connection.is_busy = False
+      connection.steps = None
+      connection.request = None
+      if connection.close_when_done:
+        self._Close(connection)
+        return
+      self._StartRequest(connection)
+      if connection.is_closed:
+        return
+      if connection.is_eof and not connection.is_busy:
+        self._Close(connection)
+        return
+    self.poller.Register(connection.socket.fileno(),
+                         readable=not connection.is_eof,
+                         writable=bool(connection.out_data))
+
+  def _StartRequest(self, connection):
+    """Start answering the next request, if it has all been read."""
+    if connection.is_busy or connection.close_when_done:
+      return
+    in_data = connection.in_data
+    header_end = in_data.find('\r\n\r\n')
+    if header_end < 0:
+      if len(in_data) > self.MAX_HEADER_SIZE:
+        self._SendError(connection, 400)
+      return
+    request_line, _, header_data = in_data[:header_end + 2].partition('\r\n')
+    words = request_line.split()
+    if len(words) != 3 or not words[2].startswith('HTTP/'):
+      logging.error('Bad request line from %s: %r', connection.address,
+                    request_line)
+      self._SendError(connection, 400)
+      return
+    command, path, version = words
+    headers = mimetools.Message(StringIO.StringIO(header_data), 0)
+    try:
+      body_length = int(headers.get('content-length', 0))
+    except ValueError:
+      self._SendError(connection, 400)
+      return
+    body_start = header_end + 4
+    if len(in_data) < body_start + body_length:
+      return
+    connection.in_data = in_data[body_start + body_length:]
+    request_body = in_data[body_start:body_start + body_length] or None
+
+    # Decide whether to keep the connection open the same way
+    # BaseHTTPRequestHandler does.
+    connection.close_when_done = version < 'HTTP/1.1'
+    connection_header = headers.get('connection', '').lower()
+    if connection_header == 'close':
+      connection.close_when_done = True
+    elif connection_header == 'keep-alive':
+      connection.close_when_done = False
+
+    connection.is_busy = True
+    connection.start_time = self.timer()
+    host = headers.get('host')
+    if host is None:
+      logging.error('Request without host header')
+      self._StartResponse(connection, httparchive.create_response(500))
+      return
+    request = httparchive.ArchivedHttpRequest(
+        command, host, _GetFullPath(path), request_body, dict(headers.items()),
+        self.is_ssl)
+    connection.request = request
+
+    response = self.custom_handlers.handle(request)
+    if response:
+      self._StartResponse(connection, response)
+    elif self.http_archive_fetch.is_record_mode:
+      self.num_fetching += 1
+      thread = threading.Thread(target=self._Fetch, args=(connection, request))
+      thread.daemon = True
+      thread.start()
+    else:
+      self._StartResponse(connection, self.http_archive_fetch(request))
+
+  def _Fetch(self, connection, request):
+    """Fetch a response on its own thread and hand it to the event loop."""
+    response = None
+    try:
+      response = self.http_archive_fetch(request)
+    except Exception:
+      logging.exception('Error fetching %s', request)
+    self.finished_fetches.append((connection, response))
+
+  def _FinishFetches(self):
+    while self.finished_fetches:
+      connection, response = self.finished_fetches.popleft()
+      self.num_fetching -= 1
+      if connection.is_closed:
+        continue
+      try:
+        self._StartResponse(connection, response)
+      except Exception:
+        logging.exception('Error serving %s', connection.address)
+        self._Close(connection)
+
+  def _SendError(self, connection, status):
+    """Answer a request we couldn't parse, and then close the connection."""
+    connection.is_busy = True
+    connection.close_when_done = True
+    connection.in_data = ''
+    connection.start_time = self.timer()
+    self._StartResponse(connection, httparchive.create_response(status))
+
+  def _StartResponse(self, connection, response):
+    """Turn the response into steps to send, and start sending them."""
+    if not response:
+      response = httparchive.create_response(404)
+    is_chunked = response.is_chunked()
+    status_line = '%s %d %s\r\n' % (
+        'HTTP/1.0' if response.version == 10 else 'HTTP/1.1',
+        response.status, response.reason)
+    headers = [status_line,
+               'Server: %s\r\n' % response.get_header('server',
+                                                      'WebPageReplay'),
+               'Date: %s\r\n' % email.utils.formatdate(usegmt=True)]
+    for header, value in response.headers:
+      if header == 'server':
+        continue
+      headers.append('%s: %s\r\n' % (header, value))
+      if header.lower() == 'connection':
+        if value.lower() == 'close':
+          connection.close_when_done = True
+        elif value.lower() == 'keep-alive':
+          connection.close_when_done = False
+    chunks = response.response_data
+    if isinstance(chunks, httparchive.MappedChunks):
+      chunks = chunks.get_buffers()
+    # If we don't have chunked encoding and there is no content length,
+    # we need to manually compute the content-length.
+    if not is_chunked and response.get_header('content-length') is None:
+      headers.append('content-length: %d\r\n' % sum(len(c) for c in chunks))
+    headers.append('\r\n')
+    if response.version == 10:
+      connection.close_when_done = True
+
+    use_delays = (self.use_delays and
+                  not self.http_archive_fetch.is_record_mode)
+    delays = response.delays
+    steps = collections.deque()
+    steps.append((delays['headers'] / 1000.0 if use_delays else 0,
+                  [''.join(headers)]))
+    for chunk, delay in zip(chunks, delays['data']):
+      if is_chunked:
+        pieces = ['%x\r\n' % len(chunk), chunk, '\r\n']
+      else:
+        pieces = [chunk]
+      steps.append((delay / 1000.0 if use_delays else 0, pieces))
+    if is_chunked:
+      steps.append((0, ['0\r\n\r\n']))  # the final, zero-length chunk
+    connection.steps = steps
+    self._SendSteps(connection)
+
+  def _SendSteps(self, connection, waited=False):
+    """Queue the steps of the response up to the next delay."""
+    if connection.is_closed:
+      return
+    steps = connection.steps
+    while steps:
+      delay, pieces = steps[0]
+      if delay > 0 and not waited:
+        self._CallLater(delay, connection, self._SendSteps, connection, True)
+        break
+      waited = False
+      steps.popleft()
+      connection.out_data.extend(pieces)
+    self._Write(connection)
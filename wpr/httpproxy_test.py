@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import httparchive
+import httplib
+import httpproxy
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+
+class FakeFetch(object):
+  """Serves responses from a dict, like ControllableHttpArchiveFetch."""
+
+  def __init__(self, responses, is_record_mode=False):
+    self.responses = responses
+    self.is_record_mode = is_record_mode
+    self.requests = []
+    self.threads = set()
+
+  def __call__(self, request):
+    self.requests.append(request)
+    self.threads.add(threading.current_thread().name)
+    return self.responses.get(request.path)
+
+
+class FakeCustomHandlers(object):
+
+  def handle(self, request):
+    if request.path == '/custom':
+      return httparchive.create_response(200, body='custom')
+    return None
+
+
+class AsyncHttpProxyServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.responses = {
+        '/': httparchive.ArchivedHttpResponse(
+            11, 200, 'OK', [('content-type', 'text/plain')], ['hello']),
+        '/chunked': httparchive.ArchivedHttpResponse(
+            11, 200, 'OK', [('transfer-encoding', 'chunked')],
+            ['one', 'two', 'three'], {'headers': 0, 'data': [0, 0, 0]}),
+        '/slow': httparchive.ArchivedHttpResponse(
+            11, 200, 'OK', [], ['a', 'b'], {'headers': 100, 'data': [50, 50]}),
+    }
+    self.fetch = FakeFetch(self.responses)
+    self.server = None
+
+  def tearDown(self):
+    if self.server:
+      self.server.cleanup()
+
+  def start_server(self, **kwargs):
+    self.server = httpproxy.AsyncHttpProxyServer(
+        self.fetch, FakeCustomHandlers(), host='127.0.0.1', port=0, **kwargs)
+    self.server.__enter__()
+    return self.server.server_address[1]
+
+  def get(self, connection, path, headers=None):
+    connection.request('GET', path, headers=headers or {'host': 'test.com'})
+    response = connection.getresponse()
+    return response, response.read()
+
+  def test_keep_alive(self):
+    connection = httplib.HTTPConnection('127.0.0.1', self.start_server())
+    for path, expected in (('/', 'hello'), ('/chunked', 'onetwothree'),
+                           ('/custom', 'custom'), ('/', 'hello')):
+      response, body = self.get(connection, path)
+      self.assertEqual(200, response.status)
+      self.assertEqual(expected, body)
+    self.assertEqual('5', response.getheader('content-length'))
+    self.assertEqual(1, len(self.server.connections))
+    connection.close()
+    self.assertEqual(['/', '/chunked', '/'],
+                     [r.path for r in self.fetch.requests])
+    self.assertEqual('test.com', self.fetch.requests[0].host)
+
+  def fetch_raw(self, port, path):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall('GET %s HTTP/1.1\r\nHost: test.com\r\n'
+                 'Connection: close\r\n\r\n' % path)
+    data = ''
+    while True:
+      received = sock.recv(4096)
+      if not received:
+        break
+      data += received
+    sock.close()
+    headers, body = data.split('\r\n\r\n', 1)
+    headers = headers.split('\r\n')
+    # Leave out the headers that vary.
+    headers = [headers[0]] + sorted(
+        h for h in headers[1:] if h.split(':')[0] not in ('Date', 'Server'))
+    return headers, body
+
+  def test_same_as_threaded_server(self):
+    port = self.start_server()
+    threaded_server = httpproxy.HttpProxyServer(
+        self.fetch, FakeCustomHandlers(), host='127.0.0.1', port=0)
+    with threaded_server:
+      for path in ('/', '/chunked', '/custom', '/missing'):
+        self.assertEqual(
+            self.fetch_raw(threaded_server.server_address[1], path),
+            self.fetch_raw(port, path))
+    headers, body = self.fetch_raw(port, '/chunked')
+    self.assertEqual('HTTP/1.1 200 OK', headers[0])
+    self.assertEqual('3\r\none\r\n3\r\ntwo\r\n5\r\nthree\r\n0\r\n\r\n', body)
+
+  def test_not_found_and_no_host(self):
+    connection = httplib.HTTPConnection('127.0.0.1', self.start_server())
+    response, _ = self.get(connection, '/missing')
+    self.assertEqual(404, response.status)
+    connection.putrequest('GET', '/', skip_host=True)
+    connection.endheaders()
+    response = connection.getresponse()
+    response.read()
+    self.assertEqual(500, response.status)
+    connection.close()
+
+  def test_request_body(self):
+    connection = httplib.HTTPConnection('127.0.0.1', self.start_server())
+    connection.request('POST', '/?q=1', 'x=y', {'host': 'test.com'})
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    request = self.fetch.requests[0]
+    self.assertEqual(('POST', '/?q=1', 'x=y'),
+                     (request.command, request.path, request.request_body))
+
+  def test_bad_request(self):
+    sock = socket.create_connection(('127.0.0.1', self.start_server()))
+    sock.sendall('NONSENSE\r\n\r\n')
+    sock.settimeout(5)
+    self.assertTrue(sock.recv(4096).startswith('HTTP/1.1 400 '))
+    self.assertEqual('', sock.recv(4096))
+    sock.close()
+
+  def test_delays_do_not_block(self):
+    port = self.start_server(use_delays=True)
+    connections = [httplib.HTTPConnection('127.0.0.1', port)
+                   for _ in range(10)]
+    start = time.time()
+    for connection in connections:
+      connection.request('GET', '/slow', headers={'host': 'test.com'})
+    for connection in connections:
+      self.assertEqual('ab', connection.getresponse().read())
+      connection.close()
+    elapsed = time.time() - start
+    # Each response takes 200ms; they should all be delayed at once.
+    self.assertTrue(0.2 <= elapsed < 1.0, elapsed)
+
+  def read_until_closed(self, sock):
+    sock.settimeout(5)
+    data = ''
+    while True:
+      received = sock.recv(4096)
+      if not received:
+        return data
+      data += received
+
+  def test_half_closed_connection(self):
+    sock = socket.create_connection(
+        ('127.0.0.1', self.start_server(use_delays=True)))
+    sock.sendall('GET /slow HTTP/1.1\r\nHost: test.com\r\n\r\n'
+                 'GET / HTTP/1.1\r\nHost: test.com\r\n\r\n')
+    sock.shutdown(socket.SHUT_WR)
+    data = self.read_until_closed(sock)
+    sock.close()
+    self.assertEqual(2, data.count('HTTP/1.1 200 OK'))
+    self.assertTrue(data.endswith('hello'), data)
+    self.assertEqual({}, self.server.connections)
+
+  def test_timer_error_closes_connection(self):
+    port = self.start_server(use_delays=True)
+    send_steps = self.server._SendSteps
+    def FailingSendSteps(connection, waited=False):
+      if waited:
+        raise ValueError('failing on purpose')
+      send_steps(connection, waited)
+    self.server._SendSteps = FailingSendSteps
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall('GET /slow HTTP/1.1\r\nHost: test.com\r\n\r\n')
+    self.assertEqual('', self.read_until_closed(sock))
+    sock.close()
+
+  def test_record_mode_fetches_on_threads(self):
+    self.fetch.is_record_mode = True
+    connection = httplib.HTTPConnection('127.0.0.1', self.start_server())
+    response, body = self.get(connection, '/')
+    self.assertEqual('hello', body)
+    connection.close()
+    self.assertEqual(1, len(self.fetch.threads))
+    self.assertFalse(threading.current_thread().name in self.fetch.threads)
+
+  def test_error_after_fetch_closes_connection(self):
+    self.fetch.is_record_mode = True
+    self.responses['/'] = 'not a response'
+    port = self.start_server()
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall('GET / HTTP/1.1\r\nHost: test.com\r\n\r\n')
+    self.assertEqual('', self.read_until_closed(sock))
+    sock.close()
+    # The server is still up.
+    del self.responses['/']
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    response, _ = self.get(connection, '/')
+    self.assertEqual(404, response.status)
+    connection.close()
+
+  def test_mapped_response(self):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      archive = httparchive.HttpArchive()
+      request = httparchive.ArchivedHttpRequest(
+          'GET', 'test.com', '/big', None, {})
+      body = os.urandom(1024 * 1024)
+      archive[request] = httparchive.ArchivedHttpResponse(
+          11, 200, 'OK', [], [body[:1000], body[1000:]])
+      archive.indexed = True
+      filename = os.path.join(tmp_dir, 'archive.wpr')
+      archive.Persist(filename)
+      archive = httparchive.HttpArchive.Load(filename)
+      self.responses['/big'] = archive[request]
+      connection = httplib.HTTPConnection('127.0.0.1', self.start_server())
+      response, data = self.get(connection, '/big')
+      connection.close()
+      self.assertEqual(body, data)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -112,7 +112,8 @@ def AddWebProxy(server_manager, options, host, real_dns_lookup, http_archive,
         inject_script,
         options.diff_unknown_requests,
         cache_misses=cache_misses,
-        use_closest_match=options.use_closest_match)
+        use_closest_match=options.use_closest_match,
+        inject_at_load=options.inject_scripts_at_load)
     server_manager.Append(
         replayspdyserver.ReplaySpdyServer, http_archive_fetch,
         http_custom_handlers, host=host, port=options.port,
@@ -123,11 +124,16 @@ def AddWebProxy(server_manager, options, host, real_dns_lookup, http_archive,
         http_archive, real_dns_lookup,
         inject_script,
         options.diff_unknown_requests, options.record,
-        cache_misses=cache_misses, use_closest_match=options.use_closest_match)
+        cache_misses=cache_misses, use_closest_match=options.use_closest_match,
+        inject_at_load=options.inject_scripts_at_load)
     server_manager.AppendRecordCallback(http_archive_fetch.SetRecordMode)
     server_manager.AppendReplayCallback(http_archive_fetch.SetReplayMode)
+    if options.async_http:
+      http_server_class = httpproxy.AsyncHttpProxyServer
+    else:
+      http_server_class = httpproxy.HttpProxyServer
     server_manager.Append(
-        httpproxy.HttpProxyServer, http_archive_fetch, http_custom_handlers,
+        http_server_class, http_archive_fetch, http_custom_handlers,
         host=host, port=options.port, use_delays=options.use_server_delay)
     if options.ssl:
       server_manager.Append(
@@ -244,6 +250,7 @@ def replay(options, replay_filename):
         name_servers=[platform_settings.get_original_primary_dns()])
     if options.record:
       http_archive = httparchive.HttpArchive()
+      http_archive.indexed = options.indexed_archive
       http_archive.AssertWritable(replay_filename)
     else:
       http_archive = httparchive.HttpArchive.Load(replay_filename)
@@ -311,6 +318,10 @@ def main():
   option_parser.add_option('-r', '--record', default=False,
       action='store_true',
       help='Download real responses and record them to replay_file')
+  option_parser.add_option('--indexed_archive', default=False,
+      action='store_true',
+      help='Record to the indexed archive format, which loads much faster. '
+           'Archives in either format can be replayed.')
   option_parser.add_option('-l', '--log_level', default='debug',
       action='store',
       type='choice',
@@ -379,6 +390,11 @@ def main():
            'pages. By default a script is injected that eliminates sources '
            'of entropy such as Date() and Math.random() deterministic. '
            'CAUTION: Without deterministic.js, many pages will not replay.')
+  harness_group.add_option('--inject_scripts_at_load', default=False,
+      action='store_true',
+      dest='inject_scripts_at_load',
+      help='Inject scripts into all the pages in the archive when it is '
+           'loaded, instead of when each page is first replayed.')
   harness_group.add_option('-D', '--no-diff_unknown_requests', default=True,
       action='store_false',
       dest='diff_unknown_requests',
@@ -394,6 +410,12 @@ def main():
       dest='use_server_delay',
       help='During replay, simulate server delay by delaying response time to'
            'requests.')
+  harness_group.add_option('--async_http', default=False,
+      action='store_true',
+      dest='async_http',
+      help='Serve HTTP (but not HTTPS) from a single event loop, instead of '
+           'a thread per connection. Server delays are then timers rather '
+           'than sleeping threads.')
   harness_group.add_option('-I', '--screenshot_dir', default=None,
       action='store',
       type='string',